@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of TPM simulations.
+
+Each simulation is keyed by a hash of all its inputs (contents of the
+shape, eph, and obs files and the TPM parameters). Results are appended to
+a single text file, one line per simulation, so that an interrupted or
+overlapping campaign can reuse what is already done.
+"""
+import os
+import hashlib
+
+
+# Hashes of files already read: (path, mtime, size) -> hash
+_file_hashes = {}
+
+
+def hash_file(path):
+    """
+    SHA-256 of the contents of a file (memoized per path and mtime).
+    """
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if memo_key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _file_hashes[memo_key] = h.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def make_key(**inputs):
+    """
+    Make a key of a simulation from its inputs.
+
+    Floats are hashed with repr, so that keys do not depend on formatting.
+    """
+    s = " ".join(f"{k}={inputs[k]!r}" for k in sorted(inputs))
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+class TPMCache:
+    """
+    Append-only cache of TPM results.
+
+    Every line is "key value". A line is written with a single write call
+    in append mode, so several campaigns can share a cache directory on a
+    local file system. A line cut by a crash (without a newline) is ignored.
+
+    Parameters
+    ----------
+    cachedir : str
+        directory of the cache
+    """
+    filename = "tpmcache.txt"
+
+    def __init__(self, cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+        self.path = os.path.join(cachedir, self.filename)
+        self.data = {}
+        # Lookups (with --resume) and new results of this run
+        self.hits, self.misses, self.writes = 0, 0, 0
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                lines = f.read().split("\n")
+            # The last element is empty or an incomplete line
+            for line in lines[:-1]:
+                key, _, value = line.partition(" ")
+                if value:
+                    self.data[key] = value
+        self.f = open(self.path, "a")
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        """
+        Return the cached value of key (None if not cached).
+        """
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Save value of key.
+        """
+        self.data[key] = value
+        self.f.write(f"{key} {value}\n")
+        self.f.flush()
+        self.writes += 1
+
+    def close(self):
+        self.f.close()
+
+    def stats(self):
+        """
+        Summary of hits and misses (only of lookups) and results saved.
+        """
+        N = self.hits + self.misses
+        lookups = (
+            f"{self.hits} hits, {self.misses} misses ({self.hits/N*100:.1f}% hit rate)" if N
+            else "no lookups")
+        return f"Cache: {lookups}, {self.writes} saved, {len(self.data)} entries in {self.path}"
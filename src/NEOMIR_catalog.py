@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Indexed catalog of TPM results (SQLite).
+
+All rows of TI{Gamma}_res_{label}.txt of one or more campaigns are kept in
+a single table indexed on (campaign, objid, TI, lam, beta), so that objects
+are listed and rows are selected without scanning result directories nor
+reading whole files, e.g., all Gamma = 300 rows with beta < 0 of objects
+1--50:
+    python src/NEOMIR_catalog.py query data/tpmres.sqlite --campaign tpmout_original --TI 300 --beta -90 0 --objid 1-50
+runtpm_NEOMIR.py fills the catalog with --catalog, and existing results
+are added with
+    python src/NEOMIR_catalog.py add data/tpmres.sqlite data/tpmout_original
+The campaign is the name of the result directory by default.
+"""
+from argparse import ArgumentParser as ap
+import os
+import re
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from NEOMIR_common import list_tpmres, read_tpmres_file, tpmres_names
+from NEOMIR_geometry import object_geometry, cached_geometry, position_columns
+
+
+# Rows are kept in the order of the file (row), since idx is not unique in
+# results of old versions of runtpm_NEOMIR.py (idx of each cycle).
+# Flux columns (flux5, flux8, ...) are added when they appear.
+_schema = """
+CREATE TABLE IF NOT EXISTS results (
+    campaign TEXT NOT NULL, objid INTEGER NOT NULL, TI INTEGER NOT NULL,
+    row INTEGER NOT NULL, idx INTEGER, D_km REAL, lam REAL, beta REAL,
+    x1 REAL, y1 REAL, z1 REAL, x2 REAL, y2 REAL, z2 REAL,
+    PRIMARY KEY (campaign, objid, TI, row));
+CREATE INDEX IF NOT EXISTS results_pole ON results (campaign, objid, TI, lam, beta);
+CREATE TABLE IF NOT EXISTS files (
+    campaign TEXT NOT NULL, objid INTEGER NOT NULL, TI INTEGER NOT NULL,
+    path TEXT, nrows INTEGER, mtime REAL,
+    PRIMARY KEY (campaign, objid, TI));
+"""
+
+
+def default_campaign(resdir):
+    """
+    Name of a campaign from its result directory (e.g., tpmout_original).
+    """
+    return os.path.basename(os.path.normpath(resdir))
+
+
+class TPMCatalog:
+    """
+    Catalog of TPM results in an SQLite file.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file of the catalog (made if not exist)
+    timeout : float
+        time in s to wait for a lock held by another process
+    """
+    def __init__(self, path, timeout=60.):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.executescript(_schema)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def columns(self):
+        """
+        Columns of the results table.
+        """
+        return [row[1] for row in self.conn.execute("PRAGMA table_info(results)")]
+
+    def _add_columns(self, cols):
+        existing = self.columns()
+        for col in cols:
+            if col in existing:
+                continue
+            # Names come from headers of result files
+            if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", col):
+                raise ValueError(f"Invalid column name: {col}")
+            self.conn.execute(f"ALTER TABLE results ADD COLUMN {col} REAL")
+
+    def add(self, campaign, objid, TI, data, path=None):
+        """
+        Add (or replace) the rows of a result file.
+
+        Parameters
+        ----------
+        campaign : str
+            name of the campaign
+        objid : int
+            object id
+        TI : int
+            thermal inertia
+        data : dict
+            column name in the header -> numpy.ndarray (see read_tpmres_file)
+        path : str, optional
+            result file
+        """
+        cols = list(data)
+        self._add_columns(cols)
+        N = len(data[cols[0]])
+        values = [np.asarray(data[col]).tolist() for col in cols]
+        values[cols.index("idx")] = [int(x) for x in values[cols.index("idx")]]
+        rows = [(campaign, int(objid), int(TI), n) + row for n, row in enumerate(zip(*values))]
+        with self.conn:
+            # Rows of a previous version of the file (e.g., before refinement)
+            self.conn.execute(
+                "DELETE FROM results WHERE campaign = ? AND objid = ? AND TI = ?",
+                (campaign, int(objid), int(TI)))
+            self.conn.executemany(
+                f"INSERT INTO results (campaign, objid, TI, row, {', '.join(cols)}) "
+                f"VALUES ({', '.join(['?']*(len(cols) + 4))})", rows)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (campaign, objid, TI, path, nrows, mtime) VALUES (?, ?, ?, ?, ?, ?)",
+                (campaign, int(objid), int(TI), None if path is None else os.path.abspath(path), N,
+                 None if path is None else os.stat(path).st_mtime))
+
+    def campaigns(self):
+        """
+        Names of campaigns in the catalog.
+        """
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT campaign FROM files ORDER BY campaign")]
+
+    def list_objid(self, campaign):
+        """
+        List object ids of a campaign.
+        """
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT objid FROM files WHERE campaign = ? ORDER BY objid", (campaign,))]
+
+    def list_files(self, campaign, objid=None, TI=None):
+        """
+        List result files of a campaign as list_tpmres does.
+
+        Return
+        ------
+        files : list of tuple
+            (filename, TI, objid) sorted by objid and TI
+        """
+        rows = self.conn.execute(
+            "SELECT path, TI, objid FROM files WHERE campaign = ? ORDER BY objid, TI", (campaign,)).fetchall()
+        return [
+            row for row in rows
+            if ((objid is None) or (row[2] in objid)) and ((TI is None) or (row[1] in TI))]
+
+    def query(self, campaign, objid=None, TI=None, lam=None, beta=None, columns=None):
+        """
+        Select rows of a campaign.
+
+        Parameters
+        ----------
+        campaign : str
+            name of the campaign
+        objid : array-like, optional
+            object ids (e.g., range(1, 51); all objects by default)
+        TI : array-like, optional
+            thermal inertia (all TI by default)
+        lam, beta : tuple, optional
+            ranges (min, max) of the pole in degree (min <= x < max; None is open)
+        columns : array-like, optional
+            columns in addition to TI and objid (e.g., lon, lat, flux8, X;
+            all columns by default)
+
+        Return
+        ------
+        df : pandas.DataFrame
+            results sorted by objid and TI in the order of files
+            (columns named as in load_tpmres)
+        """
+        if columns is None:
+            cols = [col for col in self.columns() if col not in ("campaign", "objid", "TI", "row")]
+        else:
+            cols = [tpmres_names.get(col, col) for col in columns]
+            missing = [col for col in cols if col not in self.columns()]
+            if missing:
+                raise KeyError(f"No columns {missing} in {self.path}")
+
+        where, params = ["campaign = ?"], [campaign]
+        for name, values in [("objid", objid), ("TI", TI)]:
+            if values is not None:
+                values = [int(x) for x in values]
+                where.append(f"{name} IN ({', '.join(['?']*len(values))})")
+                params += values
+        for name, lim in [("lam", lam), ("beta", beta)]:
+            if lim is None:
+                continue
+            if lim[0] is not None:
+                where.append(f"{name} >= ?")
+                params.append(float(lim[0]))
+            if lim[1] is not None:
+                where.append(f"{name} < ?")
+                params.append(float(lim[1]))
+        sql = (
+            f"SELECT {', '.join(cols + ['TI', 'objid'])} FROM results "
+            f"WHERE {' AND '.join(where)} ORDER BY objid, TI, row")
+        df = pd.read_sql_query(sql, self.conn, params=params)
+        df["TI"] = df["TI"].astype(np.int32)
+        df["objid"] = df["objid"].astype(np.int32)
+        names = {v: k for k, v in tpmres_names.items()}
+        return df.rename(columns=names)
+
+    def load_geometry(self, campaign, objid=None):
+        """
+        Load geometry of objects once per object (see load_geometry in NEOMIR_common).
+
+        Return
+        ------
+        geom : pandas.DataFrame
+            positions, r, delta, and alpha indexed by objid
+        """
+        key = f"{os.path.abspath(self.path)}:{campaign}"
+        if objid is None:
+            objid = self.list_objid(campaign)
+        objid = [int(x) for x in objid]
+        geom = cached_geometry(key, objid)
+        if geom is not None:
+            return geom
+
+        # The first row of the first file of each object (other columns are
+        # taken from the row of MIN() in SQLite)
+        usecols = [tpmres_names[col] for col in position_columns]
+        rows = self.conn.execute(
+            f"SELECT objid, MIN(TI*1000000 + row), {', '.join(usecols)} FROM results "
+            f"WHERE campaign = ? AND objid IN ({', '.join(['?']*len(objid))}) "
+            "GROUP BY objid ORDER BY objid", [campaign] + objid).fetchall()
+        object_geometry([row[0] for row in rows], [row[2:] for row in rows], key)
+
+        geom = cached_geometry(key, objid)
+        if geom is None:
+            missing = sorted(set(objid) - set(row[0] for row in rows))
+            raise FileNotFoundError(f"No results of objects {missing} of {campaign} in {self.path}")
+        return geom
+
+
+def catalog_tpmres(resdir, catalog, campaign=None, update=False):
+    """
+    Add text results in resdir to a catalog.
+
+    Parameters
+    ----------
+    resdir : str
+        directory with TI*_res_*.txt
+    catalog : TPMCatalog
+        catalog
+    campaign : str, optional
+        name of the campaign (name of resdir by default)
+    update : bool
+        add only files modified after they were added
+
+    Return
+    ------
+    N_file : int
+        number of files added
+    """
+    campaign = campaign or default_campaign(resdir)
+    mtimes = {
+        (objid, TI): mtime for objid, TI, mtime in catalog.conn.execute(
+            "SELECT objid, TI, mtime FROM files WHERE campaign = ?", (campaign,))}
+    N_file = 0
+    for filename, TI, objid in list_tpmres(resdir):
+        if update and (mtimes.get((objid, TI)) == os.stat(filename).st_mtime):
+            continue
+        catalog.add(campaign, objid, TI, read_tpmres_file(filename), filename)
+        N_file += 1
+    return N_file
+
+
+def parse_range(text):
+    """
+    Convert 1-50 or 3 to a list of integers.
+    """
+    lo, _, hi = text.partition("-")
+    return list(range(int(lo), int(hi or lo) + 1))
+
+
+if __name__ == "__main__":
+    parser = ap(description="Indexed catalog of TPM results.")
+    parser.add_argument(
+        "command", type=str, choices=["add", "list", "query"],
+        help="add (result directories), list (campaigns), or query (rows)")
+    parser.add_argument(
+        "catalog", type=str,
+        help="SQLite file of the catalog")
+    parser.add_argument(
+        "resdir", type=str, nargs="*",
+        help="Directories with output files (for add)")
+    parser.add_argument(
+        "--campaign", type=str, default=None,
+        help="Name of the campaign (name of the directory by default)")
+    parser.add_argument(
+        "--update", action="store_true", default=False,
+        help="Add only files modified after they were added")
+    parser.add_argument(
+        "--objid", type=str, nargs="*", default=None,
+        help="Object ids (e.g., 1-50 7)")
+    parser.add_argument(
+        "--TI", type=int, nargs="*", default=None,
+        help="Thermal inertia")
+    parser.add_argument(
+        "--lam", type=float, nargs=2, default=None,
+        help="Range of longitude of the pole (min <= lam < max)")
+    parser.add_argument(
+        "--beta", type=float, nargs=2, default=None,
+        help="Range of latitude of the pole (min <= beta < max)")
+    parser.add_argument(
+        "--columns", type=str, nargs="*", default=None,
+        help="Columns to be shown (e.g., lon lat flux8)")
+    parser.add_argument(
+        "--out", type=str, default=None,
+        help="Output filename of rows (shown if not given)")
+    args = parser.parse_args()
+
+    catalog = TPMCatalog(args.catalog)
+    if args.command == "add":
+        for resdir in args.resdir:
+            N_file = catalog_tpmres(resdir, catalog, args.campaign, args.update)
+            print(f"Added {N_file} files of {args.campaign or default_campaign(resdir)}")
+    elif args.command == "list":
+        for campaign in catalog.campaigns():
+            objid = catalog.list_objid(campaign)
+            N_file, N_row = catalog.conn.execute(
+                "SELECT COUNT(*), SUM(nrows) FROM files WHERE campaign = ?", (campaign,)).fetchone()
+            print(f"{campaign}: {len(objid)} objects, {N_file} files, {N_row} rows")
+    else:
+        assert args.campaign, "Set --campaign."
+        objid = None if args.objid is None else [i for x in args.objid for i in parse_range(x)]
+        df = catalog.query(
+            args.campaign, objid=objid, TI=args.TI, lam=args.lam, beta=args.beta,
+            columns=args.columns)
+        if args.out:
+            df.to_csv(args.out, sep=" ", index=False)
+            print(f"Saved {len(df)} rows in {args.out}")
+        else:
+            print(df.to_string(index=False, max_rows=20))
+            print(f"{len(df)} rows")
+    catalog.close()
@@ -3,6 +3,12 @@
 import numpy as np
 import pandas as pd
 import os
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from NEOMIR_geometry import (
+    calc_aspect, object_geometry, cached_geometry, join_geometry, position_columns)
 
 Gamma_values = [0, 50, 150, 300, 500, 1000]
 mycolor = [
@@ -10,59 +16,752 @@ mycolor = [
     "#89c3eb", "#ec6800", "cyan", "gold", "magenta"]
 
 
-def handle_tpmres(resdir):
-    filenames = [f.name for f in os.scandir(resdir)]
-    df_list = []
-    for idx_obj, fi in enumerate(filenames):
-        filename = os.path.join(resdir, fi)
-        # Extract TI from TI300_res_141.txt
-        TI = int(fi.split("_")[0][2:])
-        data = np.loadtxt(filename)
-
-        # Extract columns: lon, lat, flux5, flux8,  x1, y1, z1, x2, y2, z2
-        lon, lat, flux5, flux8 = data[:, 2], data[:, 3], data[:, 4], data[:, 5]
-        x1, y1, z1     = data[:, 6], data[:, 7], data[:, 8]
-        x2, y2, z2     = data[:, 9], data[:, 10], data[:, 11]
-
-        # Since we used asteroids with diameters of 1 km in TPM to avoid the loss of digits,
-        # we have to slace fluxes here.
-        # From 1 km to 42 m (H=25, pv=0.1)
-        sf = (42./1000.)**2
-        flux5, flux8 = flux5*sf, flux8*sf
-
-        df = pd.DataFrame(dict(
-            lon=lon, lat=lat, flux5=flux5, flux8=flux8,
-            X=x1, Y=y1, Z=z1, MirX=x2, MirY=y2, MirZ=z2
-            ))
-        df["TI"] = TI
-        df["objid"] = idx_obj
-        df_list.append(df)
-    df = pd.concat(df_list)
+# Names used in analysis -> names in the header of TI*_res_*.txt
+tpmres_names = {
+    "D": "D_km", "lon": "lam", "lat": "beta",
+    "X": "x1", "Y": "y1", "Z": "z1", "MirX": "x2", "MirY": "y2", "MirZ": "z2"}
+
+
+def handle_tpmres(resdir, compact=False):
+    df = load_tpmres(resdir, columns=["lon", "lat", "flux5", "flux8"], compact=compact)
+    # r, delta, and alpha of each object
+    df = join_geometry(df, load_geometry(resdir, np.unique(df["objid"])))
+
+    # Since we used asteroids with diameters of 1 km in TPM to avoid the loss of digits,
+    # we have to slace fluxes here.
+    # From 1 km to 42 m (H=25, pv=0.1)
+    sf = (42./1000.)**2
+    df["flux5"] *= sf
+    df["flux8"] *= sf
     return df
 
 
-def calc_aspect(df):
+def list_tpmres(resdir, objid=None, TI=None):
     """
-    Calculate alpha, delta, and r.
+    List result files in resdir.
 
-    Parameter
-    ---------
+    Parameters
+    ----------
+    resdir : str
+        directory with TI*_res_*.txt
+    objid : array-like, optional
+        object ids to be listed
+    TI : array-like, optional
+        thermal inertia to be listed
+
+    Return
+    ------
+    files : list of tuple
+        (filename, TI, objid) sorted by objid and TI
+    """
+    files = []
+    for f in os.scandir(resdir):
+        if not (f.name.startswith("TI") and f.name.endswith(".txt")):
+            continue
+        TI_fi, objid_fi = parse_tpmres_filename(f.name)
+        if (objid is not None) and (objid_fi not in objid):
+            continue
+        if (TI is not None) and (TI_fi not in TI):
+            continue
+        files.append((f.path, TI_fi, objid_fi))
+    return sorted(files, key=lambda x: (x[2], x[1]))
+
+
+def list_objid(resdir):
+    """
+    List object ids in resdir (directory with TI*_res_*.txt or a store).
+    """
+    if is_tpmstore(resdir):
+        return [int(x) for x in np.unique(load_tpmstore(resdir, ["objid"])["objid"])]
+    return sorted(set(x[2] for x in list_tpmres(resdir)))
+
+
+def read_tpmres_file(filename, usecols=None):
+    """
+    Read a result file of runtpm_NEOMIR.py with its header.
+
+    Parameters
+    ----------
+    filename : str
+        result file (e.g., TI300_res_141.txt)
+    usecols : array-like, optional
+        columns to be read (names in the header)
+
+    Return
+    ------
+    data : dict
+        column name -> numpy.ndarray
+    """
+    df = pd.read_csv(
+        filename, sep=r"\s+", engine="c", usecols=usecols, dtype=np.float64)
+    return {col: df[col].values for col in df.columns}
+
+
+def load_tpmres(resdir, objid=None, TI=None, columns=None, nthreads=8, compact=False):
+    """
+    Load TPM results with columns resolved from the header.
+
+    Only files of the selected objects and TI, and only the selected
+    columns are read. Files are read in parallel with threads.
+
+    Parameters
+    ----------
+    resdir : str
+        directory with TI*_res_*.txt or a columnar store
+    objid : array-like, optional
+        object ids to be loaded (all objects by default)
+    TI : array-like, optional
+        thermal inertia to be loaded (all TI by default)
+    columns : array-like, optional
+        columns to be loaded in addition to TI and objid
+        (e.g., lon, lat, flux8, X; all columns by default)
+    nthreads : int
+        number of threads to read files
+    compact : bool
+        if True, values are float32 and TI is categorical (half the memory)
+
+    Return
+    ------
+    df : pandas.DataFrame
+        results sorted by objid and TI
+    """
+    if is_tpmstore(resdir):
+        data = load_tpmstore(resdir)
+        mask = np.ones(len(data["objid"]), dtype=bool)
+        if objid is not None:
+            mask &= np.isin(data["objid"], objid)
+        if TI is not None:
+            mask &= np.isin(data["TI"], TI)
+        if columns is None:
+            usecols = [col for col in data if col not in ("objid", "TI")]
+        else:
+            usecols = [tpmres_names.get(col, col) for col in columns]
+        # Rows are in the order files were completed (e.g., by runtpm --store),
+        # so they are sorted as in a directory (stable, keeping idx order in a file)
+        idx = np.flatnonzero(mask)
+        idx = idx[np.lexsort((data["TI"][idx], data["objid"][idx]))]
+        out = {col: data[col][idx] for col in usecols}
+        out["TI"] = data["TI"][idx]
+        out["objid"] = data["objid"][idx]
+        return tpmres_frame(out, compact)
+
+    files = list_tpmres(resdir, objid=objid, TI=TI)
+    if not files:
+        raise FileNotFoundError(f"No results found in {resdir}")
+    return read_tpmres_files(files, columns, nthreads, compact)
+
+
+def read_tpmres_files(files, columns=None, nthreads=8, compact=False, executor=None):
+    """
+    Read result files into a single table.
+
+    Parameters
+    ----------
+    files : list of tuple
+        (filename, TI, objid) as returned by list_tpmres
+    columns : array-like, optional
+        columns to be read in addition to TI and objid (all columns by default)
+    nthreads : int
+        number of threads to read files
+    compact : bool
+        if True, values are float32 and TI is categorical
+    executor : concurrent.futures.Executor, optional
+        pool of threads reused between calls (nthreads is ignored)
+
+    Return
+    ------
     df : pandas.DataFrame
-        input dataframe
+        results in the order of files
+    """
+    usecols = None if columns is None else [tpmres_names.get(col, col) for col in columns]
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            res = list(executor.map(lambda x: read_tpmres_file(x[0], usecols), files))
+    else:
+        res = list(executor.map(lambda x: read_tpmres_file(x[0], usecols), files))
+
+    # Fill one preallocated array per column
+    N = [len(next(iter(r.values()))) for r in res]
+    if usecols is None:
+        usecols = list(res[0])
+    dtype = np.float32 if compact else np.float64
+    out = {col: np.empty(sum(N), dtype=dtype) for col in usecols}
+    out["TI"] = np.empty(sum(N), dtype=np.int32)
+    out["objid"] = np.empty(sum(N), dtype=np.int32)
+    i0 = 0
+    for (_, TI_fi, objid_fi), r, n in zip(files, res, N):
+        for col in usecols:
+            out[col][i0:i0+n] = r[col]
+        out["TI"][i0:i0+n] = TI_fi
+        out["objid"][i0:i0+n] = objid_fi
+        i0 += n
+    return tpmres_frame(out, compact)
+
+
+def tpmres_frame(out, compact=False):
+    """
+    Make a table of results with names used in analysis.
+
+    Parameters
+    ----------
+    out : dict
+        column name in the header -> numpy.ndarray (with TI and objid)
+    compact : bool
+        if True, float columns are float32 and TI is categorical
 
     Return
     ------
     df : pandas.DataFrame
-        output dataframe
-    """
-    S = np.array([df['X'].values, df['Y'].values, df['Z'].values]).T
-    normaS = np.sqrt(np.sum(S**2, axis=1))
-    O = np.array([df['MirX'].values, df['MirY'].values, df['MirZ'].values]).T
-    normaO = np.sqrt(np.sum(O**2, axis=1))
-    SO = S*O
-    pha = np.arccos(np.sum(SO, axis=1)/normaO/normaS)*180/np.pi
-   
-    df["r"] = normaS
-    df["delta"] = normaO
-    df["alpha"] = pha
+        results
+    """
+    names = {v: k for k, v in tpmres_names.items()}
+    df = pd.DataFrame({names.get(col, col): arr for col, arr in out.items()}, copy=False)
+    if compact:
+        for col in df.columns:
+            if df[col].dtype == np.float64:
+                df[col] = df[col].astype(np.float32)
+        # Categories are the TI of the paper, so that tables of campaigns can be concatenated
+        df["TI"] = pd.Categorical(
+            df["TI"], categories=sorted(set(Gamma_values) | set(np.unique(df["TI"]).tolist())))
     return df
+
+
+def flux_column(w):
+    """
+    Name of the flux column of a wavelength in micron (e.g., flux8).
+    """
+    return f"flux{w:g}"
+
+
+# Obs and eph files ========================================================
+# Wavelengths in obs files in micron (dummy fluxes)
+obs_wavelengths = list(range(5, 21))
+
+
+def format_eph(pos, t0, t1):
+    """
+    Make the contents of an eph file.
+
+    Parameters
+    ----------
+    pos : array-like
+        position of the asteroid in au
+    t0, t1 : float
+        epochs (a margin is added before and after t0)
+
+    Return
+    ------
+    text : str
+        contents of the file
+    """
+    x, y, z = pos
+    return f"0 {x} {y} {z}\n{t0} {x} {y} {z}\n{t1} {x} {y} {z}\n"
+
+
+def format_obs(pos, mir, t0, wavelengths=obs_wavelengths):
+    """
+    Make the contents of an obs file with dummy fluxes.
+
+    Parameters
+    ----------
+    pos, mir : array-like
+        positions of the asteroid and the observer in au
+    t0 : float
+        epoch of the observation
+    wavelengths : array-like
+        wavelengths in micron (fluxes are calculated only in these bands)
+
+    Return
+    ------
+    text : str
+        contents of the file
+    """
+    Nobs = 1
+    lines = [
+        f"{Nobs}", "", f"{t0} {len(wavelengths)}",
+        " ".join(f"{x}" for x in pos), " ".join(f"{x}" for x in mir)]
+    # Dummy fluxes
+    lines += [f"{w:g} 1 1" for w in wavelengths]
+    return "\n".join(lines) + "\n"
+
+
+def write_obseph_manifest(path, campaigns, t0, t1, wavelengths=obs_wavelengths):
+    """
+    Save obs and eph of all objects in a single file.
+
+    Parameters
+    ----------
+    path : str
+        output file
+    campaigns : list of tuple
+        (campaign name, object ids, positions of asteroids, positions of
+        the observer) with (N, 3) positions in au
+    t0, t1 : float
+        epochs in eph and obs files
+    wavelengths : array-like
+        wavelengths in micron
+    """
+    with open(path, "w") as f:
+        f.write(f"# t0 {t0}\n# t1 {t1}\n")
+        f.write(f"# wavelengths {' '.join(f'{w:g}' for w in wavelengths)}\n")
+        f.write("objid campaign x1 y1 z1 x2 y2 z2\n")
+        for campaign, objid, pos, mir in campaigns:
+            f.write("".join(
+                f"{i} {campaign} {p[0]} {p[1]} {p[2]} {m[0]} {m[1]} {m[2]}\n"
+                for i, p, m in zip(np.asarray(objid).tolist(), pos.tolist(), mir.tolist())))
+
+
+def read_obseph_manifest(path, campaign=None):
+    """
+    Read a manifest made with write_obseph_manifest.
+
+    Parameters
+    ----------
+    path : str
+        manifest
+    campaign : str, optional
+        campaign to be read (e.g., original; all by default)
+
+    Return
+    ------
+    df : pandas.DataFrame
+        objid, campaign, and positions (x1, y1, z1, x2, y2, z2) in au
+    meta : dict
+        t0, t1, and wavelengths
+    """
+    meta = {}
+    with open(path) as f:
+        for line in f:
+            if not line.startswith("#"):
+                break
+            key, _, value = line[1:].strip().partition(" ")
+            meta[key] = [float(x) for x in value.split()]
+    meta["t0"], meta["t1"] = meta["t0"][0], meta["t1"][0]
+    df = pd.read_csv(
+        path, sep=" ", comment="#", dtype={"campaign": str}, float_precision="round_trip")
+    if campaign is not None:
+        df = df[df["campaign"] == campaign].reset_index(drop=True)
+    return df, meta
+
+
+# Obs files already parsed: (path, mtime, size) -> (t0, positions, wavelengths)
+_obs_files = {}
+# Manifests already read: (path, campaign, mtime, size) -> structured array
+_obs_tables = {}
+
+obs_dtype = (
+    [("objid", "<i4"), ("t0", "<f8")]
+    + [(col, "<f8") for col in position_columns] + [("Ndata", "<i4")])
+
+
+def parse_obs_file(obs):
+    """
+    Parse an obs file (once per process unless the file is modified).
+
+    Parameter
+    ---------
+    obs : str
+        obs file made with make_NEOMIR_obseph.py
+
+    Return
+    ------
+    t0 : float
+        epoch of the observation
+    pos : list of float
+        x1, y1, z1 (asteroid) and x2, y2, z2 (observer) in au
+    wavelengths : list of float
+        wavelengths in micron in the order of the file
+    """
+    st = os.stat(obs)
+    key = (os.path.abspath(obs), st.st_mtime_ns, st.st_size)
+    if key not in _obs_files:
+        with open(obs) as f:
+            lines = f.read().split("\n")
+        t0, Ndata = lines[2].split()
+        pos = [float(x) for x in lines[3].split()] + [float(x) for x in lines[4].split()]
+        wavelengths = [float(line.split()[0]) for line in lines[5:5+int(Ndata)]]
+        _obs_files[key] = (float(t0), pos, wavelengths)
+    return _obs_files[key]
+
+
+def read_obs_geometry(obs):
+    """
+    Read locations of an asteroid in an obs file.
+
+    Parameter
+    ---------
+    obs : str
+        obs file made with make_NEOMIR_obseph.py
+
+    Return
+    ------
+    geom : tuple of float
+        x1, y1, z1 (asteroid) and x2, y2, z2 (observer) in au
+    """
+    return tuple(parse_obs_file(obs)[1])
+
+
+def read_obs_wavelengths(obs):
+    """
+    Read wavelengths requested in an obs file.
+
+    Parameter
+    ---------
+    obs : str
+        obs file made with make_NEOMIR_obseph.py
+
+    Return
+    ------
+    wavelengths : list of float
+        wavelengths in micron in the order of the file
+    """
+    return list(parse_obs_file(obs)[2])
+
+
+def parse_objid(filename):
+    """
+    Extract the object id from obs_141.txt or eph_141.txt (None if not found).
+    """
+    m = re.search(r"(\d+)$", os.path.splitext(os.path.basename(filename))[0])
+    return int(m.group(1)) if m else None
+
+
+def list_obseph(obsdir):
+    """
+    List obs (or eph) files in a directory sorted by object id.
+
+    Return
+    ------
+    files : list of tuple
+        (filename, objid)
+    """
+    files = [f.path for f in os.scandir(obsdir) if f.is_file()]
+    objid = [parse_objid(f) for f in files]
+    if None in objid:
+        # Names without ids: sorted by name
+        return [(f, n + 1) for n, f in enumerate(sorted(files))]
+    return sorted(zip(files, objid), key=lambda x: x[1])
+
+
+def read_obs_table(source, campaign=None):
+    """
+    Read obs files of all objects in one pass.
+
+    Parameters
+    ----------
+    source : str or list of str
+        directory with obs files, a manifest (see write_obseph_manifest),
+        or a list of obs files (kept in the given order)
+    campaign : str, optional
+        campaign in the manifest (e.g., original or control)
+
+    Return
+    ------
+    table : numpy.ndarray
+        structured array with objid, t0, X, Y, Z, MirX, MirY, MirZ, and
+        Ndata, sorted by objid for a directory (read-only; files and
+        manifests are parsed once per process unless they are modified)
+    """
+    if isinstance(source, (list, tuple)):
+        files = [(f, parse_objid(f)) for f in source]
+        files = [(f, n + 1 if i is None else i) for n, (f, i) in enumerate(files)]
+    elif os.path.isdir(source):
+        files = list_obseph(source)
+    else:
+        st = os.stat(source)
+        key = (os.path.abspath(source), campaign, st.st_mtime_ns, st.st_size)
+        if key not in _obs_tables:
+            df, meta = read_obseph_manifest(source, campaign)
+            table = np.empty(len(df), dtype=obs_dtype)
+            table["objid"] = df["objid"].values
+            table["t0"] = meta["t0"]
+            for col in position_columns:
+                table[col] = df[tpmres_names[col]].values
+            table["Ndata"] = len(meta["wavelengths"])
+            table.flags.writeable = False
+            _obs_tables[key] = table
+        return _obs_tables[key]
+
+    rows = []
+    for f, objid in files:
+        t0, pos, wavelengths = parse_obs_file(f)
+        rows.append((objid, t0, *pos, len(wavelengths)))
+    table = np.array(rows, dtype=obs_dtype)
+    table.flags.writeable = False
+    return table
+
+
+def read_eph_table(ephdir):
+    """
+    Read eph files of all objects in one pass.
+
+    Parameter
+    ---------
+    ephdir : str
+        directory with eph files
+
+    Return
+    ------
+    table : numpy.ndarray
+        structured array with objid, the first and last epochs (jd0, jd1),
+        and positions at the first epoch (X, Y, Z), sorted by objid
+    """
+    rows = []
+    for f, objid in list_obseph(ephdir):
+        with open(f) as fi:
+            lines = fi.read().split()
+        arr = np.array(lines, dtype=float).reshape(-1, 4)
+        rows.append((objid, arr[0, 0], arr[-1, 0], *arr[0, 1:]))
+    return np.array(rows, dtype=[
+        ("objid", "<i4"), ("jd0", "<f8"), ("jd1", "<f8"),
+        ("X", "<f8"), ("Y", "<f8"), ("Z", "<f8")])
+# Obs and eph files ========================================================
+
+
+def load_geometry(resdir, objid=None):
+    """
+    Load geometry of objects in resdir once per object.
+
+    Positions are read from the first row of each object, and the
+    geometry is cached by resdir and objid.
+
+    Parameters
+    ----------
+    resdir : str
+        directory with TI*_res_*.txt or a columnar store
+    objid : array-like, optional
+        object ids (all objects by default)
+
+    Return
+    ------
+    geom : pandas.DataFrame
+        positions, r, delta, and alpha indexed by objid
+    """
+    campaign = os.path.abspath(resdir)
+    if objid is None:
+        objid = list_objid(resdir)
+    objid = [int(x) for x in objid]
+    geom = cached_geometry(campaign, objid)
+    if geom is not None:
+        return geom
+
+    usecols = [tpmres_names[col] for col in position_columns]
+    if is_tpmstore(resdir):
+        data = load_tpmstore(resdir, ["objid"] + usecols)
+        ids, first = np.unique(data["objid"], return_index=True)
+        mask = np.isin(ids, objid)
+        ids, first = ids[mask], first[mask]
+        pos = np.array([data[col][first] for col in usecols]).T
+    else:
+        # The first file of each object
+        files = {}
+        for path, _, objid_fi in list_tpmres(resdir, objid=objid):
+            files.setdefault(objid_fi, path)
+        ids = sorted(files)
+        pos = []
+        for i in ids:
+            with open(files[i]) as f:
+                header = f.readline().split()
+                row = f.readline().split()
+            pos.append([float(row[header.index(col)]) for col in usecols])
+    object_geometry(ids, pos, campaign)
+
+    geom = cached_geometry(campaign, objid)
+    if geom is None:
+        missing = sorted(set(objid) - set(int(i) for i in ids))
+        raise FileNotFoundError(f"No results of objects {missing} in {resdir}")
+    return geom
+
+
+# Columnar store of TPM results =============================================
+# A store is a directory with one raw binary file per column
+# (e.g., flux8.bin) and meta.json with the number of rows and dtypes.
+# Each column is memory-mapped when loaded.
+tpmstore_meta = "meta.json"
+tpmstore_dtypes = {"objid": "<i4", "TI": "<i4", "idx": "<i4"}
+
+
+def is_tpmstore(path):
+    """
+    Check if path is a columnar store of TPM results.
+    """
+    return os.path.isfile(os.path.join(path, tpmstore_meta))
+
+
+class TPMStoreWriter:
+    """
+    Append TPM results to a columnar store.
+
+    Rows of a result file are contiguous, and the rows of each (objid, TI)
+    are located when an existing store is opened, so that a file is not
+    appended twice (see add_file).
+
+    Parameters
+    ----------
+    path : str
+        directory of the store
+    """
+    def __init__(self, path):
+        self.path = path
+        self.ranges = {}
+        os.makedirs(path, exist_ok=True)
+        if is_tpmstore(path):
+            with open(os.path.join(path, tpmstore_meta)) as f:
+                meta = json.load(f)
+            self.nrows = meta["nrows"]
+            self.columns = meta["columns"]
+            # Remove rows written after the last update of meta.json
+            for col, dtype in self.columns.items():
+                with open(self._colpath(col), "ab") as f:
+                    f.truncate(self.nrows*np.dtype(dtype).itemsize)
+            if self.nrows and ("objid" in self.columns) and ("TI" in self.columns):
+                data = load_tpmstore(path, ["objid", "TI"])
+                objid, TI = np.asarray(data["objid"]), np.asarray(data["TI"])
+                start = np.flatnonzero(np.r_[True, (np.diff(objid) != 0) | (np.diff(TI) != 0)])
+                stop = np.r_[start[1:], self.nrows]
+                for i0, i1 in zip(start.tolist(), stop.tolist()):
+                    self.ranges.setdefault((int(objid[i0]), int(TI[i0])), (i0, i1))
+        else:
+            self.nrows = 0
+            self.columns = None
+
+    def _colpath(self, col):
+        return os.path.join(self.path, f"{col}.bin")
+
+    def append(self, data):
+        """
+        Append rows.
+
+        Parameters
+        ----------
+        data : dict
+            column name -> array-like (all the same length)
+        """
+        n = len(next(iter(data.values())))
+        if self.columns is None:
+            self.columns = {
+                col: tpmstore_dtypes.get(col, "<f8") for col in data}
+        if set(data) != set(self.columns):
+            raise ValueError(
+                f"Columns do not match the store: {sorted(data)} vs. {sorted(self.columns)}")
+        for col, dtype in self.columns.items():
+            arr = np.ascontiguousarray(data[col], dtype=dtype)
+            if len(arr) != n:
+                raise ValueError(f"Length of {col} is {len(arr)}, not {n}")
+            with open(self._colpath(col), "ab") as f:
+                f.write(arr.tobytes())
+        self.nrows += n
+        if ("objid" in data) and ("TI" in data):
+            objid, TI = np.asarray(data["objid"]), np.asarray(data["TI"])
+            for key in set(zip(objid.tolist(), TI.tolist())):
+                self.ranges.setdefault(key, (self.nrows - n, self.nrows))
+        # Update meta.json atomically after all columns are written
+        tmp = os.path.join(self.path, f"{tpmstore_meta}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(dict(nrows=self.nrows, columns=self.columns), f)
+        os.replace(tmp, os.path.join(self.path, tpmstore_meta))
+
+    def add_file(self, objid, TI, data):
+        """
+        Append the results of an object and TI unless they are in the store.
+
+        Parameters
+        ----------
+        objid : int
+            object id
+        TI : int
+            thermal inertia
+        data : dict
+            column name -> array-like (without objid and TI)
+
+        Return
+        ------
+        added : bool
+            False if the same results are already in the store (e.g., with --resume)
+        """
+        n = len(next(iter(data.values())))
+        key = (int(objid), int(TI))
+        if key in self.ranges:
+            i0, i1 = self.ranges[key]
+            old = load_tpmstore(self.path, list(data))
+            same = (i1 - i0 == n) and all(
+                np.array_equal(np.asarray(old[col][i0:i1]), np.asarray(data[col], dtype=old[col].dtype))
+                for col in data)
+            if not same:
+                raise ValueError(
+                    f"Store {self.path} has other results of objid={objid}, TI={TI}. "
+                    "Use a new store.")
+            return False
+        data = dict(data, objid=np.full(n, key[0]), TI=np.full(n, key[1]))
+        self.append(data)
+        return True
+
+
+def load_tpmstore(path, columns=None):
+    """
+    Memory-map columns of a store of TPM results.
+
+    Parameters
+    ----------
+    path : str
+        directory of the store
+    columns : array-like, optional
+        columns to be loaded (all columns by default)
+
+    Return
+    ------
+    data : dict
+        column name -> read-only numpy.memmap
+    """
+    with open(os.path.join(path, tpmstore_meta)) as f:
+        meta = json.load(f)
+    nrows = meta["nrows"]
+    if columns is None:
+        columns = list(meta["columns"])
+    data = {}
+    for col in columns:
+        dtype = meta["columns"][col]
+        if nrows == 0:
+            data[col] = np.empty(0, dtype=dtype)
+        else:
+            data[col] = np.memmap(
+                os.path.join(path, f"{col}.bin"), dtype=dtype, mode="r", shape=(nrows,))
+    return data
+
+
+def parse_tpmres_filename(filename):
+    """
+    Extract TI and object id from TI300_res_141.txt.
+    """
+    name = os.path.basename(filename)
+    TI, _, objid = os.path.splitext(name)[0].split("_")
+    return int(TI[2:]), int(objid)
+
+
+def convert_tpmres(resdir, store):
+    """
+    Convert text results in resdir to a columnar store.
+
+    Parameters
+    ----------
+    resdir : str
+        directory with TI*_res_*.txt
+    store : str
+        directory of the output store (must not exist)
+
+    Return
+    ------
+    nrows : int
+        number of rows in the store
+    """
+    if is_tpmstore(store):
+        raise FileExistsError(f"Store already exists: {store}")
+    writer = TPMStoreWriter(store)
+    for filename, TI, objid in list_tpmres(resdir):
+        data = read_tpmres_file(filename)
+        n = len(data["idx"])
+        data["objid"] = np.full(n, objid)
+        data["TI"] = np.full(n, TI)
+        writer.append(data)
+    return writer.nrows
+# Columnar store of TPM results =============================================
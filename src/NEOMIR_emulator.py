@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fast emulator of TPM fluxes trained on outputs of runtpm_NEOMIR.py.
+
+For each Gamma, log10(flux x delta^2) of all bands is fitted with a
+polynomial of the geometry and the pole:
+    log10(r), cos(alpha),
+    s.u_S, s.u_O, and s.n,
+where s is the pole, u_S and u_O are the directions of the Sun and the
+observer, and n = u_S x u_O/|u_S x u_O|.
+Fluxes between two trained Gamma values are interpolated linearly in Gamma.
+
+Train and check the error with held-out objects:
+    python src/NEOMIR_emulator.py --resdir data/tpmout_original data/tpmout_control --out emulator.npz
+"""
+from argparse import ArgumentParser as ap
+import itertools
+import time
+import numpy as np
+import pandas as pd
+
+from NEOMIR_common import load_tpmres
+from NEOMIR_poles import lonlat2xyz
+
+
+feature_names = ["logr", "cosalpha", "sS", "sO", "sn"]
+
+
+def emulator_features(lam, beta, S, O):
+    """
+    Calculate features of the emulator.
+
+    Parameters
+    ----------
+    lam, beta : array-like
+        ecliptic longitude and latitude of poles in degree
+    S, O : array-like
+        (N, 3) positions of the asteroid (x1, y1, z1) and the observer
+        (x2, y2, z2) in au, as in the obs file
+
+    Return
+    ------
+    feat : numpy.ndarray
+        (N, 5) features
+    delta : numpy.ndarray
+        observer-centric distance in au
+    """
+    s = lonlat2xyz(lam, beta)
+    S, O = np.atleast_2d(S), np.atleast_2d(O)
+    r = np.linalg.norm(S, axis=1)
+    delta = np.linalg.norm(O, axis=1)
+    uS, uO = S/r[:, None], O/delta[:, None]
+    cosalpha = np.clip(np.sum(uS*uO, axis=1), -1, 1)
+    n = np.cross(uS, uO)
+    n = n/np.linalg.norm(n, axis=1)[:, None]
+    feat = np.array([
+        np.log10(r), cosalpha,
+        np.sum(s*uS, axis=1), np.sum(s*uO, axis=1), np.sum(s*n, axis=1)]).T
+    return feat, delta
+
+
+def polynomial_powers(N_feat, degree):
+    """
+    Exponents of all monomials up to degree (N_term, N_feat).
+    """
+    powers = []
+    for d in range(degree + 1):
+        for comb in itertools.combinations_with_replacement(range(N_feat), d):
+            p = np.zeros(N_feat, dtype=int)
+            for c in comb:
+                p[c] += 1
+            powers.append(p)
+    return np.array(powers)
+
+
+class FluxEmulator:
+    """
+    Polynomial emulator of TPM fluxes.
+
+    Parameters
+    ----------
+    Gammas : array-like
+        trained thermal inertia (sorted)
+    bands : array-like
+        names of flux columns (e.g., flux5)
+    coef : numpy.ndarray
+        (N_Gamma, N_term, N_band) coefficients
+    mu, sd : numpy.ndarray
+        mean and standard deviation of features
+    powers : numpy.ndarray
+        (N_term, N_feat) exponents of monomials
+    """
+    def __init__(self, Gammas, bands, coef, mu, sd, powers):
+        self.Gammas = np.asarray(Gammas)
+        self.bands = list(bands)
+        self.coef = np.asarray(coef)
+        self.mu, self.sd = np.asarray(mu), np.asarray(sd)
+        self.powers = np.asarray(powers)
+
+    def _design(self, feat):
+        x = np.ascontiguousarray(((feat - self.mu)/self.sd).T)
+        # Each monomial = (monomial of degree - 1) x (a feature)
+        A = np.empty((len(self.powers), x.shape[1]))
+        index = {}
+        for idx_t, p in enumerate(self.powers):
+            index[tuple(p)] = idx_t
+            if p.sum() == 0:
+                A[idx_t] = 1
+                continue
+            idx_f = np.nonzero(p)[0][-1]
+            q = p.copy()
+            q[idx_f] -= 1
+            np.multiply(A[index[tuple(q)]], x[idx_f], out=A[idx_t])
+        return A.T
+
+    @classmethod
+    def fit(cls, df, degree=4):
+        """
+        Fit the emulator to TPM results.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            output of load_tpmres (lon, lat, X, ..., MirZ, flux*, TI)
+        degree : int
+            degree of the polynomial
+
+        Return
+        ------
+        emu : FluxEmulator
+            fitted emulator
+        """
+        bands = [col for col in df.columns if col.startswith("flux")]
+        feat, delta = emulator_features(
+            df["lon"].values, df["lat"].values,
+            df[["X", "Y", "Z"]].values, df[["MirX", "MirY", "MirZ"]].values)
+        y = np.log10(df[bands].values*delta[:, None]**2)
+        mu, sd = feat.mean(axis=0), feat.std(axis=0)
+        # Constant features (e.g., a single object)
+        sd[sd == 0] = 1
+        powers = polynomial_powers(feat.shape[1], degree)
+        emu = cls([], bands, [], mu, sd, powers)
+
+        Gammas = np.sort(df["TI"].unique())
+        coef = []
+        for Gamma in Gammas:
+            mask = (df["TI"] == Gamma).values
+            A = emu._design(feat[mask])
+            coef.append(np.linalg.lstsq(A, y[mask], rcond=None)[0])
+        emu.Gammas, emu.coef = Gammas, np.array(coef)
+        return emu
+
+    def predict_features(self, feat, Gamma, chunk=8192):
+        """
+        Predict log10(flux x delta^2) from features.
+
+        Parameters
+        ----------
+        feat : numpy.ndarray
+            (N, 5) features (see emulator_features)
+        Gamma : float or array-like
+            thermal inertia (within the trained range)
+        chunk : int
+            number of rows evaluated at once
+
+        Return
+        ------
+        y : numpy.ndarray
+            (N, N_band) log10(flux x delta^2)
+        """
+        N = len(feat)
+        Gamma = np.broadcast_to(np.asarray(Gamma, dtype=float), (N,))
+        if (Gamma.min() < self.Gammas[0]) or (Gamma.max() > self.Gammas[-1]):
+            raise ValueError(
+                f"Gamma must be in {self.Gammas[0]}--{self.Gammas[-1]}")
+        # Bracketing trained Gamma values and weights
+        i1 = np.clip(np.searchsorted(self.Gammas, Gamma), 1, max(len(self.Gammas) - 1, 1))
+        i0 = i1 - 1
+        if len(self.Gammas) == 1:
+            i0 = i1 = np.zeros(N, dtype=int)
+            w = np.zeros(N)
+        else:
+            w = (Gamma - self.Gammas[i0])/(self.Gammas[i1] - self.Gammas[i0])
+
+        # Rows are sorted by the bracketing Gamma values, so that each block of
+        # rows is multiplied only by the coefficients of its two Gamma values
+        N_band = len(self.bands)
+        order = np.argsort(i0, kind="stable")
+        feat, i0, i1, w = feat[order], i0[order], i1[order], w[order]
+        # (N_term, 2 x N_band) of each bracket
+        coef = {
+            k: np.concatenate([self.coef[k], self.coef[i1[n]]], axis=1)
+            for k, n in zip(*np.unique(i0, return_index=True))}
+        y = np.empty((N, N_band))
+        for s0 in range(0, N, chunk):
+            s1 = min(s0 + chunk, N)
+            A = self._design(feat[s0:s1])
+            # Blocks of rows with the same bracket
+            bounds = np.flatnonzero(np.diff(i0[s0:s1])) + 1
+            for b0, b1 in zip(np.r_[0, bounds], np.r_[bounds, s1 - s0]):
+                y_pair = A[b0:b1] @ coef[i0[s0 + b0]]
+                wb = w[s0 + b0:s0 + b1, None]
+                y[s0 + b0:s0 + b1] = (1 - wb)*y_pair[:, :N_band] + wb*y_pair[:, N_band:]
+        out = np.empty_like(y)
+        out[order] = y
+        return out
+
+    def predict(self, lam, beta, S, O, Gamma):
+        """
+        Predict fluxes of all bands.
+
+        Parameters
+        ----------
+        lam, beta : array-like
+            ecliptic longitude and latitude of poles in degree
+        S, O : array-like
+            (N, 3) positions of the asteroid and the observer in au
+        Gamma : float or array-like
+            thermal inertia
+
+        Return
+        ------
+        flux : numpy.ndarray
+            (N, N_band) fluxes in the unit of training data
+        """
+        feat, delta = emulator_features(lam, beta, S, O)
+        return 10**self.predict_features(feat, Gamma)/delta[:, None]**2
+
+    def save(self, path):
+        np.savez(
+            path, Gammas=self.Gammas, bands=np.array(self.bands), coef=self.coef,
+            mu=self.mu, sd=self.sd, powers=self.powers)
+
+    @classmethod
+    def load(cls, path):
+        d = np.load(path)
+        return cls(d["Gammas"], d["bands"], d["coef"], d["mu"], d["sd"], d["powers"])
+
+
+def evaluate_emulator(emu, df):
+    """
+    Relative errors of the emulator against TPM results.
+
+    Parameters
+    ----------
+    emu : FluxEmulator
+        emulator
+    df : pandas.DataFrame
+        output of load_tpmres not used in the training
+
+    Return
+    ------
+    err : pandas.DataFrame
+        median and 95th percentile of |relative error| per band and Gamma
+    """
+    flux = emu.predict(
+        df["lon"].values, df["lat"].values,
+        df[["X", "Y", "Z"]].values, df[["MirX", "MirY", "MirZ"]].values, df["TI"].values)
+    relerr = np.abs(flux/df[emu.bands].values - 1)
+    res = []
+    for Gamma in emu.Gammas:
+        mask = (df["TI"] == Gamma).values
+        for idx_b, band in enumerate(emu.bands):
+            res.append(dict(
+                TI=Gamma, band=band,
+                median=np.median(relerr[mask, idx_b]),
+                p95=np.percentile(relerr[mask, idx_b], 95)))
+    return pd.DataFrame(res)
+
+
+if __name__ == "__main__":
+    parser = ap(description="Train an emulator of TPM fluxes.")
+    parser.add_argument(
+        "--resdir", type=str, nargs="*", default=["tpmresult"],
+        help="Directories with output files (or stores)")
+    parser.add_argument(
+        "--degree", type=int, default=4,
+        help="Degree of the polynomial")
+    parser.add_argument(
+        "--holdout", type=float, default=0.2,
+        help="Fraction of objects used to check the error")
+    parser.add_argument(
+        "--out", type=str, default="emulator.npz",
+        help="Output file of the emulator")
+    args = parser.parse_args()
+
+    df_list = []
+    for idx_dir, resdir in enumerate(args.resdir):
+        df = load_tpmres(resdir)
+        # Object ids must be unique among directories
+        df["objid"] = df["objid"] + idx_dir*100000
+        df_list.append(df)
+    df = pd.concat(df_list, ignore_index=True)
+
+    # Split objects into training and held-out ones
+    rng = np.random.default_rng(0)
+    objid = np.unique(df["objid"])
+    N_hold = int(len(objid)*args.holdout)
+    objid_hold = rng.choice(objid, N_hold, replace=False)
+    mask_hold = df["objid"].isin(objid_hold).values
+
+    t0 = time.time()
+    emu = FluxEmulator.fit(df[~mask_hold], degree=args.degree)
+    print(f"Trained with {np.sum(~mask_hold)} runs of {len(objid) - N_hold} objects ({time.time() - t0:.1f} s)")
+
+    if N_hold:
+        err = evaluate_emulator(emu, df[mask_hold])
+        print(f"Relative errors for {np.sum(mask_hold)} held-out runs of {N_hold} objects")
+        # All trained bands (rows) and Gamma values (columns)
+        for stat, name in [("median", "Median"), ("p95", "95th percentile")]:
+            table = err.pivot(index="band", columns="TI", values=stat).reindex(emu.bands)
+            print(f"{name} of |relative error|:")
+            print(table.to_string(float_format=lambda x: f"{x:.3f}"))
+        print(f"All bands: median={np.median(err['median']):.3f}, worst p95={np.max(err['p95']):.3f}")
+
+    # Throughput
+    N_query = 1000000
+    idx = rng.integers(0, len(df), N_query)
+    feat, _ = emulator_features(
+        df["lon"].values[idx], df["lat"].values[idx],
+        df[["X", "Y", "Z"]].values[idx], df[["MirX", "MirY", "MirZ"]].values[idx])
+    t0 = time.time()
+    emu.predict_features(feat, rng.uniform(emu.Gammas[0], emu.Gammas[-1], N_query))
+    print(f"Prediction: {N_query/(time.time() - t0):.3g} queries/s ({len(emu.bands)} bands)")
+
+    emu.save(args.out)
+    print(f"Saved {args.out}")
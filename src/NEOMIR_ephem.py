@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local cache of ephemerides (heliocentric vectors) for figures.
+
+Vectors are cached in a directory, one file per query keyed by target,
+location, epochs, and step, so that figures can be made without network.
+The cache can be seeded on a machine with network access,
+    python src/NEOMIR_ephem.py fetch --target 399 --location 500@10 --start 2024-08-14 --stop 2025-08-15 --step 1d
+or from a file with jd, x, y, and z columns (e.g., exported from JPL Horizons),
+    python src/NEOMIR_ephem.py import earth.txt --target 399 --location 500@10 --start 2024-08-14 --stop 2025-08-15 --step 1d
+Without the cache, the orbit of the Earth is calculated from Keplerian
+elements (Standish 1992), which is enough for plotting.
+"""
+from argparse import ArgumentParser as ap
+import os
+import re
+import numpy as np
+import pandas as pd
+from astropy.time import Time
+
+from NEOMIR_cache import make_key
+
+
+ephem_sources = ["auto", "cache", "horizons", "analytic"]
+
+# Keplerian elements of the Earth-Moon barycenter at J2000 and their rates
+# per century (ecliptic and equinox of J2000, Standish 1992)
+# a [au], e, I [deg], L [deg], varpi [deg], Omega [deg]
+elements_EMB = dict(
+    a=(1.00000261, 0.00000562), e=(0.01671123, -0.00004392),
+    I=(-0.00001531, -0.01294668), L=(100.46457166, 35999.37244981),
+    varpi=(102.93768193, 0.32327364), Omega=(0.0, 0.0))
+
+
+def parse_step(step):
+    """
+    Convert a step of Horizons (e.g., 1d, 6h, 30m) to days.
+    """
+    m = re.fullmatch(r"(\d*\.?\d+)\s*([dhm])", step)
+    if m is None:
+        raise ValueError(f"Unknown step: {step} (e.g., 1d, 6h, 30m)")
+    return float(m.group(1))/{"d": 1, "h": 24, "m": 1440}[m.group(2)]
+
+
+def ephem_epochs(start, stop, step):
+    """
+    Julian dates from start to stop (inclusive) with step.
+    """
+    jd0, jd1 = Time(start).jd, Time(stop).jd
+    dt = parse_step(step)
+    N = int(np.floor((jd1 - jd0)/dt + 1e-9)) + 1
+    return jd0 + dt*np.arange(N)
+
+
+def ephem_key(target, location, start, stop, step):
+    """
+    Key of a query in the cache.
+    """
+    return make_key(
+        target=str(target), location=str(location), start=str(start),
+        stop=str(stop), step=str(step))
+
+
+class EphemCache:
+    """
+    Cache of heliocentric vectors.
+
+    Parameters
+    ----------
+    cachedir : str
+        directory of the cache
+    """
+    def __init__(self, cachedir="ephemcache"):
+        self.dir = cachedir
+
+    def path(self, target, location, start, stop, step):
+        return os.path.join(
+            self.dir, f"{ephem_key(target, location, start, stop, step)}.txt")
+
+    def get(self, target, location, start, stop, step):
+        """
+        Return cached vectors (None if not cached).
+        """
+        path = self.path(target, location, start, stop, step)
+        if not os.path.isfile(path):
+            return None
+        return pd.read_csv(path, sep=r"\s+", comment="#")
+
+    def put(self, df, target, location, start, stop, step):
+        """
+        Save vectors (jd, x, y, z in au).
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        path = self.path(target, location, start, stop, step)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(f"# target={target} location={location} start={start} stop={stop} step={step}\n")
+            df[["jd", "x", "y", "z"]].to_csv(f, sep=" ", index=False)
+        os.replace(f"{path}.tmp", path)
+        return path
+
+
+def query_horizons(target, location, start, stop, step):
+    """
+    Query heliocentric vectors to JPL Horizons (needs network).
+
+    Return
+    ------
+    df : pandas.DataFrame
+        jd, x, y, and z in au
+    """
+    # Not needed offline
+    from astroquery.jplhorizons import Horizons
+    vec = Horizons(
+        location=location, id=target,
+        epochs={'start': start, 'stop': stop, 'step': step}).vectors()
+    return pd.DataFrame(dict(
+        jd=np.array(vec["datetime_jd"]), x=np.array(vec["x"]),
+        y=np.array(vec["y"]), z=np.array(vec["z"])))
+
+
+def earth_kepler(jd):
+    """
+    Heliocentric ecliptic position of the Earth(-Moon barycenter) in au.
+
+    Parameter
+    ---------
+    jd : array-like
+        Julian dates (TDB)
+
+    Return
+    ------
+    df : pandas.DataFrame
+        jd, x, y, and z in au
+    """
+    jd = np.atleast_1d(np.asarray(jd, dtype=float))
+    T = (jd - 2451545.0)/36525.
+    el = {k: v0 + v1*T for k, (v0, v1) in elements_EMB.items()}
+    a, e = el["a"], el["e"]
+    I, Omega = np.radians(el["I"]), np.radians(el["Omega"])
+    omega = np.radians(el["varpi"] - el["Omega"])
+    M = np.radians((el["L"] - el["varpi"] + 180) % 360 - 180)
+
+    # Solve Kepler's equation
+    E = M + e*np.sin(M)
+    for _ in range(10):
+        E = E - (E - e*np.sin(E) - M)/(1 - e*np.cos(E))
+    xp, yp = a*(np.cos(E) - e), a*np.sqrt(1 - e**2)*np.sin(E)
+
+    # Orbital plane -> ecliptic
+    co, so = np.cos(omega), np.sin(omega)
+    cO, sO = np.cos(Omega), np.sin(Omega)
+    cI, sI = np.cos(I), np.sin(I)
+    x = (co*cO - so*sO*cI)*xp + (-so*cO - co*sO*cI)*yp
+    y = (co*sO + so*cO*cI)*xp + (-so*sO + co*cO*cI)*yp
+    z = (so*sI)*xp + (co*sI)*yp
+    return pd.DataFrame(dict(jd=jd, x=x, y=y, z=z))
+
+
+def get_vectors(target, location, start, stop, step, cachedir="ephemcache", source="auto"):
+    """
+    Get heliocentric vectors of a target.
+
+    Parameters
+    ----------
+    target : str
+        id of Horizons (e.g., 399 for the Earth)
+    location : str
+        location of Horizons (e.g., 500@10 for the center of the Sun)
+    start, stop : str
+        first and last epochs (e.g., 2024-08-14)
+    step : str
+        step (e.g., 1d)
+    cachedir : str
+        directory of the cache
+    source : str
+        auto (cache, then Keplerian orbit of the Earth; no network),
+        cache, horizons (query and save in the cache), or analytic
+
+    Return
+    ------
+    df : pandas.DataFrame
+        jd, x, y, and z in au
+    """
+    cache = EphemCache(cachedir)
+    analytic_ok = (str(target) == "399") and (str(location) == "500@10")
+    if source in ("auto", "cache"):
+        df = cache.get(target, location, start, stop, step)
+        if df is not None:
+            return df
+        if source == "cache":
+            raise FileNotFoundError(
+                f"No ephemeris of {target} at {location} ({start}--{stop}, {step}) in {cachedir}")
+        if not analytic_ok:
+            raise FileNotFoundError(
+                f"No ephemeris of {target} at {location} in {cachedir}; seed the cache with NEOMIR_ephem.py")
+        return earth_kepler(ephem_epochs(start, stop, step))
+    elif source == "horizons":
+        df = query_horizons(target, location, start, stop, step)
+        cache.put(df, target, location, start, stop, step)
+        return df
+    elif source == "analytic":
+        if not analytic_ok:
+            raise ValueError("Analytic orbit is available only for the Earth (399) at 500@10")
+        return earth_kepler(ephem_epochs(start, stop, step))
+    else:
+        raise ValueError(f"Unknown source: {source} ({', '.join(ephem_sources)})")
+
+
+def import_vectors(filename, target, location, start, stop, step, cachedir="ephemcache"):
+    """
+    Save vectors in a file to the cache.
+
+    Parameters
+    ----------
+    filename : str
+        whitespace- or comma-separated file with jd, x, y, and z (in au)
+        (datetime_jd is also accepted as jd)
+    target, location, start, stop, step : str
+        query to which the vectors correspond (see get_vectors)
+    cachedir : str
+        directory of the cache
+
+    Return
+    ------
+    path : str
+        cached file
+    """
+    df = pd.read_csv(filename, sep=None, engine="python", comment="#")
+    df.columns = [col.strip() for col in df.columns]
+    df = df.rename(columns={"datetime_jd": "jd"})
+    missing = [col for col in ["jd", "x", "y", "z"] if col not in df.columns]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in {filename}")
+    return EphemCache(cachedir).put(df, target, location, start, stop, step)
+
+
+if __name__ == "__main__":
+    parser = ap(description="Seed the local cache of ephemerides.")
+    parser.add_argument(
+        "command", type=str, choices=["fetch", "import"],
+        help="fetch (query Horizons) or import (read a file)")
+    parser.add_argument(
+        "filename", type=str, nargs="?", default=None,
+        help="File with jd, x, y, and z (for import)")
+    parser.add_argument(
+        "--target", type=str, default="399",
+        help="Target (id of Horizons)")
+    parser.add_argument(
+        "--location", type=str, default="500@10",
+        help="Location (of Horizons)")
+    parser.add_argument(
+        "--start", type=str, default="2024-08-14",
+        help="First epoch")
+    parser.add_argument(
+        "--stop", type=str, default="2025-08-15",
+        help="Last epoch")
+    parser.add_argument(
+        "--step", type=str, default="1d",
+        help="Step")
+    parser.add_argument(
+        "--cachedir", type=str, default="ephemcache",
+        help="Directory of the cache")
+    args = parser.parse_args()
+
+    query = (args.target, args.location, args.start, args.stop, args.step)
+    if args.command == "fetch":
+        df = get_vectors(*query, cachedir=args.cachedir, source="horizons")
+        path = EphemCache(args.cachedir).path(*query)
+    else:
+        assert args.filename, "Set a file to be imported."
+        path = import_vectors(args.filename, *query, cachedir=args.cachedir)
+    print(f"Saved ephemeris of {args.target} at {args.location} ({args.start}--{args.stop}, {args.step}) in {path}")
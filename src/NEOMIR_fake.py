@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-ins of runtpm and fittm for load tests of the orchestration.
+
+src/fakebin/runtpm and src/fakebin/fittm take the same arguments and
+standard input as the real programs and print "f>" and "o>" records in
+their layouts, so runtpm_NEOMIR.py and calc_D_fittm.py can be run with
+src/fakebin first in PATH. Fluxes and diameters come from a simple
+thermal model (pure Python, so that a call costs only the start-up of
+the interpreter); they are smooth in pole, Gamma, and geometry but are
+not results of TPM or NEATM.
+
+Every call is deterministic: latency and failure are drawn from a random
+generator seeded with the inputs (and NEOMIR_FAKE_SEED). The behavior is
+set with environment variables (NEOMIR_FAKE_{RUNTPM,FITTM}_* override
+NEOMIR_FAKE_* for one of the programs):
+    NEOMIR_FAKE_LATENCY  : median latency in s (per row for fittm)
+    NEOMIR_FAKE_JITTER   : sigma of the log-normal latency
+    NEOMIR_FAKE_BUSY     : 1 to burn CPU instead of sleeping
+    NEOMIR_FAKE_FAILRATE : probability that a call fails (no records, exit 1)
+    NEOMIR_FAKE_LINES    : number of other lines printed (output size)
+    NEOMIR_FAKE_LAYOUT   : layout of f> lines, old or new (new is rejected by
+                           NEOMIR_tpmout.py until it is confirmed)
+    NEOMIR_FAKE_SEED     : seed
+    NEOMIR_FAKE_LOG      : file where a line per call is appended
+                           (program, pid, ppid, start, end, status, N_row)
+"""
+import os
+import sys
+import math
+import time
+import random
+import hashlib
+
+
+fake_defaults = dict(
+    LATENCY=0.0, JITTER=0.0, BUSY=0, FAILRATE=0.0, LINES=0, LAYOUT="old", SEED=0, LOG="")
+fake_log_columns = ["prog", "pid", "ppid", "start", "end", "status", "N_row"]
+
+# Physical constants in SI
+h, c, kB = 6.62607015e-34, 299792458.0, 1.380649e-23
+sigma = 5.670374419e-8
+S_sun = 1361.0
+au_m = 1.495978707e11
+
+
+def fake_param(prog, name):
+    """
+    Return a parameter of a fake program from the environment.
+    """
+    value = os.environ.get(
+        f"NEOMIR_FAKE_{prog.upper()}_{name}", os.environ.get(f"NEOMIR_FAKE_{name}"))
+    default = fake_defaults[name]
+    if value is None:
+        return default
+    return type(default)(value)
+
+
+def fake_env(prog=None, **params):
+    """
+    Make environment variables of fake programs.
+
+    Parameters
+    ----------
+    prog : str, optional
+        runtpm or fittm (the variables are common to both if not given)
+    params : dict
+        parameters (e.g., LATENCY=0.1, FAILRATE=0.01)
+
+    Return
+    ------
+    env : dict
+        names and values of variables
+    """
+    prefix = "NEOMIR_FAKE_" if prog is None else f"NEOMIR_FAKE_{prog.upper()}_"
+    env = {}
+    for name, value in params.items():
+        assert name in fake_defaults, f"Unknown parameter: {name}"
+        env[f"{prefix}{name}"] = f"{value}"
+    return env
+
+
+def fake_rng(prog, *inputs):
+    """
+    Random generator seeded with inputs of a call.
+    """
+    h = hashlib.sha256(f"{prog} {fake_param(prog, 'SEED')}".encode())
+    for x in inputs:
+        h.update(x.encode() if isinstance(x, str) else x)
+    return random.Random(int.from_bytes(h.digest()[:8], "little"))
+
+
+def fake_wait(prog, rng, N_row=1):
+    """
+    Wait for the latency of a call (sleep, or burn CPU with BUSY=1).
+    """
+    latency = fake_param(prog, "LATENCY")*N_row
+    if latency <= 0:
+        return
+    latency *= math.exp(fake_param(prog, "JITTER")*rng.gauss(0, 1))
+    if fake_param(prog, "BUSY"):
+        t_end = time.perf_counter() + latency
+        while time.perf_counter() < t_end:
+            pass
+    else:
+        time.sleep(latency)
+
+
+def fake_log(prog, t_start, status, N_row):
+    """
+    Append a line of a call to NEOMIR_FAKE_LOG (a single write).
+    """
+    path = fake_param(prog, "LOG")
+    if not path:
+        return
+    line = f"{prog} {os.getpid()} {os.getppid()} {t_start:.6f} {time.time():.6f} {status} {N_row}\n"
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def read_fake_log(path):
+    """
+    Read calls in a log of fake programs.
+
+    Return
+    ------
+    calls : list of dict
+        prog, pid, ppid, start, end, status, and N_row of each call
+    """
+    calls = []
+    if not os.path.isfile(path):
+        return calls
+    with open(path) as f:
+        for line in f:
+            values = line.split()
+            if len(values) != len(fake_log_columns):
+                continue
+            call = dict(zip(fake_log_columns, values))
+            for col in ["pid", "ppid", "status", "N_row"]:
+                call[col] = int(call[col])
+            for col in ["start", "end"]:
+                call[col] = float(call[col])
+            calls.append(call)
+    return calls
+
+
+def planck_Jy(w_um, T):
+    """
+    Planck function in Jy/sr.
+    """
+    nu = c/(w_um*1e-6)
+    x = h*nu/(kB*T)
+    if x > 700:
+        return 0.0
+    return 2*h*nu**3/c**2/math.expm1(x)*1e26
+
+
+def fake_flux(D_km, pv, eta, r, delta, alpha, w_um, eps=0.9, G=0.15):
+    """
+    Thermal flux in Jy of a sphere with the disk-averaged temperature.
+    """
+    A = (0.290 + 0.684*G)*pv
+    Tss = ((1 - A)*S_sun/(eta*eps*sigma*r**2))**0.25
+    # Mean of T over the dayside (Tss*cos^(1/4)) and phase darkening
+    T = 0.8*Tss
+    phase = 10**(-0.004*alpha)
+    return eps*math.pi*(D_km*1e3/2)**2/(delta*au_m)**2*planck_Jy(w_um, T)*phase
+
+
+def fake_eta(lam, beta, Gamma, S):
+    """
+    Beaming parameter depending on Gamma and the angle between the pole and the Sun.
+    """
+    l, b = math.radians(lam), math.radians(beta)
+    s = (math.cos(b)*math.cos(l), math.cos(b)*math.sin(l), math.sin(b))
+    r = math.sqrt(sum(x**2 for x in S))
+    cos_pole = -sum(x*y for x, y in zip(s, S))/r
+    return 0.8 + 1.5*Gamma/(Gamma + 250.)*(1 - 0.6*cos_pole**2)
+
+
+def parse_fake_argv(argv, options):
+    """
+    Values of options (e.g., {"-o": None}) in argv (other arguments are ignored).
+    """
+    values = dict(options)
+    for i, arg in enumerate(argv[:-1]):
+        if arg in values:
+            values[arg] = argv[i + 1]
+    return values
+
+
+def print_lines(prog, rng, out):
+    """
+    Print other lines of the output (NEOMIR_FAKE_LINES).
+    """
+    for i in range(fake_param(prog, "LINES")):
+        out.write(f"# {prog} {i:6d} {rng.random():.16e} {rng.random():.16e} {rng.random():.16e}\n")
+
+
+def main_runtpm(argv, stdin=sys.stdin, out=sys.stdout):
+    """
+    Fake runtpm: runtpm -o obs -S spin -s D_km < "obj eph eps Gamma BondA ca cr".
+    """
+    prog = "runtpm"
+    t_start = time.time()
+    opts = parse_fake_argv(argv, {"-o": None, "-S": None, "-s": "1.0"})
+    inp = stdin.read()
+    with open(opts["-o"]) as f:
+        obs = f.read()
+    with open(opts["-S"]) as f:
+        spin = f.read()
+    rng = fake_rng(prog, obs, spin, inp, opts["-s"])
+
+    _, _, eps, Gamma, BondA = inp.split()[:5]
+    eps, Gamma, BondA = float(eps), float(Gamma), float(BondA)
+    lam, beta = [float(x) for x in spin.split()[:2]]
+    # Obs file: N_obs, blank, "t0 N_data", asteroid, observer, "w f sigma" x N_data
+    lines = obs.split("\n")
+    t0, N_data = lines[2].split()
+    S = [float(x) for x in lines[3].split()]
+    O = [float(x) for x in lines[4].split()]
+    bands = [[float(x) for x in line.split()[:3]] for line in lines[5:5+int(N_data)]]
+
+    fake_wait(prog, rng)
+    if rng.random() < fake_param(prog, "FAILRATE"):
+        sys.stderr.write(f"runtpm (fake): failed with {opts['-o']} {opts['-S']}\n")
+        fake_log(prog, t_start, 1, 0)
+        return 1
+
+    r = math.sqrt(sum(x**2 for x in S))
+    delta = math.sqrt(sum(x**2 for x in O))
+    alpha = math.degrees(math.acos(max(-1, min(1, sum(x*y for x, y in zip(S, O))/r/delta))))
+    eta = fake_eta(lam, beta, Gamma, S)
+    # pv from the Bond albedo with q = 0.290 + 0.684*G (G = 0.15)
+    pv = BondA/(0.290 + 0.684*0.15)
+    new = fake_param(prog, "LAYOUT") == "new"
+
+    print_lines(prog, rng, out)
+    for idx, (w, fobs, sig) in enumerate(bands):
+        flux = fake_flux(float(opts["-s"]), pv, eta, r, delta, alpha, w, eps)
+        cols = [f"1 {idx + 1} {t0} {w:g}"]
+        if new:
+            cols.append(f"{eps}")
+        cols.append(f"{fobs:g} {sig:g} {flux:.6e} {fobs/flux if flux > 0 else 0:.6e} {(fobs - flux)/sig:.6e}")
+        if Gamma > 0:
+            cols.append(f"{eta:.6f}")
+        out.write(f"f> {' '.join(cols)}\n")
+    fake_log(prog, t_start, 0, len(bands))
+    return 0
+
+
+def fit_fake(H, G, eps, eta, pv, r, delta, alpha, bands, mode):
+    """
+    Fit D (and eta for mode 0) to fluxes with the model of fake_flux.
+    """
+    def fit_D(eta):
+        model = [fake_flux(1.0, pv, eta, r, delta, alpha, w, eps, G) for w, _, _ in bands]
+        num = sum(m*f/e**2 for m, (_, f, e) in zip(model, bands))
+        den = sum(m**2/e**2 for m, (_, _, e) in zip(model, bands))
+        D2 = num/den if den > 0 else 0.0
+        chi2 = sum((D2*m - f)**2/e**2 for m, (_, f, e) in zip(model, bands))
+        return math.sqrt(max(D2, 0.0)), chi2
+
+    if mode == 0:
+        # Grid search of eta
+        res = [(fit_D(eta_k), eta_k) for eta_k in [0.5 + 0.05*k for k in range(51)]]
+        (D, chi2), eta = min(res, key=lambda x: x[0][1])
+    elif mode == 3:
+        # Fast rotating model: isothermal in latitude, no phase dependence
+        D, chi2 = fit_D(math.pi)
+        eta = 1.0
+    else:
+        D, chi2 = fit_D(eta)
+    return D, eta, chi2
+
+
+def main_fittm(argv, stdin=sys.stdin, out=sys.stdout):
+    """
+    Fake fittm: fittm -m mode < "H G eps eta pv r delta alpha w f sigma ..." (one row per line).
+    """
+    prog = "fittm"
+    t_start = time.time()
+    opts = parse_fake_argv(argv, {"-m": "1"})
+    mode = int(opts["-m"])
+    rows = [line.split() for line in stdin.read().splitlines() if line.strip()]
+    rng = fake_rng(prog, opts["-m"], *[" ".join(row) for row in rows])
+
+    fake_wait(prog, rng, len(rows))
+    if rng.random() < fake_param(prog, "FAILRATE"):
+        sys.stderr.write(f"fittm (fake): failed with {len(rows)} rows\n")
+        fake_log(prog, t_start, 1, 0)
+        return 1
+
+    print_lines(prog, rng, out)
+    for row in rows:
+        H, G, eps, eta, pv, r, delta, alpha = [float(x) for x in row[:8]]
+        bands = [[float(x) for x in row[i:i+3]] for i in range(8, len(row) - 2, 3)]
+        D, eta, chi2 = fit_fake(H, G, eps, eta, pv, r, delta, alpha, bands, mode)
+        pv = (1329./D*10**(-0.2*H))**2 if D > 0 else 0.0
+        # D is the 2nd and eta is the 6th column
+        out.write(f"o> {D:.6f} {pv:.6f} {H} {G} {eta:.6f} {chi2:.6e}\n")
+    fake_log(prog, t_start, 0, len(rows))
+    return 0
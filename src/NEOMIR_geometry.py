@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Observation geometry (r, delta, alpha) of objects.
+
+The geometry is common to all poles and TI of an object, so it is
+calculated once per object, cached by (campaign, objid), and joined to
+results by objid.
+"""
+import numpy as np
+import pandas as pd
+
+
+# Positions of the asteroid and the observer in au
+position_columns = ["X", "Y", "Z", "MirX", "MirY", "MirZ"]
+aspect_columns = ["r", "delta", "alpha"]
+
+# (campaign, objid) -> (X, Y, Z, MirX, MirY, MirZ, r, delta, alpha)
+_geometry_cache = {}
+
+
+def calc_r_delta_alpha(S, O):
+    """
+    Calculate heliocentric and observer-centric distances and phase angle.
+
+    Parameters
+    ----------
+    S : array-like
+        (N, 3) positions of asteroids in au (as in the obs file)
+    O : array-like
+        (N, 3) positions of the observer seen from asteroids in au
+
+    Return
+    ------
+    r, delta : numpy.ndarray
+        heliocentric and observer-centric distances in au
+    alpha : numpy.ndarray
+        phase angle in degree
+    """
+    S, O = np.atleast_2d(S), np.atleast_2d(O)
+    r = np.sqrt(np.sum(S**2, axis=1))
+    delta = np.sqrt(np.sum(O**2, axis=1))
+    alpha = np.arccos(np.sum(S*O, axis=1)/delta/r)*180/np.pi
+    return r, delta, alpha
+
+
+def calc_aspect(df):
+    """
+    Calculate alpha, delta, and r of every row.
+
+    Use object_geometry and join_geometry for results of TPM, where the
+    geometry is common to all rows of an object.
+
+    Parameter
+    ---------
+    df : pandas.DataFrame
+        input dataframe with X, Y, Z, MirX, MirY, and MirZ
+
+    Return
+    ------
+    df : pandas.DataFrame
+        output dataframe
+    """
+    df["r"], df["delta"], df["alpha"] = calc_r_delta_alpha(
+        df[["X", "Y", "Z"]].values, df[["MirX", "MirY", "MirZ"]].values)
+    return df
+
+
+def object_geometry(objid, pos, campaign=None):
+    """
+    Make a table of geometry of objects.
+
+    Parameters
+    ----------
+    objid : array-like
+        object ids
+    pos : array-like
+        (N, 6) positions X, Y, Z, MirX, MirY, and MirZ in au
+    campaign : str, optional
+        name of the campaign (e.g., result directory); if given, the
+        geometry is cached and can be obtained with cached_geometry
+
+    Return
+    ------
+    geom : pandas.DataFrame
+        positions, r, delta, and alpha indexed by objid
+    """
+    objid = np.asarray(objid, dtype=np.int64)
+    pos = np.asarray(pos, dtype=float).reshape(len(objid), 6)
+    r, delta, alpha = calc_r_delta_alpha(pos[:, :3], pos[:, 3:])
+    geom = pd.DataFrame(pos, columns=position_columns, index=pd.Index(objid, name="objid"))
+    geom["r"], geom["delta"], geom["alpha"] = r, delta, alpha
+    if campaign is not None:
+        for i, row in zip(objid.tolist(), geom.values.tolist()):
+            _geometry_cache[(campaign, i)] = row
+    return geom
+
+
+def cached_geometry(campaign, objid):
+    """
+    Return the cached geometry of objects.
+
+    Parameters
+    ----------
+    campaign : str
+        name of the campaign
+    objid : array-like
+        object ids
+
+    Return
+    ------
+    geom : pandas.DataFrame or None
+        geometry indexed by objid (None if any of objects is not cached)
+    """
+    try:
+        rows = [_geometry_cache[(campaign, i)] for i in objid]
+    except KeyError:
+        return None
+    return pd.DataFrame(
+        rows, columns=position_columns + aspect_columns,
+        index=pd.Index(np.asarray(objid, dtype=np.int64), name="objid"))
+
+
+def join_geometry(df, geom, columns=aspect_columns):
+    """
+    Add the geometry of each object to its rows.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        results with objid
+    geom : pandas.DataFrame
+        geometry indexed by objid (see object_geometry)
+    columns : array-like
+        columns to be added
+
+    Return
+    ------
+    df : pandas.DataFrame
+        df with the columns
+    """
+    # Position of each row in geom
+    idx = geom.index.get_indexer(df["objid"].values)
+    if np.any(idx < 0):
+        missing = np.unique(df["objid"].values[idx < 0])
+        raise KeyError(f"No geometry of objects: {missing.tolist()}")
+    for col in columns:
+        df[col] = geom[col].values[idx]
+    return df
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-task telemetry of TPM and fit runs.
+
+runtpm_NEOMIR.py and calc_D_fittm.py write a JSON line per task with
+--metrics (object, Gamma, pole, queue wait, spawn time, wall and CPU time
+of the subprocess, parse time, and output size) and a line at the start
+and the end of each round. The file is flushed after every line, so a
+running campaign can be summarized at any time:
+    python src/NEOMIR_metrics.py summary metrics.jsonl
+"""
+from argparse import ArgumentParser as ap
+import os
+import json
+import time
+import resource
+import numpy as np
+import pandas as pd
+
+
+# Timings of a task in s
+timing_columns = ["queue_wait", "spawn", "wall", "cpu", "parse"]
+
+
+def child_cpu_time():
+    """
+    CPU time (user + system) in s of terminated children of this process.
+    """
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime
+
+
+class MetricsLog:
+    """
+    Append-only JSON-lines log of a run.
+
+    Every line has event (start, task, or end), program, run (id of the
+    run, so that several runs can share a file), and t (UNIX time).
+
+    Parameters
+    ----------
+    path : str
+        file of the log (appended)
+    program : str
+        name of the program (e.g., runtpm or fittm)
+    """
+    def __init__(self, path, program):
+        self.path = path
+        self.program = program
+        self.run = f"{os.getpid()}-{int(time.time())}"
+        self.f = open(path, "a")
+
+    def write(self, event, **fields):
+        """
+        Write a line (a single write, flushed).
+        """
+        rec = dict(event=event, program=self.program, run=self.run, t=time.time())
+        rec.update(fields)
+        self.f.write(json.dumps(rec) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def read_metrics(path, run="last"):
+    """
+    Read a log of metrics.
+
+    Parameters
+    ----------
+    path : str
+        file of the log
+    run : str
+        id of the run, last (the last run started), or all
+
+    Return
+    ------
+    events : pandas.DataFrame
+        start and end lines
+    tasks : pandas.DataFrame
+        task lines
+    """
+    with open(path) as f:
+        # A line being written by a running campaign is skipped
+        recs = []
+        for line in f:
+            try:
+                recs.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass
+    df = pd.DataFrame(recs)
+    if len(df) == 0:
+        raise ValueError(f"No metrics in {path}")
+    if run == "last":
+        run = df.loc[df["event"] == "start", "run"].iloc[-1] if (df["event"] == "start").any() else df["run"].iloc[-1]
+    if run != "all":
+        df = df[df["run"] == run]
+    events = df[df["event"] != "task"].reset_index(drop=True)
+    tasks = df[df["event"] == "task"].reset_index(drop=True)
+    # Keys are float when events without them are mixed
+    for col in ["objid", "Gamma", "idx", "batch", "rows"]:
+        if (col in tasks) and tasks[col].notna().all():
+            tasks[col] = tasks[col].astype(np.int64)
+    return events, tasks
+
+
+def summarize_metrics(events, tasks, top=5, window=300.):
+    """
+    Make a summary of a run.
+
+    Parameters
+    ----------
+    events, tasks : pandas.DataFrame
+        lines of the log (see read_metrics)
+    top : int
+        number of slowest Gammas and objects shown
+    window : float
+        time window in s to estimate the current throughput
+
+    Return
+    ------
+    text : str
+        summary
+    """
+    lines = []
+    starts = events[events["event"] == "start"]
+    N_task = int(starts["N_task"].sum()) if "N_task" in starts else 0
+    t_first = starts["t"].min() if len(starts) else tasks["t"].min()
+    finished = (events["event"] == "end").any()
+    t_now = events["t"].max() if finished else time.time()
+
+    ok = tasks[tasks["status"] == "ok"] if len(tasks) else tasks
+    N_fail = len(tasks) - len(ok)
+    run = tasks if len(tasks) else events
+    lines.append(f"Run {', '.join(sorted(set(run['run'])))} ({', '.join(sorted(set(run['program'])))})")
+    # Only runtpm has results from the cache
+    cached = ok["cached"].fillna(False).astype(bool) if "cached" in ok else pd.Series(False, index=ok.index)
+    N_cached = int(cached.sum())
+    lines.append(
+        f"  {len(ok)}/{N_task} tasks done ({N_cached} from cache, {N_fail} failed)"
+        + (", finished" if finished else ""))
+    if len(ok) == 0:
+        return "\n".join(lines)
+
+    # Throughput over the whole run and in the last window
+    run_ok = ok[~cached]
+    elapsed = t_now - t_first
+    lines.append(f"  Elapsed {elapsed:.1f} s, {len(ok)/elapsed if elapsed > 0 else np.nan:.2f} tasks/s")
+    if "rows" in ok:
+        lines.append(f"  {int(ok['rows'].sum())} rows, {ok['rows'].sum()/elapsed if elapsed > 0 else np.nan:.1f} rows/s")
+    recent = ok[ok["t"] > t_now - window]
+    rate = len(recent)/min(window, elapsed) if elapsed > 0 else np.nan
+    if not finished:
+        N_left = N_task - len(ok)
+        eta = N_left/rate if rate > 0 else np.inf
+        lines.append(
+            f"  {rate:.2f} tasks/s in the last {window:.0f} s, {N_left} tasks left, "
+            f"ETA {eta/60:.1f} min ({time.strftime('%Y-%m-%d %H:%M', time.localtime(t_now + eta)) if np.isfinite(eta) else 'unknown'})")
+
+    # Where the time goes (simulations run, not cached)
+    if len(run_ok):
+        lines.append("  Mean / p95 per task in s:")
+        for col in timing_columns:
+            if (col in run_ok) and run_ok[col].notna().any():
+                v = run_ok[col].astype(float)
+                lines.append(f"    {col:>10s}: {v.mean():10.4f} / {np.nanpercentile(v, 95):10.4f}")
+        if "out_bytes" in run_ok:
+            lines.append(f"    {'out_bytes':>10s}: {run_ok['out_bytes'].mean():10.0f} / {np.nanpercentile(run_ok['out_bytes'], 95):10.0f}")
+
+        # Slowest Gammas and objects by wall time of the subprocess
+        for key, name in [("Gamma", "Gammas"), ("objid", "objects")]:
+            if key not in run_ok:
+                continue
+            g = run_ok.groupby(key)["wall"].agg(["count", "mean", "sum", "max"])
+            g = g.sort_values("mean", ascending=False).head(top)
+            lines.append(f"  Slowest {name} (mean wall time):")
+            for k, row in g.iterrows():
+                lines.append(
+                    f"    {key}={k}: {row['mean']:.4f} s x {int(row['count'])} "
+                    f"(total {row['sum']:.1f} s, max {row['max']:.4f} s)")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = ap(description="Summarize metrics of TPM and fit runs.")
+    parser.add_argument(
+        "command", type=str, choices=["summary"],
+        help="summary")
+    parser.add_argument(
+        "metrics", type=str,
+        help="JSON-lines file written with --metrics")
+    parser.add_argument(
+        "--run", type=str, default="last",
+        help="Id of the run, last, or all")
+    parser.add_argument(
+        "--top", type=int, default=5,
+        help="Number of slowest Gammas and objects shown")
+    parser.add_argument(
+        "--window", type=float, default=300.,
+        help="Time window in s to estimate the current throughput")
+    args = parser.parse_args()
+
+    events, tasks = read_metrics(args.metrics, args.run)
+    print(summarize_metrics(events, tasks, args.top, args.window))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sampling of spin poles for TPM.
+
+Methods
+    uniform   : uniform in longitude and latitude (used in the paper,
+                oversamples near the poles)
+    random    : uniform on the sphere (area-correct)
+    fibonacci : Fibonacci lattice (quasi-uniform, deterministic)
+    healpix   : centers of HEALPix pixels (N = 12*nside^2)
+Poles can be added where the flux varies fastest with refine_poles.
+Values on poles are interpolated to a (lon, lat) grid with PoleInterpolator,
+which triangulates a pole set only once.
+"""
+import hashlib
+import numpy as np
+from scipy.spatial import ConvexHull, Delaunay
+from scipy.interpolate import CloughTocher2DInterpolator
+
+
+pole_methods = ["uniform", "random", "fibonacci", "healpix"]
+
+
+def sample_poles(N, method="uniform", seed=0):
+    """
+    Sample spin poles.
+
+    Parameters
+    ----------
+    N : int
+        number of poles
+    method : str
+        uniform, random, fibonacci, or healpix
+    seed : int
+        random seed (for uniform and random)
+
+    Return
+    ------
+    lam, beta : numpy.ndarray
+        ecliptic longitude (0 to 360) and latitude (-90 to 90) in degree
+    """
+    if method == "uniform":
+        # Same as the paper
+        np.random.seed(seed)
+        lam = np.random.uniform(0, 360, N)
+        beta = np.random.uniform(-90, 90, N)
+    elif method == "random":
+        rng = np.random.default_rng(seed)
+        lam = rng.uniform(0, 360, N)
+        beta = np.degrees(np.arcsin(rng.uniform(-1, 1, N)))
+    elif method == "fibonacci":
+        k = np.arange(N)
+        golden_angle = np.pi*(3 - np.sqrt(5))
+        lam = np.degrees(k*golden_angle) % 360
+        beta = np.degrees(np.arcsin(1 - (2*k + 1)/N))
+    elif method == "healpix":
+        nside = int(round(np.sqrt(N/12)))
+        if 12*nside**2 != N:
+            raise ValueError(
+                f"N must be 12*nside^2 for healpix (e.g., {12*max(nside, 1)**2}), not {N}")
+        lam, beta = healpix_centers(nside)
+    else:
+        raise ValueError(f"Unknown method: {method} ({', '.join(pole_methods)})")
+    return lam, beta
+
+
+def healpix_centers(nside):
+    """
+    Centers of HEALPix pixels in the RING scheme (Gorski et al. 2005).
+
+    Parameter
+    ---------
+    nside : int
+        resolution parameter
+
+    Return
+    ------
+    lam, beta : numpy.ndarray
+        longitude and latitude of 12*nside^2 pixel centers in degree
+    """
+    z_list, phi_list = [], []
+    for i in range(1, 4*nside):
+        if i < nside:
+            # North polar cap
+            j = np.arange(1, 4*i + 1)
+            z = np.full(len(j), 1 - i**2/(3*nside**2))
+            phi = np.pi/(2*i)*(j - 0.5)
+        elif i <= 3*nside:
+            # Equatorial belt
+            j = np.arange(1, 4*nside + 1)
+            s = (i - nside + 1) % 2
+            z = np.full(len(j), 4/3 - 2*i/(3*nside))
+            phi = np.pi/(2*nside)*(j - s/2)
+        else:
+            # South polar cap
+            ii = 4*nside - i
+            j = np.arange(1, 4*ii + 1)
+            z = np.full(len(j), -(1 - ii**2/(3*nside**2)))
+            phi = np.pi/(2*ii)*(j - 0.5)
+        z_list.append(z)
+        phi_list.append(phi)
+    z, phi = np.concatenate(z_list), np.concatenate(phi_list)
+    return np.degrees(phi) % 360, np.degrees(np.arcsin(z))
+
+
+def lonlat2xyz(lam, beta):
+    """
+    Convert longitude and latitude in degree to unit vectors.
+    """
+    lam, beta = np.radians(lam), np.radians(beta)
+    return np.array([
+        np.cos(beta)*np.cos(lam), np.cos(beta)*np.sin(lam), np.sin(beta)]).T
+
+
+def xyz2lonlat(xyz):
+    """
+    Convert vectors to longitude (0 to 360) and latitude in degree.
+    """
+    xyz = xyz/np.linalg.norm(xyz, axis=1)[:, None]
+    lam = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+    beta = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1, 1)))
+    return lam, beta
+
+
+def refine_poles(lam, beta, flux, N_new):
+    """
+    Add poles where the flux varies fastest.
+
+    The poles are triangulated on the sphere, and the centroids of the
+    N_new triangles with the largest flux range times size are returned.
+
+    Parameters
+    ----------
+    lam, beta : array-like
+        longitude and latitude of poles already computed in degree
+    flux : array-like
+        flux of each pole
+    N_new : int
+        number of poles to be added
+
+    Return
+    ------
+    lam_new, beta_new : numpy.ndarray
+        longitude and latitude of new poles in degree
+    """
+    xyz = lonlat2xyz(lam, beta)
+    flux = np.asarray(flux, dtype=float)
+    # Convex hull of points on a sphere = spherical Delaunay triangulation
+    tri = ConvexHull(xyz).simplices
+    v = xyz[tri]
+    f = flux[tri]
+    size = np.max(np.linalg.norm(v - np.roll(v, 1, axis=1), axis=2), axis=1)
+    score = (np.max(f, axis=1) - np.min(f, axis=1))*size
+    idx = np.argsort(score)[::-1][:N_new]
+    return xyz2lonlat(np.mean(v[idx], axis=1))
+
+
+class PoleInterpolator:
+    """
+    Cubic interpolation of values on poles in longitude and latitude.
+
+    The Delaunay triangulation is made once per pole set and shared by
+    all values (e.g., all TI and objects). Poles within pad degrees of
+    0 or 360 deg are copied to the other side, so that maps are continuous
+    at the longitude of 0/360 deg.
+
+    Parameters
+    ----------
+    lam, beta : array-like
+        longitude (0 to 360) and latitude of poles in degree
+    pad : float
+        width of the copied band in longitude in degree
+    """
+    def __init__(self, lam, beta, pad=60.0):
+        lam, beta = np.asarray(lam, dtype=float), np.asarray(beta, dtype=float)
+        idx = np.arange(len(lam))
+        left, right = lam < pad, lam > 360 - pad
+        # Index of the original pole of each point
+        self.index = np.concatenate([idx, idx[left], idx[right]])
+        points = np.array([
+            np.concatenate([lam, lam[left] + 360, lam[right] - 360]),
+            np.concatenate([beta, beta[left], beta[right]])]).T
+        self.tri = Delaunay(points)
+
+    def __call__(self, values, lam, beta):
+        """
+        Interpolate values.
+
+        Parameters
+        ----------
+        values : array-like
+            (N_pole,) or (N_pole, K) values on poles
+        lam, beta : array-like
+            longitude and latitude where values are interpolated
+
+        Return
+        ------
+        out : numpy.ndarray
+            interpolated values with the shape of lam (+ (K,));
+            NaN outside of the poles in latitude
+        """
+        values = np.asarray(values, dtype=float)[self.index]
+        return CloughTocher2DInterpolator(self.tri, values)(lam, beta)
+
+
+# Interpolators of pole sets already triangulated: hash -> PoleInterpolator
+_interpolators = {}
+
+
+def get_interpolator(lam, beta):
+    """
+    Return the interpolator of a pole set (made once per pole set).
+    """
+    lam, beta = np.ascontiguousarray(lam, dtype=float), np.ascontiguousarray(beta, dtype=float)
+    key = hashlib.sha1(lam.tobytes() + beta.tobytes()).hexdigest()
+    if key not in _interpolators:
+        _interpolators[key] = PoleInterpolator(lam, beta)
+    return _interpolators[key], key
+
+
+def interpolate_pole_maps(maps, lam_grid, beta_grid):
+    """
+    Interpolate many maps to a grid, batched by pole set.
+
+    Parameters
+    ----------
+    maps : list of tuple
+        (lam, beta, values) of each map
+    lam_grid, beta_grid : array-like
+        longitude and latitude of the grid
+
+    Return
+    ------
+    grids : list of numpy.ndarray
+        interpolated maps with the shape of lam_grid
+    """
+    # Maps with the same poles are interpolated at once
+    groups = {}
+    for idx, (lam, beta, values) in enumerate(maps):
+        interp, key = get_interpolator(lam, beta)
+        groups.setdefault(key, (interp, []))[1].append(idx)
+
+    grids = [None]*len(maps)
+    for interp, idx_maps in groups.values():
+        values = np.array([maps[idx][2] for idx in idx_maps]).T
+        res = interp(values, lam_grid, beta_grid)
+        for k, idx in enumerate(idx_maps):
+            grids[idx] = res[..., k]
+    return grids
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared work queue of TPM simulations (SQLite).
+
+A campaign is enqueued once (one row per object, Gamma, and pole), and
+workers on any node that sees the file claim tasks with a lease. A worker
+renews the leases of its tasks while they run; when a worker crashes, its
+leases expire and the tasks are claimed again by other workers.
+Results are appended by each worker to its own shard file next to the
+queue ({queue}.shards/{worker}.txt), and the shards are merged into the
+usual TI{Gamma}_res_{label}.txt files at the end (see runtpm_NEOMIR.py).
+
+Claims are made in an immediate transaction, so the queue can be shared by
+processes on one machine or on a file system with working locks.
+The state of a queue is shown with
+    python src/NEOMIR_queue.py status queue.sqlite
+"""
+from argparse import ArgumentParser as ap
+import os
+import json
+import time
+import socket
+import sqlite3
+
+
+task_states = ["pending", "leased", "done", "failed"]
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    label TEXT, Gamma INTEGER, idx INTEGER, lam REAL, beta REAL,
+    state TEXT DEFAULT 'pending', worker TEXT, lease_until REAL,
+    attempts INTEGER DEFAULT 0, error TEXT, t_done REAL,
+    UNIQUE (label, Gamma, idx));
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until);
+"""
+
+
+def default_worker_id():
+    """
+    Id of a worker (host and pid).
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Work queue of TPM simulations in an SQLite file.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file of the queue
+    timeout : float
+        time in s to wait for a lock held by another process
+    """
+    def __init__(self, path, timeout=60.):
+        self.path = path
+        self.shard_dir = f"{path}.shards"
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.executescript(_schema)
+
+    def close(self):
+        self.conn.close()
+
+    def set_meta(self, key, value):
+        """
+        Save a value (JSON) of the campaign, e.g., objects and shape model.
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(f"No {key} in the queue {self.path}")
+        return json.loads(row[0])
+
+    def enqueue(self, tasks):
+        """
+        Add tasks (tasks already in the queue are kept).
+
+        Parameter
+        ---------
+        tasks : list of tuple
+            (label, Gamma, idx, lam, beta)
+
+        Return
+        ------
+        N : int
+            number of tasks added
+        """
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        N_before = cur.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        cur.executemany(
+            "INSERT OR IGNORE INTO tasks (label, Gamma, idx, lam, beta) VALUES (?, ?, ?, ?, ?)",
+            [(label, int(Gamma), int(i), float(lam), float(beta)) for label, Gamma, i, lam, beta in tasks])
+        N_after = cur.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        cur.execute("COMMIT")
+        return N_after - N_before
+
+    def claim(self, worker, N, lease):
+        """
+        Claim pending tasks and tasks whose lease has expired.
+
+        Parameters
+        ----------
+        worker : str
+            id of the worker
+        N : int
+            maximum number of tasks
+        lease : float
+            duration of the lease in s
+
+        Return
+        ------
+        tasks : list of tuple
+            (id, label, Gamma, idx, lam, beta)
+        """
+        now = time.time()
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            rows = cur.execute(
+                "SELECT id, label, Gamma, idx, lam, beta FROM tasks "
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY id LIMIT ?", (now, N)).fetchall()
+            cur.executemany(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                [(worker, now + lease, row[0]) for row in rows])
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        return rows
+
+    def renew(self, worker, ids, lease):
+        """
+        Extend leases of tasks still held by a worker.
+
+        Return
+        ------
+        N : int
+            number of leases extended (smaller if some were claimed by others)
+        """
+        if not ids:
+            return 0
+        cur = self.conn.executemany(
+            "UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            [(time.time() + lease, i, worker) for i in ids])
+        return cur.rowcount
+
+    def complete(self, worker, task_id):
+        """
+        Mark a task as done (its result has been saved in the shard).
+        """
+        self.conn.execute(
+            "UPDATE tasks SET state = 'done', worker = ?, t_done = ?, error = NULL "
+            "WHERE id = ? AND state != 'done'", (worker, time.time(), task_id))
+
+    def fail(self, worker, task_id, error, max_attempts=3):
+        """
+        Put a failed task back into the queue (or mark it failed after max_attempts).
+        """
+        self.conn.execute(
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker = ?, lease_until = NULL, error = ? WHERE id = ? AND state != 'done'",
+            (max_attempts, worker, error, task_id))
+
+    def requeue(self, ids):
+        """
+        Put tasks back into the queue (e.g., results lost in shards).
+        """
+        self.conn.executemany(
+            "UPDATE tasks SET state = 'pending', worker = NULL, lease_until = NULL, t_done = NULL "
+            "WHERE id = ?", [(i,) for i in ids])
+
+    def counts(self):
+        """
+        Number of tasks in each state.
+        """
+        counts = dict.fromkeys(task_states, 0)
+        for state, N in self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"):
+            counts[state] = N
+        return counts
+
+    def N_open(self):
+        """
+        Number of tasks not done nor failed.
+        """
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def tasks(self, state=None):
+        """
+        Return tasks (id, label, Gamma, idx, lam, beta, state, worker, attempts, error).
+        """
+        sql = "SELECT id, label, Gamma, idx, lam, beta, state, worker, attempts, error FROM tasks"
+        if state is None:
+            return self.conn.execute(f"{sql} ORDER BY id").fetchall()
+        return self.conn.execute(f"{sql} WHERE state = ? ORDER BY id", (state,)).fetchall()
+
+    def shard_path(self, worker):
+        """
+        Shard file of results of a worker.
+        """
+        os.makedirs(self.shard_dir, exist_ok=True)
+        return os.path.join(self.shard_dir, f"{worker}.txt")
+
+    def shards(self):
+        """
+        Return all shard files.
+        """
+        if not os.path.isdir(self.shard_dir):
+            return []
+        return sorted(
+            os.path.join(self.shard_dir, name) for name in os.listdir(self.shard_dir)
+            if name.endswith(".txt"))
+
+
+if __name__ == "__main__":
+    parser = ap(description="Show the state of a work queue of TPM simulations.")
+    parser.add_argument(
+        "command", type=str, choices=["status", "failed"],
+        help="status (numbers of tasks and workers) or failed (list failed tasks)")
+    parser.add_argument(
+        "queue", type=str,
+        help="SQLite file of the queue")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    if args.command == "status":
+        counts = queue.counts()
+        print(f"{sum(counts.values())} tasks: " + ", ".join(f"{N} {state}" for state, N in counts.items()))
+        now = time.time()
+        for worker, N, lease in queue.conn.execute(
+                "SELECT worker, COUNT(*), MAX(lease_until) FROM tasks "
+                "WHERE state = 'leased' GROUP BY worker ORDER BY worker"):
+            status = "active" if lease >= now else "expired"
+            print(f"  {worker}: {N} leased ({status}, {lease - now:+.0f} s)")
+    else:
+        for task_id, label, Gamma, idx, lam, beta, _, worker, attempts, error in queue.tasks("failed"):
+            print(f"{task_id} {label} TI{Gamma} idx={idx} ({lam}, {beta}) {attempts} attempts by {worker}: {error}")
+    queue.close()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Staging of spin files for runtpm.
+
+Spin files are written to a RAM-backed directory (/dev/shm if available)
+and named after a hash of their contents, so that a spin file shared by
+several objects, TI values, or campaigns is written only once.
+At the end of a run, all staged files are added to one tar file (files
+archived by earlier runs are kept).
+"""
+import os
+import shutil
+import hashlib
+import tarfile
+import tempfile
+
+
+def default_stagedir():
+    """
+    Return a RAM-backed directory if available, otherwise a temporary one.
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class SpinStager:
+    """
+    Stage spin files deduplicated by their contents.
+
+    Parameters
+    ----------
+    stagedir : str, optional
+        directory where spin files are staged. If given, the directory is
+        kept after the run, so that other campaigns can reuse its files.
+        If not given, a new directory is made in a RAM-backed file system
+        and removed with cleanup.
+    """
+    def __init__(self, stagedir=None):
+        if stagedir is None:
+            self.dir = tempfile.mkdtemp(prefix="neomir_spin_", dir=default_stagedir())
+            self.keep = False
+        else:
+            os.makedirs(stagedir, exist_ok=True)
+            self.dir = stagedir
+            self.keep = True
+        self.staged = set()
+        self.N_request = 0
+
+    def stage(self, lam, beta, rotP_hr):
+        """
+        Stage a spin file.
+
+        Parameters
+        ----------
+        lam, beta : float
+            ecliptic longitude and latitude of the pole in degree
+        rotP_hr : float
+            rotation period in hour
+
+        Return
+        ------
+        path : str
+            path of the spin file
+        """
+        self.N_request += 1
+        content = f"{lam} {beta} {rotP_hr} 0 0\n"
+        name = f"spin_{hashlib.sha1(content.encode()).hexdigest()[:16]}.txt"
+        path = os.path.join(self.dir, name)
+        if name not in self.staged:
+            # Files staged by other campaigns are reused
+            if not os.path.isfile(path):
+                with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+                    f.write(content)
+                os.replace(f"{path}.{os.getpid()}.tmp", path)
+            self.staged.add(name)
+        return path
+
+    def archive(self, spindir, name="spinfiles.tar"):
+        """
+        Add spin files staged in this run to a tar file.
+
+        Files already in the tar file (e.g., of an earlier run resumed from
+        the cache) are kept. Nothing is written if no file was staged.
+
+        Parameters
+        ----------
+        spindir : str
+            directory for the tar file
+        name : str
+            name of the tar file
+
+        Return
+        ------
+        out : str
+            path of the tar file (None if no file was staged)
+        """
+        if not self.staged:
+            return None
+        os.makedirs(spindir, exist_ok=True)
+        out = os.path.join(spindir, name)
+        with tarfile.open(f"{out}.tmp", "w") as tar:
+            if os.path.isfile(out):
+                with tarfile.open(out) as old:
+                    for member in old.getmembers():
+                        if member.isfile() and (member.name not in self.staged):
+                            tar.addfile(member, old.extractfile(member))
+            for fi in sorted(self.staged):
+                tar.add(os.path.join(self.dir, fi), arcname=fi)
+        os.replace(f"{out}.tmp", out)
+        return out
+
+    def cleanup(self):
+        """
+        Remove the staging directory (unless it was given by the user).
+        """
+        if not self.keep:
+            shutil.rmtree(self.dir, ignore_errors=True)
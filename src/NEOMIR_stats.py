@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Out-of-core aggregation of TPM results.
+
+A campaign (directory with TI*_res_*.txt or a columnar store) is read in
+chunks of objects (blocks of rows for a store), and statistics of columns
+are accumulated per group, so that memory does not grow with the number
+of objects:
+    N, min, max, mean, std : exact (chunks are merged as in Chan et al. 1979)
+    median, quantiles      : interpolated in a histogram with fixed bins
+Groups are any of campaign, TI, objid, and sense (prograde if lat >= 0,
+retrograde otherwise). Histograms (e.g., of lon and lat) are kept per group.
+
+Statistics of 8 micron flux per TI and sense of two campaigns:
+    python src/NEOMIR_stats.py --resdir data/tpmout_original data/tpmout_control --column flux8 --by TI sense
+"""
+from argparse import ArgumentParser as ap
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+from NEOMIR_common import (
+    tpmres_names, list_tpmres, is_tpmstore, load_tpmstore, read_tpmres_files,
+    tpmres_frame)
+
+
+group_keys = ["campaign", "TI", "objid", "sense"]
+
+
+def default_bins(column):
+    """
+    Bins of histograms of a column (for median and quantiles).
+    """
+    if column == "lon":
+        return np.arange(0, 361, 1.)
+    if column == "lat":
+        return np.arange(-90, 91, 1.)
+    if column.startswith("flux"):
+        # 100 bins per decade from 1e-3 to 1e9 micro Jy
+        return np.logspace(-3, 9, 1201)
+    raise ValueError(f"Give bins of {column}")
+
+
+def iter_tpmres(resdir, objid=None, TI=None, columns=None, chunk=10, chunk_rows=1000000, compact=False, nthreads=8):
+    """
+    Read TPM results chunk by chunk.
+
+    Parameters
+    ----------
+    resdir : str
+        directory with TI*_res_*.txt or a columnar store
+    objid : array-like, optional
+        object ids to be read (all objects by default)
+    TI : array-like, optional
+        thermal inertia to be read (all TI by default)
+    columns : array-like, optional
+        columns to be read in addition to TI and objid (all columns by default)
+    chunk : int
+        number of objects in a chunk (directory)
+    chunk_rows : int
+        number of rows in a chunk (store)
+    compact : bool
+        if True, values are float32 and TI is categorical
+    nthreads : int
+        number of threads to read files
+
+    Return
+    ------
+    df : pandas.DataFrame
+        results of a chunk (generator)
+    """
+    if is_tpmstore(resdir):
+        usecols = None if columns is None else [tpmres_names.get(col, col) for col in columns]
+        data = load_tpmstore(resdir, None if usecols is None else usecols + ["TI", "objid"])
+        if usecols is None:
+            usecols = [col for col in data if col not in ("objid", "TI")]
+        N = len(data["objid"])
+        for i0 in range(0, N, chunk_rows):
+            sl = slice(i0, min(i0 + chunk_rows, N))
+            mask = np.ones(sl.stop - sl.start, dtype=bool)
+            if objid is not None:
+                mask &= np.isin(data["objid"][sl], objid)
+            if TI is not None:
+                mask &= np.isin(data["TI"][sl], TI)
+            if not mask.any():
+                continue
+            out = {col: np.asarray(data[col][sl])[mask] for col in usecols + ["TI", "objid"]}
+            yield tpmres_frame(out, compact)
+        return
+
+    # The directory is listed once, and files are grouped by object
+    files = list_tpmres(resdir, objid=objid, TI=TI)
+    if not files:
+        raise FileNotFoundError(f"No results found in {resdir}")
+    ids = sorted(set(x[2] for x in files))
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        for i0 in range(0, len(ids), chunk):
+            ids_chunk = set(ids[i0:i0+chunk])
+            yield read_tpmres_files(
+                [x for x in files if x[2] in ids_chunk], columns, compact=compact,
+                executor=executor)
+
+
+class GroupStats:
+    """
+    Streaming statistics of a column per group.
+
+    Parameters
+    ----------
+    bins : array-like
+        edges of the histogram of each group (for median and quantiles)
+    """
+    def __init__(self, bins):
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.groups = {}
+
+    def update(self, keys, values):
+        """
+        Add values of a chunk.
+
+        Parameters
+        ----------
+        keys : pandas.DataFrame
+            group keys of each value (an empty frame for a single group)
+        values : array-like
+            values (NaN are ignored)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        ok = ~np.isnan(values)
+        # 0: below bins[0], len(bins): above bins[-1] (the last edge is in the last bin as in numpy)
+        ibin = np.searchsorted(self.bins, values, side="right")
+        ibin[values == self.bins[-1]] = len(self.bins) - 1
+        if keys.shape[1] == 0:
+            parts = [((), np.flatnonzero(ok))]
+        else:
+            parts = [
+                (key if isinstance(key, tuple) else (key,), idx[ok[idx]])
+                for key, idx in keys.groupby(list(keys.columns), observed=True).indices.items()]
+        for key, idx in parts:
+            if len(idx) == 0:
+                continue
+            v = values[idx]
+            n = len(v)
+            mean = v.mean()
+            M2 = np.sum((v - mean)**2)
+            hist = np.bincount(ibin[idx], minlength=len(self.bins) + 1)
+            g = self.groups.get(key)
+            if g is None:
+                self.groups[key] = dict(N=n, mean=mean, M2=M2, min=v.min(), max=v.max(), hist=hist)
+                continue
+            # Merge with the running statistics
+            N = g["N"] + n
+            d = mean - g["mean"]
+            g["M2"] += M2 + d*d*g["N"]*n/N
+            g["mean"] += d*n/N
+            g["N"] = N
+            g["min"] = min(g["min"], v.min())
+            g["max"] = max(g["max"], v.max())
+            g["hist"] += hist
+
+    def quantile(self, key, q):
+        """
+        Quantile of a group interpolated in the histogram.
+
+        Values below (above) the bins are spread between min (max) and the
+        first (last) edge.
+        """
+        g = self.groups[key]
+        edges = np.concatenate([[g["min"]], self.bins, [g["max"]]])
+        edges = np.clip(edges, g["min"], g["max"])
+        cum = np.cumsum(g["hist"])
+        target = q*g["N"]
+        i = min(int(np.searchsorted(cum, target, side="left")), len(cum) - 1)
+        below = cum[i-1] if i > 0 else 0
+        frac = (target - below)/g["hist"][i] if g["hist"][i] > 0 else 0.
+        return edges[i] + frac*(edges[i+1] - edges[i])
+
+    def histogram(self, key):
+        """
+        Counts in the bins of a group (values outside the bins are not counted).
+        """
+        return self.groups[key]["hist"][1:-1].copy()
+
+    def result(self, by=(), quantiles=(0.5,)):
+        """
+        Make a table of statistics.
+
+        Parameters
+        ----------
+        by : array-like
+            names of group keys
+        quantiles : array-like
+            quantiles to be added (0.5 is the median)
+
+        Return
+        ------
+        df : pandas.DataFrame
+            N, min, max, mean, std (ddof=1), and quantiles of each group
+        """
+        rows = []
+        for key in sorted(self.groups):
+            g = self.groups[key]
+            row = dict(zip(by, key))
+            row.update(
+                N=g["N"], min=g["min"], max=g["max"], mean=g["mean"],
+                std=np.sqrt(g["M2"]/(g["N"] - 1)) if g["N"] > 1 else np.nan)
+            for q in quantiles:
+                name = "median" if q == 0.5 else f"q{100*q:g}"
+                row[name] = self.quantile(key, q)
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+def aggregate_tpmres(resdir, columns, by=("TI",), bins=None, objid=None, TI=None, chunk=10):
+    """
+    Accumulate statistics of columns per group over campaigns.
+
+    Parameters
+    ----------
+    resdir : str or array-like
+        directories with TI*_res_*.txt or columnar stores
+    columns : array-like
+        columns to be aggregated (e.g., flux8, lat)
+    by : array-like
+        group keys (campaign, TI, objid, and/or sense)
+    bins : dict, optional
+        column -> edges of histograms (see default_bins)
+    objid : array-like, optional
+        object ids (all objects by default)
+    TI : array-like, optional
+        thermal inertia (all TI by default)
+    chunk : int
+        number of objects read at once
+
+    Return
+    ------
+    stats : dict
+        column -> GroupStats
+    """
+    if isinstance(resdir, str):
+        resdir = [resdir]
+    for key in by:
+        assert key in group_keys, f"Unknown group key: {key} (choose from {group_keys})"
+    bins = bins or {}
+    stats = {col: GroupStats(bins.get(col, default_bins(col))) for col in columns}
+
+    read = sorted(set(columns) | ({"lat"} if "sense" in by else set()))
+    for r in resdir:
+        campaign = os.path.basename(os.path.normpath(r))
+        for df in iter_tpmres(r, objid=objid, TI=TI, columns=read, chunk=chunk):
+            keys = pd.DataFrame(index=df.index)
+            for key in by:
+                if key == "campaign":
+                    keys[key] = campaign
+                elif key == "sense":
+                    keys[key] = np.where(df["lat"] >= 0, "prograde", "retrograde")
+                else:
+                    keys[key] = np.asarray(df[key])
+            for col in columns:
+                stats[col].update(keys, df[col].values)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = ap(description="Statistics of TPM results computed chunk by chunk.")
+    parser.add_argument(
+        "--resdir", type=str, nargs="*", default=["data/tpmout_original"],
+        help="Directories with output files or columnar stores")
+    parser.add_argument(
+        "--column", type=str, nargs="*", default=["flux8"],
+        help="Columns to be aggregated (e.g., flux5 flux8 lat)")
+    parser.add_argument(
+        "--by", type=str, nargs="*", default=["TI"], choices=group_keys,
+        help="Group keys")
+    parser.add_argument(
+        "--idx_obj", type=int, nargs="*", default=None,
+        help="Index of objects (all objects by default)")
+    parser.add_argument(
+        "--TI", type=int, nargs="*", default=None,
+        help="Thermal inertia (all TI by default)")
+    parser.add_argument(
+        "--quantiles", type=float, nargs="*", default=[0.5],
+        help="Quantiles (0.5 is shown as median)")
+    parser.add_argument(
+        "--chunk", type=int, default=10,
+        help="Number of objects read at once")
+    parser.add_argument(
+        "--out", type=str, default=None,
+        help="Output file of statistics (shown if not given)")
+    args = parser.parse_args()
+
+    stats = aggregate_tpmres(
+        args.resdir, args.column, args.by, objid=args.idx_obj, TI=args.TI, chunk=args.chunk)
+    res = []
+    for col, st in stats.items():
+        df = st.result(args.by, args.quantiles)
+        df.insert(0, "column", col)
+        res.append(df)
+    df = pd.concat(res, ignore_index=True)
+    if args.out:
+        df.to_csv(args.out, sep=" ", index=False)
+        print(f"Saved {args.out}")
+    else:
+        with pd.option_context("display.width", 200, "display.max_rows", None):
+            print(df.to_string(index=False))
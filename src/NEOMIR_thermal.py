@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NEATM/FRM diameter solver in NumPy/SciPy (no fittm needed).
+
+Thermal fluxes of all rows are evaluated at once with Gauss-Legendre
+quadrature, and D (and eta) are fitted with a single sparse least-squares
+problem per chunk of rows.
+The models follow the choices of `fittm -m`:
+    0 : NEATM fitting eta
+    1 : NEATM with fixed eta
+    3 : FRM
+"""
+import numpy as np
+from scipy import constants
+from scipy.optimize import least_squares
+from scipy.sparse import lil_matrix
+
+
+# Physical constants in SI
+h, c, kB = constants.h, constants.c, constants.k
+sigma = constants.Stefan_Boltzmann
+au_m = constants.au
+# Solar constant at 1 au in W/m^2
+S_sun = 1361.0
+# D = 1329/sqrt(pv)*10^(-H/5)
+C_D = 1329.0
+
+# Order of the Gauss-Legendre quadrature (longitude, latitude)
+N_theta, N_phi = 32, 16
+# Maximum Bond albedo (T -> 0 at A -> 1); pv is limited to A_max/(0.290 + 0.684*G)
+A_max = 0.99
+# Values of eta tried to make initial values when eta is fitted
+eta_grid = [0.5, 0.8, 1.0, 1.3, 1.7, 2.2, 2.8, 3.5]
+
+
+def calc_D(H, pv):
+    """
+    Calculate diameter in km from H and pv.
+    """
+    return C_D/np.sqrt(pv)*10**(-0.2*H)
+
+
+def calc_pv(H, D):
+    """
+    Calculate geometric albedo from H and diameter in km.
+    """
+    return (C_D/D*10**(-0.2*H))**2
+
+
+def bond_albedo(pv, G=0.15):
+    """
+    Calculate Bond albedo from geometric albedo (limited to A_max).
+    """
+    return np.minimum((0.290 + 0.684*G)*pv, A_max)
+
+
+def planck_Jy(w_um, T):
+    """
+    Planck function in Jy/sr.
+
+    Parameters
+    ----------
+    w_um : float or array-like
+        wavelength in micron
+    T : array-like
+        temperature in K
+
+    Return
+    ------
+    B : array-like
+        specific intensity in Jy/sr
+    """
+    nu = c/(w_um*1e-6)
+    T = np.asarray(T, dtype=float)
+    with np.errstate(over="ignore", divide="ignore"):
+        B = 2*h*nu**3/c**2/np.expm1(h*nu/(kB*T))
+    # B -> 0 at T -> 0
+    B = np.where(T > 0, B, 0.0)
+    return B*1e26
+
+
+def _gauss_legendre(n, a, b):
+    """
+    Gauss-Legendre nodes and weights on [a, b] (a and b can be arrays).
+    """
+    x, w = np.polynomial.legendre.leggauss(n)
+    a, b = np.asarray(a, dtype=float)[..., None], np.asarray(b, dtype=float)[..., None]
+    return 0.5*(b - a)*x + 0.5*(b + a), 0.5*(b - a)*w
+
+
+def neatm_nodes(alpha):
+    """
+    Quadrature nodes of NEATM for all rows (they depend only on alpha).
+
+    Parameters
+    ----------
+    alpha : array-like
+        phase angle in degree
+
+    Return
+    ------
+    ginv : numpy.ndarray
+        Tss/T at nodes with a shape of (N_row, N_theta*N_phi) (inf on the night side)
+    weight : numpy.ndarray
+        weights of nodes with the same shape
+    """
+    a = np.radians(np.atleast_1d(np.asarray(alpha, dtype=float)))
+    # Longitude from the sub-solar point: illuminated and visible part
+    theta, w_theta = _gauss_legendre(N_theta, a - np.pi/2, np.pi/2)
+    # Latitude: symmetric with respect to the equator
+    phi, w_phi = _gauss_legendre(N_phi, 0, np.pi/2)
+    # (N_row, N_theta, N_phi)
+    cos_mu = np.cos(theta)[:, :, None]*np.cos(phi)[None, None, :]
+    with np.errstate(divide="ignore"):
+        ginv = np.clip(cos_mu, 0, None)**-0.25
+    weight = (
+        (w_theta*np.cos(theta - a[:, None]))[:, :, None]
+        *(w_phi*np.cos(phi)**2)[None, None, :])*2
+    return ginv.reshape(len(a), -1), weight.reshape(len(a), -1)
+
+
+def flux_NEATM(D, pv, eta, r, delta, alpha, w, eps=0.9, G=0.15, nodes=None):
+    """
+    Calculate NEATM fluxes for all rows at once.
+
+    Parameters
+    ----------
+    D : array-like
+        diameter in km
+    pv : array-like
+        geometric albedo
+    eta : array-like
+        beaming parameter
+    r, delta : array-like
+        heliocentric and observer-centric distances in au
+    alpha : array-like
+        phase angle in degree
+    w : array-like
+        wavelengths in micron (common to all rows)
+    eps : float
+        emissivity
+    G : float
+        slope parameter
+    nodes : tuple, optional
+        quadrature nodes of alpha (see neatm_nodes), reused during fitting
+
+    Return
+    ------
+    flux : numpy.ndarray
+        flux densities in Jy with a shape of (N_row, N_band)
+    """
+    D, pv, eta, r, delta, alpha = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(x, dtype=float)) for x in (D, pv, eta, r, delta, alpha)])
+    w = np.atleast_1d(np.asarray(w, dtype=float))
+    A = bond_albedo(pv, G)
+    Tss = ((1 - A)*S_sun/(eta*eps*sigma*r**2))**0.25
+    ginv, weight = neatm_nodes(alpha) if nodes is None else nodes
+
+    # eps*D^2/(4*delta^2) in the same unit
+    sf = eps*(D*1e3)**2/(4*(delta*au_m)**2)
+    flux = np.empty((len(D), len(w)))
+    for idx_w, w_um in enumerate(w):
+        # Planck function in Jy/sr with T = Tss/ginv (B -> 0 on the night side)
+        nu = c/(w_um*1e-6)
+        with np.errstate(over="ignore"):
+            x = np.expm1((h*nu/(kB*Tss))[:, None]*ginv)
+        B = 2*h*nu**3/c**2*1e26/x
+        flux[:, idx_w] = sf*np.einsum("ij,ij->i", B, weight)
+    return flux
+
+
+def flux_FRM(D, pv, r, delta, w, eps=0.9, G=0.15):
+    """
+    Calculate FRM fluxes for all rows at once.
+
+    Parameters
+    ----------
+    D : array-like
+        diameter in km
+    pv : array-like
+        geometric albedo
+    r, delta : array-like
+        heliocentric and observer-centric distances in au
+    w : array-like
+        wavelengths in micron (common to all rows)
+    eps : float
+        emissivity
+    G : float
+        slope parameter
+
+    Return
+    ------
+    flux : numpy.ndarray
+        flux densities in Jy with a shape of (N_row, N_band)
+    """
+    D, pv, r, delta = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(x, dtype=float)) for x in (D, pv, r, delta)])
+    w = np.atleast_1d(np.asarray(w, dtype=float))
+    A = bond_albedo(pv, G)
+    Tmax = ((1 - A)*S_sun/(np.pi*eps*sigma*r**2))**0.25
+
+    # Latitude: symmetric with respect to the equator
+    phi, w_phi = _gauss_legendre(N_phi, 0, np.pi/2)
+    T = Tmax[:, None]*np.cos(phi)[None, :]**0.25
+    weight = w_phi*np.cos(phi)**2*2
+
+    # Isothermal in longitude: integral of cos over the visible hemisphere is 2
+    sf = eps*(D*1e3)**2/(2*(delta*au_m)**2)
+    flux = np.empty((len(D), len(w)))
+    for idx_w, w_um in enumerate(w):
+        flux[:, idx_w] = sf*np.sum(planck_Jy(w_um, T)*weight, axis=1)
+    return flux
+
+
+def _calc_flux(mode, D, eta, H, r, delta, alpha, w, eps, G, nodes=None):
+    """
+    Calculate model fluxes with the albedo consistent with H and D.
+    """
+    pv = calc_pv(H, D)
+    if mode == 3:
+        return flux_FRM(D, pv, r, delta, w, eps, G)
+    else:
+        return flux_NEATM(D, pv, eta, r, delta, alpha, w, eps, G, nodes)
+
+
+def fit_tm(H, r, delta, alpha, w, flux, fluxerr, mode=1, eta=1.0,
+           eps=0.9, G=0.15, pv0=0.1, eta_range=(0.1, 10.0), chunk=2000):
+    """
+    Fit diameters (and beaming parameters) of all rows.
+
+    Parameters
+    ----------
+    H : float or array-like
+        absolute magnitude
+    r, delta : array-like
+        heliocentric and observer-centric distances in au
+    alpha : array-like
+        phase angle in degree
+    w : array-like
+        wavelengths in micron (common to all rows)
+    flux, fluxerr : array-like
+        flux densities and their uncertainties in Jy, (N_row, N_band)
+    mode : int
+        0 (NEATM fitting eta), 1 (NEATM w/ fixed eta), or 3 (FRM)
+    eta : float or array-like
+        beaming parameter (initial value when mode == 0)
+    eps : float
+        emissivity
+    G : float
+        slope parameter
+    pv0 : float
+        initial geometric albedo
+    eta_range : tuple of float
+        range of eta when mode == 0
+    chunk : int
+        number of rows solved at once
+
+    Return
+    ------
+    D, eta : numpy.ndarray
+        diameters in km and beaming parameters
+        (eta is always 1 in FRM, as in fittm; NaN for rows that did not converge)
+    """
+    if mode not in (0, 1, 3):
+        raise ValueError(f"Unknown model index: {mode} (0, 1, or 3)")
+    r = np.atleast_1d(np.asarray(r, dtype=float))
+    N = len(r)
+    H, delta, alpha, eta = [
+        np.broadcast_to(np.asarray(x, dtype=float), (N,)) for x in (H, delta, alpha, eta)]
+    w = np.atleast_1d(np.asarray(w, dtype=float))
+    flux = np.asarray(flux, dtype=float).reshape(N, len(w))
+    fluxerr = np.asarray(fluxerr, dtype=float).reshape(N, len(w))
+
+    D_res, eta_res = np.empty(N), np.empty(N)
+    for i0 in range(0, N, chunk):
+        s = slice(i0, min(i0 + chunk, N))
+        D_res[s], eta_res[s] = _fit_chunk(
+            mode, H[s], r[s], delta[s], alpha[s], w, flux[s], fluxerr[s],
+            eta[s], eps, G, pv0, eta_range)
+    if mode == 3:
+        eta_res[np.isfinite(D_res)] = 1.0
+    return D_res, eta_res
+
+
+def _initial_D(mode, eta, H, r, delta, alpha, w, flux, fluxerr, eps, G, pv0, lnD_min, nodes):
+    """
+    Initial diameter (D scaled with sqrt(flux ratio) once) and chi2 of each row.
+    """
+    D0 = calc_D(H, pv0)
+    f0 = _calc_flux(mode, D0, eta, H, r, delta, alpha, w, eps, G, nodes)
+    D0 = D0*np.sqrt(np.sum(flux*f0/fluxerr**2, axis=1)/np.sum(f0**2/fluxerr**2, axis=1))
+    # pv must be below the limit (A < 1)
+    with np.errstate(invalid="ignore"):
+        lnD0 = np.fmax(np.log(D0), lnD_min + 1e-3)
+    f = _calc_flux(mode, np.exp(lnD0), eta, H, r, delta, alpha, w, eps, G, nodes)
+    chi2 = np.sum(((f - flux)/fluxerr)**2, axis=1)
+    return lnD0, chi2
+
+
+def _fit_chunk(mode, H, r, delta, alpha, w, flux, fluxerr, eta, eps, G, pv0, eta_range):
+    """
+    Solve a chunk of rows as one sparse least-squares problem.
+    """
+    n, nb = flux.shape
+    fiteta = (mode == 0)
+    # Rows without valid fluxes are not fitted
+    valid = np.all(np.isfinite(flux) & np.isfinite(fluxerr) & (fluxerr > 0), axis=1)
+    if not valid.all():
+        D, eta_fit = np.full(n, np.nan), np.full(n, np.nan)
+        if valid.any():
+            D[valid], eta_fit[valid] = _fit_chunk(
+                mode, H[valid], r[valid], delta[valid], alpha[valid], w, flux[valid],
+                fluxerr[valid], eta[valid], eps, G, pv0, eta_range)
+        return D, eta_fit
+
+    # D at the maximum albedo
+    lnD_min = np.log(calc_D(H, A_max/(0.290 + 0.684*G)))
+    # Nodes of the quadrature are the same in all evaluations
+    nodes = None if mode == 3 else neatm_nodes(alpha)
+
+    x0, chi2 = _initial_D(mode, eta, H, r, delta, alpha, w, flux, fluxerr, eps, G, pv0, lnD_min, nodes)
+    lb, ub = np.array(lnD_min, dtype=float), np.full(n, np.inf)
+    lb = np.broadcast_to(lb, (n,)).copy()
+    if fiteta:
+        # Initial eta from a grid (D from eta = 1 may be far from the solution)
+        lneta0 = np.clip(np.log(eta), np.log(eta_range[0]), np.log(eta_range[1]))
+        for eta_i in eta_grid:
+            if not (eta_range[0] <= eta_i <= eta_range[1]):
+                continue
+            lnD_i, chi2_i = _initial_D(
+                mode, np.full(n, eta_i), H, r, delta, alpha, w, flux, fluxerr, eps, G, pv0, lnD_min, nodes)
+            better = chi2_i < chi2
+            x0, lneta0, chi2 = (
+                np.where(better, lnD_i, x0), np.where(better, np.log(eta_i), lneta0),
+                np.where(better, chi2_i, chi2))
+        x0 = np.concatenate([x0, lneta0])
+        lb = np.concatenate([lb, np.full(n, np.log(eta_range[0]))])
+        ub = np.concatenate([ub, np.full(n, np.log(eta_range[1]))])
+
+    def residual(x):
+        D = np.exp(x[:n])
+        eta_x = np.exp(x[n:]) if fiteta else eta
+        f = _calc_flux(mode, D, eta_x, H, r, delta, alpha, w, eps, G, nodes)
+        return ((f - flux)/fluxerr).ravel()
+
+    # Residuals of each row depend only on the parameters of the row
+    npar = 2 if fiteta else 1
+    sparsity = lil_matrix((n*nb, n*npar), dtype=int)
+    rows = np.arange(n*nb)
+    for idx_par in range(npar):
+        sparsity[rows, np.repeat(np.arange(n), nb) + idx_par*n] = 1
+
+    res = least_squares(
+        residual, x0, jac_sparsity=sparsity, bounds=(lb, ub), method="trf",
+        x_scale=1.0, xtol=1e-10, ftol=1e-10)
+    D = np.exp(res.x[:n])
+    eta_fit = np.exp(res.x[n:]) if fiteta else eta.copy()
+
+    # Rows with non-finite residuals or stuck at the albedo limit did not converge
+    fun = res.fun.reshape(n, nb)
+    failed = ~np.all(np.isfinite(fun), axis=1) | (res.x[:n] <= lnD_min + 1e-6)
+    if res.status <= 0:
+        failed[:] = True
+    D[failed] = np.nan
+    eta_fit[failed] = np.nan
+    return D, eta_fit
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parser of "f>" lines in the output of runtpm.
+
+runtpm writes one "f>" line per data point of the obs file:
+    f> iobs idata JD wavelength fobs sigma flux ...
+The number of columns depends on the version of runtpm and on Gamma
+(one more column when Gamma > 0). The new version is expected to write
+the emissivity after the wavelength, which shifts the flux.
+The layout is identified by the number of columns and Gamma, and the
+number of lines is checked against the number of data points in the obs
+file.
+
+Only layouts confirmed with real output of runtpm are accepted, since a
+flux read from a wrong column cannot be detected. The old layout is the
+one parsed since the first version of runtpm_NEOMIR.py (flux in the 7th
+column). The new layout has not been checked against real output yet;
+add "new" to fline_confirmed once it is. Only the flux column of the old
+layout is confirmed, so the wavelength column is compared with the obs
+file only for versions in fline_wavelength_confirmed (none yet).
+"""
+import numpy as np
+
+
+# Columns after "f>" of each version of runtpm
+# (version, Gamma > 0) -> names of columns
+# Columns after flux are kept but not interpreted.
+_old = ["iobs", "idata", "JD", "wavelength", "fobs", "sigma", "flux", "col8", "col9"]
+_new = ["iobs", "idata", "JD", "wavelength", "eps", "fobs", "sigma", "flux", "col9", "col10"]
+fline_layouts = {
+    ("old", False): _old,
+    ("old", True): _old + ["col10"],
+    ("new", False): _new,
+    ("new", True): _new + ["col11"],
+}
+# Versions whose layout was checked against real output of runtpm
+fline_confirmed = {"old"}
+# Versions whose wavelength column was checked against real output of runtpm
+fline_wavelength_confirmed = set()
+
+
+def detect_layout(N_col, Gamma):
+    """
+    Identify the layout of "f>" lines.
+
+    Parameters
+    ----------
+    N_col : int
+        number of columns after "f>"
+    Gamma : float
+        thermal inertia
+
+    Return
+    ------
+    version : str
+        version of runtpm (old or new)
+    names : list of str
+        names of columns
+    """
+    for (version, warm), names in fline_layouts.items():
+        if (warm == (Gamma > 0)) and (len(names) == N_col):
+            if version not in fline_confirmed:
+                raise ValueError(
+                    f"f> lines have {N_col} columns with Gamma={Gamma}, as in the {version} layout "
+                    f"(columns: {' '.join(names)}), but this layout has not been confirmed with real "
+                    f"output of runtpm. Check the column of flux in the output, then add "
+                    f"'{version}' to fline_confirmed in NEOMIR_tpmout.py")
+            return version, names
+    raise ValueError(
+        f"Unknown layout of f> lines: {N_col} columns with Gamma={Gamma} "
+        f"(known: {', '.join(f'{v} {len(n)}' for (v, w), n in fline_layouts.items() if w == (Gamma > 0))})")
+
+
+def parse_tpm_output(lines, Gamma, wavelengths=None):
+    """
+    Parse "f>" lines of runtpm at once.
+
+    Parameters
+    ----------
+    lines : list of str
+        lines starting with "f>"
+    Gamma : float
+        thermal inertia
+    wavelengths : array-like, optional
+        wavelengths in micron in the obs file (the number of lines is checked
+        if given, and the wavelength column for fline_wavelength_confirmed)
+
+    Return
+    ------
+    rec : numpy.ndarray
+        structured array with a row per line (e.g., rec["flux"] in Jy)
+    """
+    if not lines:
+        raise ValueError("No f> lines in the output")
+    N_col = len(lines[0].split()) - 1
+    version, names = detect_layout(N_col, Gamma)
+
+    # Tokenize all lines once
+    tokens = "".join(line[2:] if line.endswith("\n") else f"{line[2:]}\n" for line in lines).split()
+    if len(tokens) != N_col*len(lines):
+        raise ValueError(
+            f"Lines have different numbers of columns ({len(tokens)} values in {len(lines)} lines of {N_col} columns)")
+    arr = np.array(tokens, dtype=float).reshape(len(lines), N_col)
+
+    if wavelengths is not None:
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        if len(arr) != len(wavelengths):
+            raise ValueError(
+                f"{len(arr)} f> lines in the output for {len(wavelengths)} wavelengths in the obs file")
+        if (version in fline_wavelength_confirmed) and not np.allclose(arr[:, names.index("wavelength")], wavelengths):
+            raise ValueError(
+                f"Wavelengths in the output ({version} layout) do not match the obs file: "
+                f"{arr[:, names.index('wavelength')].tolist()} vs. {wavelengths.tolist()}")
+
+    rec = np.empty(len(arr), dtype=[(name, "f8") for name in names])
+    for idx, name in enumerate(names):
+        rec[name] = arr[:, idx]
+    return rec
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the analysis hot paths.
+
+Results in data/tpmout_* and synthetic copies with 10x and 100x objects
+(symbolic links to the same files with new object ids) are used.
+Time, throughput, and peak memory (tracemalloc, in a separate run so as
+not to slow down the timing) are saved in a JSON file with the git commit,
+so that runs can be compared among commits. Caches of geometry, obs
+files, and triangulations are cleared before each run, so that both runs
+start cold.
+
+Benchmarks
+    handle_tpmres      : loading with handle_tpmres
+    aggregate_tpmres   : statistics of fluxes per TI and sense read chunk by chunk
+    read_tpmres_neomir : loading in calc_D_fittm.py
+    calc_aspect        : r, delta, and alpha of every row
+    join_geometry      : r, delta, and alpha once per object joined to rows
+    fit_tm             : NEATM fitting of 2 bands (numpy backend)
+    run_fittm          : NEATM fitting with fittm (if fittm is found)
+    griddata           : cubic interpolation of maps with griddata
+    interpolate_maps   : interpolation with a shared triangulation
+    render             : rendering of flux maps
+
+Run all benchmarks at 1x, 10x, and 100x:
+    python src/bench_NEOMIR.py --resdir data/tpmout_original --out bench.json
+"""
+from argparse import ArgumentParser as ap
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from scipy.interpolate import griddata
+
+import NEOMIR_common
+import NEOMIR_geometry
+import NEOMIR_poles
+from NEOMIR_common import (
+    handle_tpmres, load_tpmres, list_tpmres, list_objid, load_geometry,
+    join_geometry, calc_aspect, Gamma_values)
+from NEOMIR_thermal import fit_tm
+from NEOMIR_poles import interpolate_pole_maps
+from NEOMIR_stats import aggregate_tpmres
+from calc_D_fittm import read_tpmres_neomir, run_fittm
+from plot_8flux_map import plot_flux_map, make_mesh, sf
+
+
+bench_names = [
+    "handle_tpmres", "aggregate_tpmres", "read_tpmres_neomir", "calc_aspect",
+    "join_geometry", "fit_tm", "run_fittm", "griddata", "interpolate_maps", "render"]
+
+
+def make_scaled_copy(resdir, scale, workdir):
+    """
+    Make a directory with scale x objects of resdir (symbolic links).
+
+    Parameters
+    ----------
+    resdir : str
+        directory with TI*_res_*.txt
+    scale : int
+        number of copies
+    workdir : str
+        directory where the copy is made
+
+    Return
+    ------
+    outdir : str
+        directory of the copy (resdir itself if scale == 1)
+    """
+    if scale == 1:
+        return resdir
+    outdir = os.path.join(workdir, f"{os.path.basename(os.path.normpath(resdir))}_x{scale}")
+    if os.path.isdir(outdir):
+        return outdir
+    os.makedirs(outdir)
+    files = list_tpmres(resdir)
+    N_obj = max(x[2] for x in files)
+    for k in range(scale):
+        for path, TI, objid in files:
+            os.symlink(
+                os.path.abspath(path),
+                os.path.join(outdir, f"TI{TI}_res_{objid + k*N_obj:03d}.txt"))
+    return outdir
+
+
+def clear_caches():
+    """
+    Clear caches of geometry, obs files, and triangulations kept in this process.
+    """
+    NEOMIR_geometry._geometry_cache.clear()
+    NEOMIR_poles._interpolators.clear()
+    NEOMIR_common._obs_files.clear()
+    NEOMIR_common._obs_tables.clear()
+
+
+def measure(func, memory=True):
+    """
+    Measure the elapsed time (and peak memory in a second run) of func().
+
+    Caches are cleared before each run, so that the second run does not
+    reuse what the first one has read.
+
+    Return
+    ------
+    seconds : float
+        elapsed time in s
+    peak_MB : float or None
+        peak memory allocated in the call in MB
+    """
+    clear_caches()
+    gc.collect()
+    t0 = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - t0
+
+    peak_MB = None
+    if memory:
+        clear_caches()
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak_MB = tracemalloc.get_traced_memory()[1]/1024**2
+        tracemalloc.stop()
+    return seconds, peak_MB
+
+
+def bench_scale(name, resdir, args):
+    """
+    Prepare a benchmark of a directory.
+
+    Return
+    ------
+    func : callable
+        function to be measured (None if not available)
+    N : int
+        number of items processed by func
+    unit : str
+        name of items
+    """
+    objid = list_objid(resdir)
+    if name == "handle_tpmres":
+        N = len(list_tpmres(resdir))
+        return lambda: handle_tpmres(resdir), N, "files"
+    elif name == "aggregate_tpmres":
+        N = len(list_tpmres(resdir))
+        return (
+            lambda: aggregate_tpmres(resdir, ["lon", "lat", "flux5", "flux8"], ("TI", "sense")),
+            N, "files")
+    elif name == "read_tpmres_neomir":
+        N = len(list_tpmres(resdir))
+        return lambda: read_tpmres_neomir(resdir, objid, Gamma_values), N, "files"
+    elif name == "calc_aspect":
+        df = load_tpmres(resdir, columns=["X", "Y", "Z", "MirX", "MirY", "MirZ"])
+        return lambda: calc_aspect(df), len(df), "rows"
+    elif name == "join_geometry":
+        df = load_tpmres(resdir, columns=["lon"])
+        return lambda: join_geometry(df, load_geometry(resdir, objid)), len(df), "rows"
+
+    # Fitting, interpolation, and rendering use a subset of rows or objects
+    elif name in ("fit_tm", "run_fittm"):
+        if (name == "run_fittm") and (shutil.which("fittm") is None):
+            return None, 0, "rows"
+        df = load_tpmres(resdir, objid=objid[:args.nobj_fit], columns=["flux5", "flux8"])
+        df = join_geometry(df, load_geometry(resdir, objid[:args.nobj_fit]))
+        df = df.iloc[:args.nfit]
+        flux = df[["flux5", "flux8"]].values*1e-6
+        r, delta, alpha = df["r"].values, df["delta"].values, df["alpha"].values
+        H, eta = 18.118, 1.0
+        if name == "fit_tm":
+            return (
+                lambda: fit_tm(H, r, delta, alpha, [5, 8], flux, flux*0.1, mode=0, eta=eta),
+                len(df), "rows")
+        lines = [
+            f"{H} 0.15 0.9 {eta} 0.1 {r[i]} {delta[i]} {alpha[i]} "
+            f"5 {flux[i, 0]} {flux[i, 0]*0.1} 8 {flux[i, 1]} {flux[i, 1]*0.1}\n"
+            for i in range(len(df))]
+        return lambda: run_fittm(lines, 0, nproc=args.nproc), len(df), "rows"
+    elif name in ("griddata", "interpolate_maps", "render"):
+        N_obj = args.nfig if name == "render" else len(objid)
+        df = load_tpmres(resdir, objid=objid[:N_obj], TI=Gamma_values, columns=["lon", "lat", "flux8"])
+        maps = [
+            (d["lon"].values, d["lat"].values, d["flux8"].values*sf)
+            for _, d in df.groupby(["objid", "TI"])]
+        lon_mesh, lat_mesh = make_mesh()
+        if name == "griddata":
+            return (
+                lambda: [griddata((lam, beta), f, (lon_mesh, lat_mesh), method="cubic") for lam, beta, f in maps],
+                len(maps), "maps")
+        elif name == "interpolate_maps":
+            return lambda: interpolate_pole_maps(maps, lon_mesh, lat_mesh), len(maps), "maps"
+        grids = interpolate_pole_maps(maps, lon_mesh, lat_mesh)
+        out = os.path.join(args.workdir, "bench_render.jpg")
+        N_Gamma = len(Gamma_values)
+
+        def render():
+            for n in range(N_obj):
+                plot_flux_map(
+                    grids[n*N_Gamma:(n + 1)*N_Gamma], 1.0, 0.2, 30.0, out,
+                    Gamma_values, 20.0, 400.0, "inferno")
+        return render, N_obj, "figures"
+    assert False, f"Unknown benchmark: {name}"
+
+
+def git_commit():
+    """
+    Return the git commit of this script (None if not in a repository).
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = ap(description="Benchmarks of the analysis hot paths.")
+    parser.add_argument(
+        "--resdir", type=str, default="data/tpmout_original",
+        help="Directory with output files")
+    parser.add_argument(
+        "--scales", type=int, nargs="*", default=[1, 10, 100],
+        help="Number of copies of objects")
+    parser.add_argument(
+        "--bench", type=str, nargs="*", default=bench_names, choices=bench_names,
+        help="Benchmarks to be run")
+    parser.add_argument(
+        "--nfit", type=int, default=2000,
+        help="Number of rows for fitting")
+    parser.add_argument(
+        "--nobj_fit", type=int, default=10,
+        help="Number of objects for fitting")
+    parser.add_argument(
+        "--nfig", type=int, default=2,
+        help="Number of figures for rendering")
+    parser.add_argument(
+        "--nproc", type=int, default=os.cpu_count(),
+        help="Number of processes for fittm")
+    parser.add_argument(
+        "--nomemory", action="store_true", default=False,
+        help="Do not measure peak memory (faster)")
+    parser.add_argument(
+        "--workdir", type=str, default=None,
+        help="Directory for scaled copies (temporary by default)")
+    parser.add_argument(
+        "--out", type=str, default="bench_NEOMIR.json",
+        help="Output JSON file")
+    args = parser.parse_args()
+
+    keep = args.workdir is not None
+    if not keep:
+        args.workdir = tempfile.mkdtemp(prefix="neomir_bench_")
+    os.makedirs(args.workdir, exist_ok=True)
+
+    # Rows, fits, and maps do not depend on the scale
+    scaled = ["handle_tpmres", "aggregate_tpmres", "read_tpmres_neomir", "calc_aspect", "join_geometry", "griddata", "interpolate_maps"]
+
+    results = []
+    try:
+        for scale in args.scales:
+            resdir = make_scaled_copy(args.resdir, scale, args.workdir)
+            for name in args.bench:
+                if (scale != args.scales[0]) and (name not in scaled):
+                    continue
+                func, N, unit = bench_scale(name, resdir, args)
+                if func is None:
+                    print(f"{name:>20s} x{scale:<4d}: skipped")
+                    continue
+                seconds, peak_MB = measure(func, memory=not args.nomemory)
+                res = dict(
+                    name=name, scale=scale, N=N, unit=unit, seconds=seconds,
+                    throughput=N/seconds, peak_MB=peak_MB)
+                results.append(res)
+                peak = "" if peak_MB is None else f", peak {peak_MB:.1f} MB"
+                print(f"{name:>20s} x{scale:<4d}: {seconds:8.3f} s, {N/seconds:10.1f} {unit}/s{peak}")
+    finally:
+        if not keep:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    info = dict(
+        commit=git_commit(), date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        host=platform.node(), python=sys.version.split()[0], numpy=np.__version__,
+        ncpu=os.cpu_count(), resdir=args.resdir, results=results)
+    with open(args.out, "w") as f:
+        json.dump(info, f, indent=2)
+    print(f"Saved {args.out}")
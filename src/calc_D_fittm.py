@@ -4,12 +4,18 @@
 Calculate diameter with NEATM/FRM.
 """
 import numpy as np
-import pandas as pd
 import subprocess, os
+import time
 from argparse import ArgumentParser as ap
+from concurrent.futures import ProcessPoolExecutor
 
+from NEOMIR_common import load_tpmres, list_objid, load_geometry, join_geometry
+from NEOMIR_thermal import fit_tm
+from NEOMIR_metrics import MetricsLog, child_cpu_time
+from NEOMIR_catalog import TPMCatalog, default_campaign
 
-def read_tpmres_neomir(resdir, idx_plot, Gamma_valuea):
+
+def read_tpmres_neomir(resdir, idx_plot, Gamma_values, catalog=None, campaign=None):
     """
 
     Parameters
@@ -20,61 +26,132 @@ def read_tpmres_neomir(resdir, idx_plot, Gamma_valuea):
         index of objects to be analyzed
     Gamma_values : array-like
         thermal inertia
+    catalog : TPMCatalog, optional
+        catalog queried instead of reading files in resdir
+    campaign : str, optional
+        name of the campaign in the catalog (name of resdir by default)
     """
     # Read lam, beta, flux, TI, objid
-    df_list = []
-    for idx_obj in idx_plot:
-        print(f"READ results of OBJ{idx_obj:03d}")
-        
-        # Loop over each Gamma value to load data and generate a plot
-        for idx, Gamma in enumerate(Gamma_values):
-            filename = f"TI{Gamma}_res_{idx_obj:03d}.txt"  # Load the corresponding Gamma file
-            filename = os.path.join(resdir, filename)
-            data = np.loadtxt(filename)
-
-            # Extract columns: lon, lat, flux5, flux8,  x1, y1, z1, x2, y2, z2
-            D, lon, lat  = data[:, 1], data[:, 2], data[:, 3], 
-            flux5, flux8 = data[:, 4], data[:, 5]
-            x1, y1, z1   = data[:, 6], data[:, 7], data[:, 8]
-            x2, y2, z2   = data[:, 9], data[:, 10], data[:, 11]
-
-            df = pd.DataFrame(dict(
-                D=D, lon=lon, lat=lat, flux5=flux5, flux8=flux8,
-                X=x1, Y=y1, Z=z1, MirX=x2, MirY=y2, MirZ=z2
-                ))
-            df["TI"] = Gamma
-            df["objid"] = idx_obj
-
-            df_list.append(df)
-    df = pd.concat(df_list)
+    print(f"READ results of {len(idx_plot)} objects")
+    columns = ["D", "lon", "lat", "flux5", "flux8"]
+    if catalog is not None:
+        return catalog.query(
+            campaign or default_campaign(resdir), objid=idx_plot, TI=Gamma_values,
+            columns=columns)
+    df = load_tpmres(
+        resdir, objid=idx_plot, TI=Gamma_values, columns=columns)
     return df
 
 
-def calc_aspect(df):
+def run_fittm_batch(lines, N_model, t_submit=None):
     """
-    Calculate alpha, delta, and r.
+    Run a single fittm process for a batch of input rows.
 
-    Parameter
-    ---------
-    df : pandas.DataFrame
-        input dataframe
+    Parameters
+    ----------
+    lines : list of str
+        input rows of fittm (one object per line)
+    N_model : int
+        model index passed to fittm with -m
+    t_submit : float, optional
+        time when the batch was submitted (for queue wait)
 
     Return
     ------
-    df : pandas.DataFrame
-        output dataframe
+    res : list of tuple
+        (D, eta) for each input row
+    metrics : dict
+        timings in s and output size (see NEOMIR_metrics.py)
     """
-    S = np.array([df['X'].values, df['Y'].values, df['Z'].values]).T
-    normaS = np.sqrt(np.sum(S**2, axis=1))
-    O = np.array([df['MirX'].values, df['MirY'].values, df['MirZ'].values]).T
-    normaO = np.sqrt(np.sum(O**2, axis=1))
-    SO = S*O
-    pha = np.arccos(np.sum(SO, axis=1)/normaO/normaS)*180/np.pi
-   
-    df["r"] = normaS
-    df["delta"] = normaO
-    df["alpha"] = pha
-    return df
+    t_start, cpu_start = time.time(), child_cpu_time()
+    cmd = ["fittm", "-m", str(N_model)]
+    p = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, text=True)
+    t_spawn = time.time()
+    stdout, stderr = p.communicate("".join(lines))
+    t_exit = time.time()
+    # A crashed fittm may have printed complete records of a part of the rows
+    if p.returncode != 0:
+        tail = "\n".join(stderr.rstrip().splitlines()[-10:])
+        raise RuntimeError(
+            f"fittm exited with code {p.returncode}: {' '.join(cmd)}"
+            + (f"\n{tail}" if tail else ""))
+    # Parse "o>" records in the same order as the input rows
+    res = [l.split() for l in stdout.splitlines() if l.startswith("o>")]
+    if len(res) != len(lines):
+        raise ValueError(
+            f"fittm returned {len(res)} 'o>' records for {len(lines)} rows. "
+            "Use --batch 1 if your fittm reads only one row per call.")
+    res = [(float(r[1]), float(r[5])) for r in res]
+    t_end = time.time()
+    metrics = dict(
+        queue_wait=None if t_submit is None else t_start - t_submit,
+        spawn=t_spawn - t_start, wall=t_exit - t_start,
+        cpu=child_cpu_time() - cpu_start, parse=t_end - t_exit,
+        out_bytes=len(stdout), pid=os.getpid(), t_start=t_start, t_end=t_end)
+    return res, metrics
+
+
+def run_fittm(lines, N_model, nproc=1, batch=1, metrics=None, keys=None):
+    """
+    Run fittm for all input rows with a pool of worker processes.
+
+    Parameters
+    ----------
+    lines : list of str
+        input rows of fittm
+    N_model : int
+        model index passed to fittm with -m
+    nproc : int
+        number of worker processes
+    batch : int
+        number of rows sent to a single fittm process
+    metrics : MetricsLog, optional
+        log where timings of each batch are written
+    keys : list of dict, optional
+        key of each row written with its batch (e.g., objid, Gamma, lam, beta
+        of the first row)
+
+    Return
+    ------
+    D_list, eta_list : list of float
+        diameters and beaming parameters in the original row order
+    """
+    batches = [lines[i:i+batch] for i in range(0, len(lines), batch)]
+    D_list, eta_list = [], []
+
+    def write_metrics(n, status="ok", **fields):
+        if metrics is not None:
+            key = {} if keys is None else keys[n*batch]
+            metrics.write(
+                "task", **key, batch=n, row=n*batch, rows=len(batches[n]),
+                status=status, **fields)
+
+    if metrics is not None:
+        metrics.write(
+            "start", N_task=len(batches), N_row=len(lines), N_proc=nproc,
+            batch=batch, model=N_model)
+    with ProcessPoolExecutor(max_workers=nproc) as executor:
+        # map keeps the order of the batches
+        res_batches = executor.map(
+            run_fittm_batch, batches, [N_model]*len(batches),
+            [time.time()]*len(batches))
+        for n in range(len(batches)):
+            try:
+                res, timings = next(res_batches)
+            except Exception as e:
+                write_metrics(n, status="error", error=str(e))
+                raise
+            write_metrics(n, **timings)
+            if (len(D_list)//1000) != ((len(D_list) + len(res))//1000):
+                print(f"  {len(D_list) + len(res)}/{len(lines)}")
+            for D, eta in res:
+                D_list.append(D)
+                eta_list.append(eta)
+    if metrics is not None:
+        metrics.write("end")
+    return D_list, eta_list
 
 
 if __name__ == "__main__":
@@ -103,6 +180,27 @@ if __name__ == "__main__":
     parser.add_argument(
         "--outdir", type=str, default="data",
         help="Directory for output file")
+    parser.add_argument(
+        "--nproc", type=int, default=os.cpu_count(),
+        help="Number of fittm processes running in parallel")
+    parser.add_argument(
+        "--batch", type=int, default=1,
+        help="Number of rows sent to a single fittm process")
+    parser.add_argument(
+        "--backend", type=str, default="fittm", choices=["fittm", "numpy"],
+        help="Solver (fittm or numpy)")
+    parser.add_argument(
+        "--crosscheck", type=int, default=0,
+        help="Number of rows compared with fittm (only for numpy backend)")
+    parser.add_argument(
+        "--metrics", type=str, default=None,
+        help="JSON-lines file where timings of each fittm batch are appended")
+    parser.add_argument(
+        "--catalog", type=str, default=None,
+        help="SQLite catalog queried instead of files in resdir")
+    parser.add_argument(
+        "--campaign", type=str, default=None,
+        help="Campaign in the catalog (name of resdir by default)")
     args = parser.parse_args()
 
     resdir = args.resdir
@@ -139,60 +237,89 @@ if __name__ == "__main__":
         etafit  = 0
         print("Use FRM")
     
+    catalog = TPMCatalog(args.catalog) if args.catalog else None
+    campaign = args.campaign or default_campaign(resdir)
     if args.all:
         # Try to find object id
-        filenames = [f.name for f in os.scandir(resdir)]
-        # Extract object id from TI150_res_012.txta
-        filenames_part = [f.split("_")[-1] for f in filenames]
-        idx_plot = [int(f.split(".")[0]) for f in filenames_part]
-        idx_plot = list(set(idx_plot))
+        idx_plot = catalog.list_objid(campaign) if catalog else list_objid(resdir)
     else:
         idx_plot = args.idx_obj
     
-    df = read_tpmres_neomir(resdir, idx_plot, Gamma_values)
+    df = read_tpmres_neomir(resdir, idx_plot, Gamma_values, catalog, campaign)
 
-    # Calculate alpha, r, and delta
-    df = calc_aspect(df)
+    # Add alpha, r, and delta of each object
+    geom = catalog.load_geometry(campaign, idx_plot) if catalog else load_geometry(resdir, idx_plot)
+    df = join_geometry(df, geom)
 
     eta = args.eta
     print("Parameters for NEATM")
     print(f"  H={H}, eta={eta}")
-    D_NEATM_list = []
-    eta_NEATM_list = []
     df = df.reset_index(drop=True)
 
-    for idx, row in df.iterrows():
-        if (idx%1000)==0:
-            print(f"  {idx}/{len(df)}")
-        # Convert micronJy to Jy
-        flux5 = row[key_flux5]*1e-6
-        flux8 = row[key_flux8]*1e-6
-        fluxerr5 = flux5*0.1
-        fluxerr8 = flux8*0.1
-        lon   = row["lon"]
-        lat   = row["lat"]
-        r     = row["r"]
-        delta = row["delta"]
-        alpha = row["alpha"]
-        
-        # Use 2-bands
-        # Note: eta is not used in FRM. (output is always eta of 1)
-        #       So of cource eta is not fit in FRM.
-        if args.fiteta:
-            # TODO: {w5} {flux5} {fluxerr5} {w8} {flux8} {fluxerr8} and 
-            #       {w8} {flux8} {fluxerr8} {w5} {flux5} {fluxerr5} give different results?
-            cmd = f'echo {H} 0.15 0.9 {eta} 0.1 {r} {delta} {alpha} {w5} {flux5} {fluxerr5} {w8} {flux8} {fluxerr8} | fittm -m {N_model} | grep "o>"'
-        # Use only 8 micron
-        else:
-            cmd = f'echo {H} 0.15 0.9 {eta} 0.1 {r} {delta} {alpha} {w8} {flux8} {fluxerr8} | fittm -m {N_model} | grep "o>"'
-        p = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-        comm = p.communicate()
-        res = comm[0].decode("ascii").split()
-        D_NEATM = float(res[1])
-        eta_NEATM = float(res[5])
-        # Diameter in km
-        D_NEATM_list.append(D_NEATM)
-        eta_NEATM_list.append(eta_NEATM)
+    # Convert micronJy to Jy
+    flux5 = df[key_flux5].values*1e-6
+    flux8 = df[key_flux8].values*1e-6
+    fluxerr5 = flux5*0.1
+    fluxerr8 = flux8*0.1
+    r, delta, alpha = df["r"].values, df["delta"].values, df["alpha"].values
+
+    # Use 2-bands
+    # Note: eta is not used in FRM. (output is always eta of 1)
+    #       So of cource eta is not fit in FRM.
+    if args.fiteta:
+        # TODO: {w5} {flux5} {fluxerr5} {w8} {flux8} {fluxerr8} and 
+        #       {w8} {flux8} {fluxerr8} {w5} {flux5} {fluxerr5} give different results?
+        w_list = [w5, w8]
+        flux = np.array([flux5, flux8]).T
+        fluxerr = np.array([fluxerr5, fluxerr8]).T
+    # Use only 8 micron
+    else:
+        w_list = [w8]
+        flux = np.array([flux8]).T
+        fluxerr = np.array([fluxerr8]).T
+
+    # Object, Gamma, and pole of each row for metrics
+    metrics = MetricsLog(args.metrics, "fittm") if args.metrics else None
+    row_keys = [
+        dict(objid=int(o), Gamma=int(g), lam=float(l), beta=float(b))
+        for o, g, l, b in zip(df["objid"], df["TI"], df["lon"], df["lat"])] if metrics else None
+
+    def make_fittm_input(idx_rows):
+        bands = [
+            " ".join(f"{w} {flux[i, j]} {fluxerr[i, j]}" for j, w in enumerate(w_list))
+            for i in idx_rows]
+        return [
+            f"{H} 0.15 0.9 {eta} 0.1 {r[i]} {delta[i]} {alpha[i]} {b}\n"
+            for i, b in zip(idx_rows, bands)]
+
+    # Diameter in km
+    if args.backend == "fittm":
+        lines = make_fittm_input(range(len(df)))
+        D_NEATM_list, eta_NEATM_list = run_fittm(
+            lines, N_model, nproc=args.nproc, batch=args.batch,
+            metrics=metrics, keys=row_keys)
+    else:
+        D_NEATM_list, eta_NEATM_list = fit_tm(
+            H, r, delta, alpha, w_list, flux, fluxerr, mode=N_model, eta=eta,
+            eps=0.9, G=0.15, pv0=0.1)
+        N_fail = int(np.sum(np.isnan(D_NEATM_list)))
+        if N_fail:
+            print(f"  {N_fail}/{len(df)} rows did not converge (D and eta are NaN)")
+
+        if args.crosscheck:
+            # Compare with fittm using randomly selected rows
+            rng = np.random.default_rng(0)
+            N_check = min(args.crosscheck, len(df))
+            idx_check = np.sort(rng.choice(len(df), N_check, replace=False))
+            lines = make_fittm_input(idx_check)
+            D_fittm, eta_fittm = run_fittm(
+                lines, N_model, nproc=args.nproc, batch=args.batch, metrics=metrics,
+                keys=None if row_keys is None else [row_keys[i] for i in idx_check])
+            D_ratio = D_NEATM_list[idx_check]/np.array(D_fittm)
+            eta_diff = eta_NEATM_list[idx_check] - np.array(eta_fittm)
+            print(f"Cross-check with fittm (N={N_check})")
+            print(f"  D(numpy)/D(fittm): median={np.median(D_ratio):.4f}, min={np.min(D_ratio):.4f}, max={np.max(D_ratio):.4f}")
+            print(f"  eta(numpy)-eta(fittm): median={np.median(eta_diff):.4f}, min={np.min(eta_diff):.4f}, max={np.max(eta_diff):.4f}")
 
     df["D_NEATM"] = D_NEATM_list
     df["D_true"] = D_true
@@ -205,3 +332,5 @@ if __name__ == "__main__":
     outdir = args.outdir
     out = os.path.join(outdir, out)
     df.to_csv(out, sep=" ")
+    if metrics is not None:
+        metrics.close()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Convert text outputs of runtpm_NEOMIR.py to a columnar store.
+"""
+from argparse import ArgumentParser as ap
+import time
+
+from NEOMIR_common import convert_tpmres
+
+
+if __name__ == "__main__":
+    parser = ap(description="Convert TPM results to a columnar store.")
+    parser.add_argument(
+        "resdir", type=str,
+        help="Directory with output files of runtpm_NEOMIR.py")
+    parser.add_argument(
+        "store", type=str,
+        help="Directory of the output store")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    nrows = convert_tpmres(args.resdir, args.store)
+    print(f"Saved {nrows} rows in {args.store} ({time.time() - t0:.1f} s)")
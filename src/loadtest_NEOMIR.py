@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load tests of the orchestration of runtpm and fittm with fake programs.
+
+main_tpm of runtpm_NEOMIR.py and run_fittm of calc_D_fittm.py are run
+with src/fakebin first in PATH (see NEOMIR_fake.py) for every pair of
+campaign size (number of objects) and number of processes.
+Each call of a fake program is logged, from which the following are
+reported:
+    tasks/s     : calls (simulations or fittm batches) per second
+    util        : time spent in fake programs / (wall time x processes)
+    p50/p95/p99 : latency of calls in s
+    gap         : median time between calls of a worker in s
+                  (overhead of the orchestration per task, including the
+                  start-up of the interpreter of fake programs)
+
+Run runtpm with 1, 2, 4, and 8 processes and 1 and 4 objects:
+    python src/loadtest_NEOMIR.py --target runtpm --nobj 1 4 --nproc 1 2 4 8 --latency 0.05
+"""
+from argparse import ArgumentParser as ap
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import tempfile
+import contextlib
+import numpy as np
+
+import NEOMIR_fake
+from NEOMIR_fake import fake_env, read_fake_log
+from NEOMIR_common import format_obs, format_eph, obs_wavelengths
+from NEOMIR_spin import SpinStager
+from NEOMIR_thermal import flux_NEATM
+from runtpm_NEOMIR import main_tpm
+from calc_D_fittm import run_fittm
+
+
+fakebin = os.path.join(os.path.dirname(os.path.abspath(NEOMIR_fake.__file__)), "fakebin")
+targets = ["runtpm", "fittm"]
+
+
+def make_campaign(N_obj, workdir, seed=0):
+    """
+    Make obs and eph files of a synthetic campaign.
+
+    Parameters
+    ----------
+    N_obj : int
+        number of objects
+    workdir : str
+        directory where obs, eph, and obj files are made
+    seed : int
+        seed of positions
+
+    Return
+    ------
+    obs_list, eph_list : list of str
+        obs and eph files
+    obj : str
+        (dummy) shape model
+    """
+    rng = np.random.default_rng(seed)
+    for d in ["obs", "eph"]:
+        os.makedirs(os.path.join(workdir, d), exist_ok=True)
+    obs_list, eph_list = [], []
+    t0, t1 = 2460000.5, 2460001.5
+    for n in range(N_obj):
+        # Asteroid at 1-2 au and the observer within 0.5 au
+        u = rng.normal(size=3)
+        pos = u/np.linalg.norm(u)*rng.uniform(1.0, 2.0)
+        mir = -pos/np.linalg.norm(pos)*rng.uniform(0.05, 0.5) + rng.normal(scale=0.05, size=3)
+        obs = os.path.join(workdir, "obs", f"obs_{n+1:03d}.txt")
+        eph = os.path.join(workdir, "eph", f"eph_{n+1:03d}.txt")
+        with open(obs, "w") as f:
+            f.write(format_obs(pos, mir, t0, obs_wavelengths))
+        with open(eph, "w") as f:
+            f.write(format_eph(pos, t0, t1))
+        obs_list.append(obs)
+        eph_list.append(eph)
+    obj = os.path.join(workdir, "fake.obj")
+    with open(obj, "w") as f:
+        f.write("# dummy shape model (not read by the fake runtpm)\n")
+    return obs_list, eph_list, obj
+
+
+def make_fittm_lines(N_row, seed=0):
+    """
+    Make input rows of fittm with NEATM fluxes at 5 and 8 micron.
+    """
+    rng = np.random.default_rng(seed)
+    H, D, pv, eta = 18.118, 1.0, 0.1, 1.0
+    r = rng.uniform(1.0, 2.0, N_row)
+    delta = rng.uniform(0.1, 1.0, N_row)
+    alpha = rng.uniform(10, 80, N_row)
+    flux = flux_NEATM(D, pv, eta, r, delta, alpha, [5, 8])
+    return [
+        f"{H} 0.15 0.9 {eta} {pv} {r[i]} {delta[i]} {alpha[i]} "
+        f"5 {flux[i, 0]} {flux[i, 0]*0.1} 8 {flux[i, 1]} {flux[i, 1]*0.1}\n"
+        for i in range(N_row)]
+
+
+def summarize_calls(calls, wall, N_proc):
+    """
+    Throughput, utilization, and latency of calls of fake programs.
+
+    Parameters
+    ----------
+    calls : list of dict
+        calls in the log (see read_fake_log)
+    wall : float
+        elapsed time of the run in s
+    N_proc : int
+        number of processes
+
+    Return
+    ------
+    stats : dict
+        statistics of the run
+    """
+    latency = np.array([c["end"] - c["start"] for c in calls])
+    # Gaps between consecutive calls of a worker process
+    gaps = []
+    for ppid in set(c["ppid"] for c in calls):
+        t = sorted((c["start"], c["end"]) for c in calls if c["ppid"] == ppid)
+        gaps += [s1 - e0 for (_, e0), (s1, _) in zip(t[:-1], t[1:])]
+    if len(latency) == 0:
+        latency = np.array([np.nan])
+    stats = dict(
+        N_call=len(calls), N_fail=sum(c["status"] != 0 for c in calls),
+        N_row=sum(c["N_row"] for c in calls), wall=wall,
+        tasks_per_s=len(calls)/wall if wall > 0 else np.nan,
+        util=float(np.nansum(latency)/(wall*N_proc)) if wall > 0 else np.nan,
+        p50=float(np.percentile(latency, 50)), p95=float(np.percentile(latency, 95)),
+        p99=float(np.percentile(latency, 99)),
+        gap=float(np.median(gaps)) if gaps else np.nan)
+    return stats
+
+
+def run_load(target, N_obj, N_proc, args, workdir):
+    """
+    Run the orchestration of a target once.
+
+    Return
+    ------
+    stats : dict
+        statistics of the run (see summarize_calls)
+    """
+    log = os.path.join(workdir, f"fake_{target}.log")
+    if os.path.isfile(log):
+        os.remove(log)
+    os.environ["NEOMIR_FAKE_LOG"] = log
+    # Output of main_tpm is not shown unless --verbose
+    out = sys.stdout if args.verbose else io.StringIO()
+    error = None
+
+    if target == "runtpm":
+        campdir = os.path.join(workdir, f"camp_{N_obj}")
+        obs_list, eph_list, obj = make_campaign(N_obj, campdir, args.seed)
+        outdir = os.path.join(campdir, f"out_{N_proc}")
+        os.makedirs(outdir, exist_ok=True)
+        spin = SpinStager()
+        t0 = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(out):
+                main_tpm(
+                    obs_list, eph_list, obj, args.npole, 0.0968, args.gamma,
+                    spin, outdir, N_proc)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        wall = time.perf_counter() - t0
+        spin.cleanup()
+        N_task = N_obj*len(args.gamma)*args.npole
+    elif target == "fittm":
+        lines = make_fittm_lines(N_obj*len(args.gamma)*args.npole, args.seed)
+        t0 = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(out):
+                run_fittm(lines, 1, nproc=N_proc, batch=args.batch)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        wall = time.perf_counter() - t0
+        N_task = -(-len(lines)//args.batch)
+    else:
+        assert False, f"Unknown target: {target}"
+
+    stats = summarize_calls(read_fake_log(log), wall, N_proc)
+    stats.update(target=target, N_obj=N_obj, N_proc=N_proc, N_task=N_task, error=error)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = ap(description="Load tests of runtpm/fittm orchestration with fake programs.")
+    parser.add_argument(
+        "--target", type=str, nargs="*", default=targets, choices=targets,
+        help="Orchestration to be tested")
+    parser.add_argument(
+        "--nobj", type=int, nargs="*", default=[1, 4],
+        help="Numbers of objects (campaign sizes)")
+    parser.add_argument(
+        "--nproc", type=int, nargs="*", default=[1, 2, 4, 8],
+        help="Numbers of processes")
+    parser.add_argument(
+        "--npole", type=int, default=20,
+        help="Number of poles per object and Gamma")
+    parser.add_argument(
+        "--gamma", type=int, nargs="*", default=[0, 50, 150, 300, 500, 1000],
+        help="Thermal inertia")
+    parser.add_argument(
+        "--batch", type=int, default=1,
+        help="Number of rows sent to a single fittm process")
+    parser.add_argument(
+        "--latency", type=float, default=0.05,
+        help="Median latency of a call in s (per row for fittm)")
+    parser.add_argument(
+        "--jitter", type=float, default=0.3,
+        help="Sigma of the log-normal latency")
+    parser.add_argument(
+        "--busy", action="store_true", default=False,
+        help="Burn CPU instead of sleeping")
+    parser.add_argument(
+        "--failrate", type=float, default=0.0,
+        help="Probability that a call fails")
+    parser.add_argument(
+        "--lines", type=int, default=0,
+        help="Number of other lines printed by a call (output size)")
+    parser.add_argument(
+        "--layout", type=str, default="old", choices=["old", "new"],
+        help="Layout of f> lines (new is rejected until it is confirmed)")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed of fake programs and campaigns")
+    parser.add_argument(
+        "--workdir", type=str, default=None,
+        help="Directory for campaigns and logs (temporary by default)")
+    parser.add_argument(
+        "--out", type=str, default=None,
+        help="Output JSON file")
+    parser.add_argument(
+        "--verbose", action="store_true", default=False,
+        help="Show output of the orchestration")
+    args = parser.parse_args()
+
+    keep = args.workdir is not None
+    if not keep:
+        args.workdir = tempfile.mkdtemp(prefix="neomir_load_")
+    os.makedirs(args.workdir, exist_ok=True)
+
+    # Fake programs are found first
+    os.environ["PATH"] = f"{fakebin}{os.pathsep}{os.environ.get('PATH', '')}"
+    os.environ.update(fake_env(
+        LATENCY=args.latency, JITTER=args.jitter, BUSY=int(args.busy),
+        FAILRATE=args.failrate, LINES=args.lines, LAYOUT=args.layout, SEED=args.seed))
+
+    results = []
+    print(f"{'target':>7s} {'N_obj':>5s} {'N_proc':>6s} {'tasks':>6s} {'wall':>8s} {'tasks/s':>8s} {'util':>5s} {'p50':>7s} {'p95':>7s} {'p99':>7s} {'gap':>7s}")
+    try:
+        for target in args.target:
+            for N_obj in args.nobj:
+                for N_proc in args.nproc:
+                    stats = run_load(target, N_obj, N_proc, args, args.workdir)
+                    results.append(stats)
+                    print(
+                        f"{target:>7s} {N_obj:5d} {N_proc:6d} {stats['N_call']:6d} "
+                        f"{stats['wall']:8.2f} {stats['tasks_per_s']:8.1f} {stats['util']:5.2f} "
+                        f"{stats['p50']:7.3f} {stats['p95']:7.3f} {stats['p99']:7.3f} {stats['gap']:7.3f}")
+                    if stats["error"]:
+                        print(f"  failed after {stats['N_call']}/{stats['N_task']} calls ({stats['N_fail']} failed): {stats['error']}")
+    finally:
+        if not keep:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=2)
+        print(f"Saved {args.out}")
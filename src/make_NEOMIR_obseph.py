@@ -5,9 +5,38 @@ Make obs file and ephem file for NEOMIR paper..
 """
 import os 
 from argparse import ArgumentParser as ap
+import numpy as np
 import pandas as pd
 from astropy import constants as const
 
+from NEOMIR_common import format_obs, format_eph, write_obseph_manifest, obs_wavelengths
+
+
+def write_obseph(outobs, outeph, pos, mir, t0, t1, wavelengths=obs_wavelengths):
+    """
+    Write obs and eph files of all objects.
+
+    Parameters
+    ----------
+    outobs, outeph : str
+        directories for obs and eph files
+    pos, mir : numpy.ndarray
+        (N, 3) positions of asteroids and NEOMIR in au
+    t0, t1 : float
+        epochs in the files
+    wavelengths : array-like
+        wavelengths in micron
+    """
+    os.makedirs(outobs, exist_ok=True)
+    os.makedirs(outeph, exist_ok=True)
+    pos, mir = pos.tolist(), mir.tolist()
+    for idx, (p, m) in enumerate(zip(pos, mir)):
+        # Each file is written at once
+        with open(os.path.join(outeph, f"eph_{idx+1:03d}.txt"), "w") as f:
+            f.write(format_eph(p, t0, t1))
+        with open(os.path.join(outobs, f"obs_{idx+1:03d}.txt"), "w") as f:
+            f.write(format_obs(p, m, t0, wavelengths))
+
 
 if __name__ == "__main__":
     parser = ap(description="Make obs and eph file for tpm.")
@@ -23,104 +52,73 @@ if __name__ == "__main__":
     parser.add_argument(
         "--pseudo", action="store_true", default=False,
         help="Make a pseudo objects")
+    parser.add_argument(
+        "--outeph_control", type=str, default=None,
+        help="Directory for eph files of control objects (made in the same run)")
+    parser.add_argument(
+        "--outobs_control", type=str, default=None,
+        help="Directory for obs files of control objects (made in the same run)")
+    parser.add_argument(
+        "--wavelengths", type=float, nargs="*", default=obs_wavelengths,
+        help="Wavelengths in micron where fluxes are calculated")
+    parser.add_argument(
+        "--manifest", type=str, default=None,
+        help="Save all objects in a single file instead of obs and eph files")
     args = parser.parse_args()
    
-    outeph = args.outeph
-    os.makedirs(outeph, exist_ok=True)
-    outobs = args.outobs
-    os.makedirs(outobs, exist_ok=True)
-    
     au_km = const.au.to("km").value
 
     # Read the file
     df = pd.read_csv(args.pos, sep="|", skiprows=1)
+    print(f"Make obs & eph files of {len(df)} objects")
 
+    # Convert to au
+    pos = df[["X", "Y", "Z"]].values/au_km
+    mir = df[["MirX", "MirY", "MirZ"]].values/au_km
 
-    for idx, row in df.iterrows():
-        print(f"Make obs & eph files: {idx:03d}")
-        x_ast, y_ast, z_ast = row["X"], row["Y"], row["Z"]
-        x_mir, y_mir, z_mir = row["MirX"], row["MirY"], row["MirZ"]
-        # Convert to au
-        x_ast /= au_km
-        y_ast /= au_km
-        z_ast /= au_km
-        x_mir /= au_km
-        y_mir /= au_km
-        z_mir /= au_km
-        print(f"  x_ast, y_ast, z_ast = {x_ast}, {y_ast}, {z_ast}")
-        print(f"  x_mir, y_mir, z_mir = {x_mir}, {y_mir}, {z_mir}")
-
-        # Make pseudo objects at symmetric positions with respect to the earth
-        if args.pseudo:
-            # x, y, z = (X-2MirX, Y-2MirY, Z-2MirZ)
-            # x, y, z = (-MirX, -MirY, -MirZ)
-            x_ast = x_ast - 2*x_mir 
-            y_ast = y_ast - 2*y_mir 
-            z_ast = z_ast - 2*z_mir 
-            x_mir = -x_mir
-            y_mir = -y_mir
-            z_mir = -z_mir
-            print("Make pseudo object")
-            print(f"  x_ast, y_ast, z_ast = {x_ast}, {y_ast}, {z_ast}")
-            print(f"  x_mir, y_mir, z_mir = {x_mir}, {y_mir}, {z_mir}")
-
-
-        # Ephemeris file ======================================================
-        # JD r_X r_Y r_Z
-        # the position of the body in the heliocentric ecliptic reference frame 
-        # as SEEN AT THE ASTEROID. (i.e., Just the location)
-        # Ast -> Sun vector
-
-        # Consider Margin
-        t0 = 5
-        t1 = 5.0001
-        
-        eph = f"eph_{idx+1:03d}.txt"
-        eph = os.path.join(outeph, eph)
+    # Make pseudo objects at symmetric positions with respect to the earth
+    # x, y, z = (X-2MirX, Y-2MirY, Z-2MirZ)
+    # x, y, z = (-MirX, -MirY, -MirZ)
+    pos_control = pos - 2*mir
+    mir_control = -mir
 
-        with open(eph, "w") as f:
-                f.write(f"0 {x_ast} {y_ast} {z_ast}\n")
-                f.write(f"{t0} {x_ast} {y_ast} {z_ast}\n")
-                f.write(f"{t1} {x_ast} {y_ast} {z_ast}\n")
-            
-        # Ephemeris file ======================================================
+    campaigns = []
+    if args.pseudo:
+        campaigns.append(("control", pos_control, mir_control, args.outobs, args.outeph))
+    else:
+        campaigns.append(("original", pos, mir, args.outobs, args.outeph))
+        if args.outobs_control or args.outeph_control:
+            assert args.outobs_control and args.outeph_control, "Set both --outobs_control and --outeph_control."
+            campaigns.append(("control", pos_control, mir_control, args.outobs_control, args.outeph_control))
 
+    # Ephemeris file ======================================================
+    # JD r_X r_Y r_Z
+    # the position of the body in the heliocentric ecliptic reference frame 
+    # as SEEN AT THE ASTEROID. (i.e., Just the location)
+    # Ast -> Sun vector
+    #
+    # Observation file ====================================================
+    # --------------
+    # Nobs
+    # 
+    # JD Ndata
+    # r_X r_Y r_Z (as for ephemeris file)
+    # x y z
+    # heliocentric X,Y,Z components of the vector from the asteroid to the Earth 
+    # as SEEN AT THE ASTEROID. (i.e., Just the location)
 
-        # Observation file ====================================================
-        # --------------
-        # Nobs
-        # 
-        # JD Ndata
-        # r_X r_Y r_Z (as for ephemeris file)
-        # x y z
-        # heliocentric X,Y,Z components of the vector from the asteroid to the Earth 
-        # as SEEN AT THE ASTEROID. (i.e., Just the location)
-        Nobs = 1
-        Ndata = 16
+    # Consider Margin
+    t0 = 5
+    t1 = 5.0001
 
-        obs = f"obs_{idx+1:03d}.txt"
-        obs = os.path.join(outobs, obs)
-        with open(obs, "w") as f:
-            f.write(f"{Nobs}\n")
-            f.write("\n")
-            f.write(f"{t0} {Ndata}\n")
-            f.write(f"{x_ast} {y_ast} {z_ast}\n")
-            f.write(f"{x_mir} {y_mir} {z_mir}\n")
-            # Dummy fluxes
-            f.write(f"5 1 1\n")
-            f.write(f"6 1 1\n")
-            f.write(f"7 1 1\n")
-            f.write(f"8 1 1\n")
-            f.write(f"9 1 1\n")
-            f.write(f"10 1 1\n")
-            f.write(f"11 1 1\n")
-            f.write(f"12 1 1\n")
-            f.write(f"13 1 1\n")
-            f.write(f"14 1 1\n")
-            f.write(f"15 1 1\n")
-            f.write(f"16 1 1\n")
-            f.write(f"17 1 1\n")
-            f.write(f"18 1 1\n")
-            f.write(f"19 1 1\n")
-            f.write(f"20 1 1\n")
-        # Observation file ====================================================
+    if args.manifest:
+        objid = np.arange(1, len(df) + 1)
+        write_obseph_manifest(
+            args.manifest,
+            [(campaign, objid, p, m) for campaign, p, m, _, _ in campaigns], t0, t1,
+            args.wavelengths)
+        print(f"Saved {len(campaigns)*len(df)} objects in {args.manifest}")
+    else:
+        for campaign, p, m, outobs, outeph in campaigns:
+            write_obseph(outobs, outeph, p, m, t0, t1, args.wavelengths)
+            print(f"Saved {campaign} objects in {outobs} and {outeph}")
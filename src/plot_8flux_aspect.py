@@ -6,7 +6,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import os
 
-from NEOMIR_common import mycolor, handle_tpmres, calc_aspect
+from NEOMIR_common import mycolor, handle_tpmres
 
 
 if __name__ == "__main__":
@@ -38,16 +38,14 @@ if __name__ == "__main__":
     # Font size
     fs = 14
     
-    # Read original objects
-    df1 = handle_tpmres(resdir1)
+    # Read original objects (with r, delta, and alpha)
+    # float32 fluxes and categorical TI are enough for scatter plots
+    df1 = handle_tpmres(resdir1, compact=True)
     # Read control objects
-    df2 = handle_tpmres(resdir2)
+    df2 = handle_tpmres(resdir2, compact=True)
     # Merge
     df = pd.concat([df1, df2])
 
-    # Calculate alpha, r, and delta
-    df = calc_aspect(df)
-
     # Plot r, delta, alpha vs. flux (TI dependence) ===========================
     fig = plt.figure(figsize=(16, 14))
     ax_a = fig.add_axes([0.10, 0.58, 0.25, 0.37])
@@ -2,12 +2,149 @@
 # -*- coding: utf-8 -*-
 """
 Plot 8 micron flux!
+
+Fluxes of all figures are interpolated to the grid at once (the poles are
+triangulated once per pole set), and figures are rendered in parallel with
+--nproc. A figure is skipped when its inputs (fluxes, geometry, options,
+and this script) have not changed since the last run (see figure_hash).
 """
 from argparse import ArgumentParser as ap
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import os
-from scipy.interpolate import griddata
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from NEOMIR_common import load_tpmres, list_objid, load_geometry
+from NEOMIR_cache import hash_file
+import NEOMIR_poles
+from NEOMIR_poles import interpolate_pole_maps
+from NEOMIR_catalog import TPMCatalog, default_campaign
+
+
+# Since we used asteroids with diameters of 1 km in TPM to avoid the loss of digits,
+# we have to slace fluxes here.
+# From 1 km to 42 m (H=25, pv=0.1)
+sf = (42./1000.)**2
+
+
+def make_mesh(num_points=100):
+    """
+    Make the (lon, lat) grid of maps.
+    """
+    # Define grid resolution
+    # Adjust num_points for finer/coarser smoothing
+    lon_grid = np.linspace(0, 360, num_points)
+    lat_grid = np.linspace(-90, 90, num_points)
+    return np.meshgrid(lon_grid, lat_grid)
+
+
+def plot_flux_map(flux_grids, r, delta, alpha, out, Gamma_values, vmin, vmax, cmap):
+    """
+    Plot 8 micron flux maps of an object.
+
+    Parameters
+    ----------
+    flux_grids : list of numpy.ndarray
+        fluxes interpolated to the grid of make_mesh (one per Gamma)
+    r, delta, alpha : float
+        geometry of the object
+    out : str
+        output filename
+    Gamma_values : array-like
+        thermal inertia (one panel each)
+    vmin, vmax : float
+        range of the color map
+    cmap : str
+        color map
+
+    Return
+    ------
+    out : str
+        output filename
+    """
+    lon_mesh, lat_mesh = make_mesh(flux_grids[0].shape[1])
+
+    # Create a 3x2 subplot
+    fig = plt.figure(figsize=(12, 16))
+    ax1 = fig.add_axes([0.1, 0.70, 0.3, 0.22])
+    ax2 = fig.add_axes([0.6, 0.70, 0.3, 0.22])
+    ax3 = fig.add_axes([0.1, 0.38, 0.3, 0.22])
+    ax4 = fig.add_axes([0.6, 0.38, 0.3, 0.22])
+    ax5 = fig.add_axes([0.1, 0.06, 0.3, 0.22])
+    ax6 = fig.add_axes([0.6, 0.06, 0.3, 0.22])
+
+
+
+    axs = [ax1, ax2, ax3, ax4, ax5, ax6]
+
+    # Loop over each Gamma value to generate a plot
+    for idx, (Gamma, flux_grid) in enumerate(zip(Gamma_values, flux_grids)):
+        info = r"(r, $\Delta$, $\alpha$) = " + f"({r:.2f} au, {delta:.2f} au, {alpha:.2f} deg)"
+        #ax1.text(0.5, 1.2, info, size=22, horizontalalignment="left", transform=ax1.transAxes)
+        fig.suptitle(info, fontsize=20)
+
+        # Plot in the correct subplot (3x2 grid)
+        ax = axs[idx]
+        c = ax.contourf(lon_mesh, lat_mesh, flux_grid, levels=50, cmap=cmap, vmin=vmin, vmax=vmax)
+        fig.colorbar(c, ax=ax, label=r'Flux deinsity ($\mu$Jy)')
+
+        # Add contour lines
+        contour_lines = ax.contour(lon_mesh, lat_mesh, flux_grid, levels=10, colors='red', linewidths=0.5)
+
+        # Add labels to contour lines
+        ax.clabel(contour_lines, inline=True, fontsize=10, fmt="%.0f", colors='red')
+
+        # Set labels and title
+        ax.set_xlabel('Ecliptic longitude of north rotation pole', fontsize=14)
+        ax.set_ylabel('Ecliptic latitude of north rotation pole', fontsize=14)
+        ax.set_xlim([0,  360])
+        ax.set_ylim([-90, 90])
+        ax.set_title(r"$\Gamma$" + f" = {Gamma} tiu", fontsize=14)
+
+    plt.savefig(out)
+    plt.close()
+    return out
+
+
+def timed(func, *args):
+    """
+    Call func and measure the elapsed time in s.
+    """
+    t0 = time.time()
+    return func(*args), time.time() - t0
+
+
+def figure_hash(df_obj, geom, options):
+    """
+    Hash of all inputs of a figure.
+
+    Parameters
+    ----------
+    df_obj : pandas.DataFrame
+        results of the object
+    geom : array-like
+        r, delta, and alpha
+    options : dict
+        options of the figure
+
+    Return
+    ------
+    h : str
+        SHA-256 of inputs
+    """
+    h = hashlib.sha256()
+    # Changes of this script and of the interpolation of maps also update figures
+    h.update(hash_file(__file__).encode())
+    h.update(hash_file(NEOMIR_poles.__file__).encode())
+    h.update(repr(sorted(options.items())).encode())
+    h.update(np.asarray(geom, dtype=np.float64).tobytes())
+    for col in ["TI", "lon", "lat", "flux8"]:
+        h.update(np.ascontiguousarray(df_obj[col].values).tobytes())
+    return h.hexdigest()
 
 
 if __name__ == "__main__":
@@ -36,6 +173,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "--outdir", type=str, default="plot",
         help="Directory for output file")
+    parser.add_argument(
+        "--nproc", type=int, default=os.cpu_count(),
+        help="Number of parallel processes")
+    parser.add_argument(
+        "--force", action="store_true", default=False,
+        help="Make figures even if they are up to date")
+    parser.add_argument(
+        "--catalog", type=str, default=None,
+        help="SQLite catalog queried instead of files in resdir")
+    parser.add_argument(
+        "--campaign", type=str, default=None,
+        help="Campaign in the catalog (name of resdir by default)")
     args = parser.parse_args()
 
     resdir = args.resdir
@@ -43,109 +192,81 @@ if __name__ == "__main__":
     os.makedirs(outdir, exist_ok=True)
 
     Gamma_values = [0, 50, 150, 300, 500, 1000]
-    vmin, vmax = args.vmin, args.vmax
-    cmap = args.cmap
-    
+    options = dict(
+        Gamma_values=Gamma_values, vmin=args.vmin, vmax=args.vmax, cmap=args.cmap)
+
+    catalog = TPMCatalog(args.catalog) if args.catalog else None
+    campaign = args.campaign or default_campaign(resdir)
     if args.all:
         # Try to find object id
-        filenames = [f.name for f in os.scandir(resdir)]
-        # Extract object id from TI150_res_012.txta
-        filenames_part = [f.split("_")[-1] for f in filenames]
-        idx_plot = [int(f.split(".")[0]) for f in filenames_part]
-        idx_plot = list(set(idx_plot))
+        idx_plot = catalog.list_objid(campaign) if catalog else list_objid(resdir)
     else:
         idx_plot = args.idx_obj
 
+    # Load all objects at once
+    t0 = time.time()
+    if catalog is not None:
+        df = catalog.query(
+            campaign, objid=idx_plot, TI=Gamma_values, columns=["lon", "lat", "flux8"])
+        geom = catalog.load_geometry(campaign, idx_plot)
+    else:
+        df = load_tpmres(
+            resdir, objid=idx_plot, TI=Gamma_values, columns=["lon", "lat", "flux8"])
+        geom = load_geometry(resdir, idx_plot)
+    df_objs = dict(list(df.groupby("objid")))
 
+    # Find figures to be made
+    todo = []
     for idx_obj in idx_plot:
-        print(f"Make a figure for OBJ{idx_obj:03d}")
-        
         if args.out:
             out = args.out
         else:
             out = f"tpmres_NEOMIR_obj{idx_obj:03d}.jpg"
         out = os.path.join(outdir, out)
 
+        # These are common
+        r, delta, alpha = geom.loc[idx_obj, ["r", "delta", "alpha"]]
+        h = figure_hash(df_objs[idx_obj], (r, delta, alpha), options)
+        if (not args.force) and os.path.isfile(out) and os.path.isfile(f"{out}.hash"):
+            with open(f"{out}.hash") as f:
+                if f.read().strip() == h:
+                    print(f"Skip OBJ{idx_obj:03d} (up to date)")
+                    continue
+        todo.append((idx_obj, out, h, (r, delta, alpha)))
 
-        allFluxes=[]
-        
-        # Define grid resolution
-        num_points = 100  # Adjust for finer/coarser smoothing
-        lon_grid = np.linspace(0, 360, num_points)
-        lat_grid = np.linspace(-90, 90, num_points)
-        lon_mesh, lat_mesh = np.meshgrid(lon_grid, lat_grid)
-        
-        # Create a 3x2 subplot
-        fig = plt.figure(figsize=(12, 16))
-        ax1 = fig.add_axes([0.1, 0.70, 0.3, 0.22])
-        ax2 = fig.add_axes([0.6, 0.70, 0.3, 0.22])
-        ax3 = fig.add_axes([0.1, 0.38, 0.3, 0.22])
-        ax4 = fig.add_axes([0.6, 0.38, 0.3, 0.22])
-        ax5 = fig.add_axes([0.1, 0.06, 0.3, 0.22])
-        ax6 = fig.add_axes([0.6, 0.06, 0.3, 0.22])
-       
-
-
-        axs = [ax1, ax2, ax3, ax4, ax5, ax6]
-        
-        # Loop over each Gamma value to load data and generate a plot
-        for idx, Gamma in enumerate(Gamma_values):
-            filename = f"TI{Gamma}_res_{idx_obj:03d}.txt"  # Load the corresponding Gamma file
-            filename = os.path.join(resdir, filename)
-            data = np.loadtxt(filename)
-        
-            # Extract columns: lon, lat, flux
-            lon, lat, flux5, flux8 = data[:, 2], data[:, 3], data[:, 4], data[:, 5]
-            # Since we used asteroids with diameters of 1 km in TPM to avoid the loss of digits,
-            # we have to slace fluxes here.
-            # From 1 km to 42 m (H=25, pv=0.1)
-            sf = (42./1000.)**2
-            flux5, flux8 = flux5*sf, flux8*sf
-
-            # These are common
-            x1, y1, z1     = data[:, 6][0], data[:, 7][0], data[:, 8][0]
-            x2, y2, z2     = data[:, 9][0], data[:, 10][0], data[:, 11][0]
-
-            # Calculate alpha, r, delta
-            S = np.array([x1, y1, z1]).T
-            r = np.sqrt(np.sum(S**2))
-            O = np.array([x2, y2, z2]).T
-            delta = np.sqrt(np.sum(O**2))
-            SO = S*O
-            alpha = np.arccos(np.sum(SO)/r/delta)*180/np.pi
-            print(f"  r, delta, alpha = {r:.2f}, {delta:.2f}, {alpha:.2f}")
+    # Interpolate all maps at once
+    t1 = time.time()
+    maps = []
+    for idx_obj, _, _, (r, delta, alpha) in todo:
+        df_obj = df_objs[idx_obj]
+        print(f"OBJ{idx_obj:03d}")
+        print(f"  r, delta, alpha = {r:.2f}, {delta:.2f}, {alpha:.2f}")
+        for Gamma in Gamma_values:
+            df_TI = df_obj[df_obj["TI"] == Gamma]
+            flux8 = df_TI["flux8"].values*sf
             print(f"Gamma {Gamma}: min={np.min(flux8)}, max={np.max(flux8)}, median={np.median(flux8)}, std={np.std(flux8)}")
-            
-                    
-            info = r"(r, $\Delta$, $\alpha$) = " + f"({r:.2f} au, {delta:.2f} au, {alpha:.2f} deg)"
-            #ax1.text(0.5, 1.2, info, size=22, horizontalalignment="left", transform=ax1.transAxes)
-            fig.suptitle(info, fontsize=20)
-        
-            # Interpolate scattered data to grid
-            flux_grid = griddata((lon, lat), flux8, (lon_mesh, lat_mesh), method='cubic')
-        
-            # Plot in the correct subplot (3x2 grid)
-            ax = axs[idx] 
-            c = ax.contourf(lon_mesh, lat_mesh, flux_grid, levels=50, cmap=cmap, vmin=vmin, vmax=vmax)
-            fig.colorbar(c, ax=ax, label=r'Flux deinsity ($\mu$Jy)')
-        
-            # Add contour lines
-            contour_lines = ax.contour(lon_mesh, lat_mesh, flux_grid, levels=10, colors='red', linewidths=0.5)
-        
-            # Add labels to contour lines
-            ax.clabel(contour_lines, inline=True, fontsize=10, fmt="%.0f", colors='red')
-        
-            # Set labels and title
-            ax.set_xlabel('Ecliptic longitude of north rotation pole', fontsize=14)
-            ax.set_ylabel('Ecliptic latitude of north rotation pole', fontsize=14)
-            ax.set_xlim([0,  360])
-            ax.set_ylim([-90, 90])
-            ax.set_title(r"$\Gamma$" + f" = {Gamma} tiu", fontsize=14)
-            if (Gamma>0):
-                allFluxes.extend(flux8)
-        
-        # Useless?
-        #allFluxes = np.sort(allFluxes)
-        #plt.plot(allFluxes, np.arange(1,len(allFluxes)+1)/len(allFluxes))
-        plt.savefig(out)
-        plt.close()
+            maps.append((df_TI["lon"].values, df_TI["lat"].values, flux8))
+    lon_mesh, lat_mesh = make_mesh()
+    grids = interpolate_pole_maps(maps, lon_mesh, lat_mesh)
+    print(f"Interpolated {len(maps)} maps in {time.time() - t1:.2f} s")
+
+    # Render figures in parallel
+    N_Gamma = len(Gamma_values)
+    N_made = 0
+    if todo:
+        with ProcessPoolExecutor(max_workers=min(args.nproc, len(todo))) as executor:
+            futures = {}
+            for n, (idx_obj, out, h, (r, delta, alpha)) in enumerate(todo):
+                fut = executor.submit(
+                    timed, plot_flux_map, grids[n*N_Gamma:(n + 1)*N_Gamma],
+                    r, delta, alpha, out, Gamma_values, args.vmin, args.vmax, args.cmap)
+                futures[fut] = (idx_obj, out, h)
+            for fut in as_completed(futures):
+                idx_obj, out, h = futures[fut]
+                _, elapsed = fut.result()
+                # Save the hash after the figure
+                with open(f"{out}.hash", "w") as f:
+                    f.write(f"{h}\n")
+                N_made += 1
+                print(f"Make a figure for OBJ{idx_obj:03d} ({elapsed:.2f} s)")
+    print(f"{N_made} figures made, {len(idx_plot) - N_made} skipped in {time.time() - t0:.1f} s")
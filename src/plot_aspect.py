@@ -10,45 +10,20 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import os
 
+from NEOMIR_common import calc_aspect, read_obs_table
+
 mycolor = [
     "#AD002D", "#1e50a2", "#69821b", "#f055f0", "#afafb0", 
     "#0095b9", "#89c3eb", "#ec6800", "cyan", "gold"]
 
-def calc_aspect(df):
-    """
-    Calculate alpha, delta, and r.
-
-    Parameter
-    ---------
-    df : pandas.DataFrame
-        input dataframe
-
-    Return
-    ------
-    df : pandas.DataFrame
-        output dataframe
-    """
-    S = np.array([df['X'].values, df['Y'].values, df['Z'].values]).T
-    normaS = np.sqrt(np.sum(S**2, axis=1))
-    O = np.array([df['MirX'].values, df['MirY'].values, df['MirZ'].values]).T
-    normaO = np.sqrt(np.sum(O**2, axis=1))
-    SO = S*O
-    pha = np.arccos(np.sum(SO, axis=1)/normaO/normaS)*180/np.pi
-   
-    df["r"] = normaS
-    df["delta"] = normaO
-    df["alpha"] = pha
-    return df
-
-
 if __name__ == "__main__":
     parser = ap(description="Plot TPM results for NEOMIR.")
     parser.add_argument(
         "obsdir1", type=str,
-        help="Directory with output files")
+        help="Directory with obs files of original objects (or a manifest)")
     parser.add_argument(
         "obsdir2", type=str,
-        help="Directory with output files")
+        help="Directory with obs files of control objects (or a manifest)")
     parser.add_argument(
         "--out", type=str, default="aspect.jpg",
         help="Output filename")
@@ -63,56 +38,9 @@ if __name__ == "__main__":
     os.makedirs(outdir, exist_ok=True)
 
 
-    # Original objects ========================================================
-    filenames1 = [f.name for f in os.scandir(obsdir1)]
-    df1_list = []
-    for idx_fi, fi in enumerate(filenames1):
-        fi = os.path.join(obsdir1, fi)
-        with open(fi, "r") as f:
-            f = f.readlines()
-            # Extract positions
-            
-            xyz = f[3].replace("\n", "")
-            xyzMIR = f[4].replace("\n", "")
-            xyz = xyz.split()
-            xyzMIR = xyzMIR.split()
-            x1, y1, z1     = float(xyz[0]), float(xyz[1]), float(xyz[2])
-            x2, y2, z2     = float(xyzMIR[0]), float(xyzMIR[1]), float(xyzMIR[2])
-
-            df = pd.DataFrame(dict(
-                X=[x1], Y=[y1], Z=[z1], MirX=[x2], MirY=[y2], MirZ=[z2]
-                ))
-            df["objid"] = idx_fi
-            df1_list.append(df)
-    df1 = pd.concat(df1_list)
-    df1 = df1.reset_index(drop=True)
-    # Original objects ========================================================
-
-
-    # Control objects =========================================================
-    filenames2 = [f.name for f in os.scandir(obsdir2)]
-    df2_list = []
-    for idx_fi, fi in enumerate(filenames2):
-        fi = os.path.join(obsdir2, fi)
-        with open(fi, "r") as f:
-            f = f.readlines()
-            # Extract positions
-            
-            xyz = f[3].replace("\n", "")
-            xyzMIR = f[4].replace("\n", "")
-            xyz = xyz.split()
-            xyzMIR = xyzMIR.split()
-            x1, y1, z1     = float(xyz[0]), float(xyz[1]), float(xyz[2])
-            x2, y2, z2     = float(xyzMIR[0]), float(xyzMIR[1]), float(xyzMIR[2])
-
-            df = pd.DataFrame(dict(
-                X=[x1], Y=[y1], Z=[z1], MirX=[x2], MirY=[y2], MirZ=[z2]
-                ))
-            df["objid"] = idx_fi
-            df2_list.append(df)
-    df2 = pd.concat(df2_list)
-    df2 = df2.reset_index(drop=True)
-    # Control objects =========================================================
+    # Original objects and control objects (directories or manifests)
+    df1 = pd.DataFrame(read_obs_table(obsdir1, campaign="original"))
+    df2 = pd.DataFrame(read_obs_table(obsdir2, campaign="control"))
 
     # Calculate alpha, r, and delta
     df1 = calc_aspect(df1)
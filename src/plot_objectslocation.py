@@ -8,7 +8,9 @@ from argparse import ArgumentParser as ap
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
-from astroquery.jplhorizons import Horizons
+
+from NEOMIR_common import read_obs_table
+from NEOMIR_ephem import get_vectors, ephem_sources
 
 mycolor = [
     "#AD002D", "#1e50a2", "#69821b", "#f055f0", "#afafb0", 
@@ -18,16 +20,22 @@ if __name__ == "__main__":
     parser = ap(description="Plot TPM results for NEOMIR.")
     parser.add_argument(
         "obsdir1", type=str,
-        help="Directory with output files")
+        help="Directory with obs files of original objects (or a manifest)")
     parser.add_argument(
         "obsdir2", type=str,
-        help="Directory with output files")
+        help="Directory with obs files of control objects (or a manifest)")
     parser.add_argument(
         "--out", type=str, default="loc.jpg",
         help="Output filename")
     parser.add_argument(
         "--outdir", type=str, default="fig",
         help="Directory for output file")
+    parser.add_argument(
+        "--ephem", type=str, default="auto", choices=ephem_sources,
+        help="Source of the Earth orbit (auto: cache or Keplerian orbit, without network)")
+    parser.add_argument(
+        "--ephemcache", type=str, default="ephemcache",
+        help="Directory of the cache of ephemerides")
     args = parser.parse_args()
 
     obsdir1 = args.obsdir1
@@ -36,56 +44,9 @@ if __name__ == "__main__":
     os.makedirs(outdir, exist_ok=True)
 
 
-    # Original objects ========================================================
-    filenames1 = [f.name for f in os.scandir(obsdir1)]
-    df1_list = []
-    for idx_fi, fi in enumerate(filenames1):
-        fi = os.path.join(obsdir1, fi)
-        with open(fi, "r") as f:
-            f = f.readlines()
-            # Extract positions
-            
-            xyz = f[3].replace("\n", "")
-            xyzMIR = f[4].replace("\n", "")
-            xyz = xyz.split()
-            xyzMIR = xyzMIR.split()
-            x1, y1, z1     = float(xyz[0]), float(xyz[1]), float(xyz[2])
-            x2, y2, z2     = float(xyzMIR[0]), float(xyzMIR[1]), float(xyzMIR[2])
-
-            df = pd.DataFrame(dict(
-                X=[x1], Y=[y1], Z=[z1], MirX=[x2], MirY=[y2], MirZ=[z2]
-                ))
-            df["objid"] = idx_fi
-            df1_list.append(df)
-    df1 = pd.concat(df1_list)
-    df1 = df1.reset_index(drop=True)
-    # Original objects ========================================================
-
-
-    # Control objects =========================================================
-    filenames2 = [f.name for f in os.scandir(obsdir2)]
-    df2_list = []
-    for idx_fi, fi in enumerate(filenames2):
-        fi = os.path.join(obsdir2, fi)
-        with open(fi, "r") as f:
-            f = f.readlines()
-            # Extract positions
-            
-            xyz = f[3].replace("\n", "")
-            xyzMIR = f[4].replace("\n", "")
-            xyz = xyz.split()
-            xyzMIR = xyzMIR.split()
-            x1, y1, z1     = float(xyz[0]), float(xyz[1]), float(xyz[2])
-            x2, y2, z2     = float(xyzMIR[0]), float(xyzMIR[1]), float(xyzMIR[2])
-
-            df = pd.DataFrame(dict(
-                X=[x1], Y=[y1], Z=[z1], MirX=[x2], MirY=[y2], MirZ=[z2]
-                ))
-            df["objid"] = idx_fi
-            df2_list.append(df)
-    df2 = pd.concat(df2_list)
-    df2 = df2.reset_index(drop=True)
-    # Control objects =========================================================
+    # Original objects and control objects (directories or manifests)
+    df1 = pd.DataFrame(read_obs_table(obsdir1, campaign="original"))
+    df2 = pd.DataFrame(read_obs_table(obsdir2, campaign="control"))
 
     df1["x"] = -df1["X"]
     df1["y"] = -df1["Y"]
@@ -115,35 +76,25 @@ if __name__ == "__main__":
     ax.set_ylabel("y [au]")
     
     # Oroginal 
-    for idx, row in df1.iterrows():
-        col = mycolor[0]
-        mark = "o"
-        si = 50
-        if idx == 0:
-            lab = f"Original asteroids N={len(df1)}"
-        else:
-            lab = None
-        ax.scatter(
-            row["x"], row["y"], color=col, lw=1, ls="solid", 
-            label=lab, zorder=-1, s=si, marker=mark, facecolor="None")
+    col = mycolor[0]
+    mark = "o"
+    si = 50
+    lab = f"Original asteroids N={len(df1)}"
+    ax.scatter(
+        df1["x"], df1["y"], color=col, lw=1, ls="solid", 
+        label=lab, zorder=-1, s=si, marker=mark, facecolor="None")
     # Control
-    for idx, row in df2.iterrows():
-        col = mycolor[1]
-        mark = "x"
-        si = 50
-        if idx == 0:
-            lab = f"Control asteroids N={len(df2)}\n(Symmetric with respect to the NEOMIR)"
-        else:
-            lab = None
-        ax.scatter(row["x"], row["y"], color=col, lw=1, ls="solid", label=lab, zorder=-1, s=si, marker=mark)
+    col = mycolor[1]
+    mark = "x"
+    si = 50
+    lab = f"Control asteroids N={len(df2)}\n(Symmetric with respect to the NEOMIR)"
+    ax.scatter(df2["x"], df2["y"], color=col, lw=1, ls="solid", label=lab, zorder=-1, s=si, marker=mark)
 
     # Earth
     t0 = "2024-08-14"
     t1 = "2025-08-15"
-    Earth1 = Horizons(
-        location='500@10',
-        id="399", epochs={'start':t0, 'stop':t1, 'step':"1d"})
-    Earth1 = Earth1.vectors()
+    Earth1 = get_vectors(
+        "399", "500@10", t0, t1, "1d", cachedir=args.ephemcache, source=args.ephem)
     lab = "Earth orbit"
     ax.plot(Earth1["x"], Earth1["y"], color="grey", lw=1.5, ls="dashed", label=lab, zorder=-1)
     # Sun
@@ -3,85 +3,666 @@
 from argparse import ArgumentParser as ap
 import numpy as np
 import subprocess, os
-from concurrent.futures import ProcessPoolExecutor
-from multiprocessing import Manager
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import defaultdict
 
+from NEOMIR_common import (
+    TPMStoreWriter, read_obs_table, read_obs_wavelengths, read_tpmres_file, flux_column,
+    position_columns)
+from NEOMIR_cache import TPMCache, hash_file, make_key
+from NEOMIR_spin import SpinStager
+from NEOMIR_poles import sample_poles, refine_poles, pole_methods
+from NEOMIR_tpmout import parse_tpm_output
+from NEOMIR_metrics import MetricsLog, child_cpu_time
+from NEOMIR_queue import WorkQueue, default_worker_id
+from NEOMIR_catalog import TPMCatalog, default_campaign
 
-def run_simulation(i, rotP_hr, lam, beta, Gamma, obs, eph, obj, spindir, label):
 
-    spinf = f"spin{i:03d}_TI{Gamma}_{label}.txt"
-    with open(f'{spindir}/{spinf}', 'wt') as f:
-        print(lam, beta, rotP_hr, 0, 0, file=f)
-    
-    # emissivity
-    eps = 0.9
-    D_km = 1.0
-    BondA = 0.039
+# Fixed parameters of TPM
+# eps: emissivity, D_km: diameter, BondA: Bond albedo,
+# Assume no craters (ca = 0, cr = 0)
+tpm_params = dict(eps=0.9, D_km=1.0, BondA=0.039, ca=0, cr=0)
+
+
+def run_simulation(i, rotP_hr, lam, beta, Gamma, obs, eph, obj, spinf, geom, wavelengths, t_submit=None):
+    # The spin file (lam, beta, rotP_hr) is staged by the main process
+    eps, D_km, BondA = tpm_params["eps"], tpm_params["D_km"], tpm_params["BondA"]
+    ca, cr = tpm_params["ca"], tpm_params["cr"]
+    t_start, cpu_start = time.time(), child_cpu_time()
 
-    # Assume no craters (ca = 0, cr = 0)
-    cmd = f'echo {obj} {eph} {eps} {Gamma} {BondA} 0 0 | runtpm -o {obs} -S {spindir}/{spinf} -s {D_km} | grep "f>"'
-    p = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-    comm = p.communicate()
-    output = comm[0].decode('ascii').strip()
+    # Run runtpm without shell, and keep only lines starting with "f>"
+    cmd = ["runtpm", "-o", obs, "-S", spinf, "-s", f"{D_km}"]
+    p = subprocess.Popen(
+        cmd, start_new_session=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+        stderr=subprocess.PIPE, text=True)
+    t_spawn = time.time()
+    stdout, stderr = p.communicate(f"{obj} {eph} {eps} {Gamma} {BondA} {ca} {cr}\n")
+    t_exit = time.time()
+    out_bytes = len(stdout)
+    output = [line for line in stdout.splitlines(keepends=True) if line.startswith("f>")]
 
+    # A crashed or killed runtpm may have printed only a part of the fluxes
+    if p.returncode != 0:
+        tail = "\n".join(stderr.rstrip().splitlines()[-10:])
+        raise RuntimeError(
+            f"runtpm exited with code {p.returncode}: {' '.join(cmd)}"
+            + (f"\n{tail}" if tail else ""))
     if not output:
-        raise ValueError(f"Command produced no output: {cmd}")
-    
-    split_output = output.split()
-    if len(split_output) <= 7:
-        raise IndexError(f"Unexpected command output: {output}")
+        raise ValueError(f"Command produced no output: {' '.join(cmd)}")
     
+    # One line per wavelength in the obs file (old or new version of runtpm)
+    try:
+        rec = parse_tpm_output(output, Gamma, wavelengths)
+    except ValueError as e:
+        raise ValueError(f"{e}: {' '.join(cmd)}") from None
+
     # Fluxes in microJy
-    # The first flux is "7"
-    # 7 to 20 micron
-    #with open("test", "w") as f:
-    #    f.writelines(split_output)
+    fluxes = " ".join(f"{f}" for f in (rec["flux"]*1e6).tolist())
 
-    if Gamma == 0:
-        fluxes = " ".join(f"{float(split_output[7 + (i - 5) * 10]) * 1e6}" for i in range(5, 21))
-    else:
-        fluxes = " ".join(f"{float(split_output[7 + (i - 5) * 11]) * 1e6}" for i in range(5, 21))
-    # Extract locations of asteroids from obsfile
-    with open(obs) as f_obs: 
-        lines = f_obs.readlines()
-        xyz1 = lines[3]
-        x1, y1, z1 = xyz1.split()
-        xyz2 = lines[4]
-        x2, y2, z2 = xyz2.split()
+    # Locations of asteroids from obsfile
+    x1, y1, z1, x2, y2, z2 = geom
 
     log_entry = f"{i} {D_km} {lam} {beta} {x1} {y1} {z1} {x2} {y2} {z2} {fluxes}\n"
-    return log_entry  # Return the formatted log entry
+
+    # Timings in s (see NEOMIR_metrics.py)
+    t_end = time.time()
+    metrics = dict(
+        queue_wait=None if t_submit is None else t_start - t_submit,
+        spawn=t_spawn - t_start, wall=t_exit - t_start,
+        cpu=child_cpu_time() - cpu_start, parse=t_end - t_exit,
+        out_bytes=out_bytes, pid=os.getpid(), t_start=t_start, t_end=t_end)
+    return log_entry, metrics  # Return the formatted log entry and timings
+
+
+def tpmres_header(wavelengths):
+    """
+    Header of result files with fluxes at wavelengths (e.g., flux5 flux8).
+    """
+    fluxes = " ".join(flux_column(w) for w in wavelengths)
+    return f"idx D_km lam beta x1 y1 z1 x2 y2 z2 {fluxes}\n"
+
+
+class TPMResWriter:
+    """
+    Stream results to TI{Gamma}_res_{label}.txt as they arrive.
+
+    Lines are appended in the order of completion, so partial results can
+    be followed with tail. When all expected poles of a file are done, the
+    file is sorted by idx (stable). The file is appended to the columnar
+    store (unless it is already there) and added to the catalog after its
+    last round (see expect).
+
+    Parameters
+    ----------
+    outdir : str
+        directory for output file
+    headers : dict
+        label -> header of the file (see tpmres_header)
+    store : TPMStoreWriter, optional
+        columnar store where results are also saved
+    catalog : TPMCatalog, optional
+        catalog where results are also saved
+    campaign : str, optional
+        name of the campaign in the catalog (name of outdir by default)
+    """
+    def __init__(self, outdir, headers, store=None, catalog=None, campaign=None):
+        self.outdir = outdir
+        self.headers = headers
+        self.store = store
+        self.catalog = catalog
+        self.campaign = campaign or default_campaign(outdir)
+        self.files, self.counts = {}, {}
+        self.expected, self.final = {}, {}
+
+    def path(self, label, Gamma):
+        return os.path.join(self.outdir, f"TI{Gamma}_res_{label}.txt")
+
+    def expect(self, label, Gamma, N, final=True):
+        """
+        Set the number of poles of a file (including previous rounds).
+
+        Parameters
+        ----------
+        label : str
+            label of the object (e.g., 001)
+        Gamma : int
+            thermal inertia
+        N : int
+            number of poles when the file is completed
+        final : bool
+            False if more poles are added in the next round
+        """
+        self.expected[(label, Gamma)] = N
+        self.final[(label, Gamma)] = final
+
+    def add(self, label, Gamma, entry):
+        """
+        Append an output of run_simulation.
+
+        Return
+        ------
+        completed : bool
+            True if all expected poles of the file are done
+        """
+        key = (label, Gamma)
+        if key not in self.files:
+            if key in self.counts:
+                # Poles added in a new round
+                f = open(self.path(label, Gamma), "a")
+            else:
+                f = open(self.path(label, Gamma), "w")
+                f.write(self.headers[label])
+                self.counts[key] = 0
+            self.files[key] = f
+        self.files[key].write(entry)
+        self.files[key].flush()
+        self.counts[key] += 1
+        if self.counts[key] < self.expected[key]:
+            return False
+        self.files.pop(key).close()
+        self.finalize(label, Gamma, self.final[key])
+        return True
+
+    def finalize(self, label, Gamma, final=True):
+        """
+        Sort a completed file by idx and save it in the store and the catalog.
+        """
+        path = self.path(label, Gamma)
+        with open(path) as f:
+            lines = f.readlines()
+        header, lines = lines[0], lines[1:]
+        lines = sorted(lines, key=lambda x: int(x.split(" ", 1)[0]))
+        with open(f"{path}.tmp", "w") as f:
+            f.write(header)
+            f.writelines(lines)
+        os.replace(f"{path}.tmp", path)
+
+        # Append the results to the columnar store and the catalog
+        if final and ((self.store is not None) or (self.catalog is not None)):
+            arr = np.loadtxt(io.StringIO("".join(lines)), ndmin=2)
+            data = {col: arr[:, i] for i, col in enumerate(header.split())}
+            if self.catalog is not None:
+                self.catalog.add(self.campaign, int(label), Gamma, data, path)
+            if self.store is not None:
+                # Files saved by an earlier run (e.g., before --resume) are skipped
+                self.store.add_file(int(label), Gamma, data)
+
+    def close(self):
+        """
+        Close files not completed (partial results are kept).
+        """
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+def simulation_key(i, rotP_hr, lam, beta, Gamma, obs, eph, obj):
+    """
+    Key of a simulation in the cache (hash of all inputs except i).
+    """
+    return make_key(
+        obj=hash_file(obj), eph=hash_file(eph), obs=hash_file(obs),
+        Gamma=float(Gamma), lam=float(lam), beta=float(beta), rotP_hr=float(rotP_hr),
+        **tpm_params)
 
 
-def main_tpm(obs, eph, obj, N, M, rotP_hr, Gamma_values, label, spindir, outdir):
-    # Make the (lam, beta) 
-    # Assume N x M = 300
+def campaign_objects(obs_list, eph_list):
+    """
+    Extract locations of asteroids and wavelengths once per object.
+
+    Parameters
+    ----------
+    obs_list, eph_list : array-like
+        obs and eph files of objects
+
+    Return
+    ------
+    labels : list of str
+        labels of objects (001, 002, ...)
+    objects : dict
+        label -> (obs, eph, geometry, wavelengths)
+    """
+    labels = [f"{n+1:03d}" for n in range(len(obs_list))]
+    table = read_obs_table(list(obs_list))
+    objects = {
+        label: (obs, eph, tuple(table[col][n].item() for col in position_columns), read_obs_wavelengths(obs))
+        for n, (label, obs, eph) in enumerate(zip(labels, obs_list, eph_list))}
+    return labels, objects
+
+
+def main_tpm(obs_list, eph_list, obj, N_pole, rotP_hr, Gamma_values, spin, outdir, N_proc, store=None, cache=None, resume=False, method="uniform", N_round=0, N_refine=0, metrics=None, catalog=None, w_refine=8.0):
+    """
+    Run TPMs of all objects, Gamma, and poles with a single pool.
+
+    Parameters
+    ----------
+    obs_list, eph_list : array-like
+        obs and eph files of objects
+    obj : str
+        shape model
+    N_pole : int
+        number of poles per object and Gamma
+    rotP_hr : float
+        rotation period in hour
+    Gamma_values : array-like
+        thermal inertia
+    spin : SpinStager
+        staging of spin files
+    outdir : str
+        directory for output file
+    N_proc : int
+        number of processes
+    store : TPMStoreWriter, optional
+        columnar store where results are also saved
+    cache : TPMCache, optional
+        cache where results of simulations are saved
+    resume : bool
+        reuse results in the cache
+    method : str
+        sampling method of poles (see NEOMIR_poles.py)
+    N_round : int
+        number of rounds of adaptive refinement
+    N_refine : int
+        number of poles added per object and Gamma in each round
+    metrics : MetricsLog, optional
+        log where timings of each simulation are written
+    catalog : TPMCatalog, optional
+        catalog where results are also saved (campaign is the name of outdir)
+    w_refine : float
+        wavelength in micron of the flux used in refinement (must be in obs files)
+    """
+    # Make the (lam, beta), common for all objects
     seed = 0
-    np.random.seed(seed)
-
-    # Generate random values for lam, beta
-    lam_list = np.random.uniform(0, 360, N*M)
-    beta_list = np.random.uniform(-90, 90, N*M)
-
-    # Initialize manager for shared list
-    with Manager() as manager:
-        for Gamma in Gamma_values:  # Iterate over each Gamma value
-            print(f"Running simulations for Gamma = {Gamma}...")
-            results = manager.list()  # Create a new list for each Gamma value
-            for cycle in range(M):
-                lam_list_M, beta_list_M = lam_list[cycle*N:(cycle+1)*N], beta_list[cycle*N:(cycle+1)*N]
-                with ProcessPoolExecutor(max_workers=N) as executor:
-                    futures = [executor.submit(run_simulation, i, rotP_hr, lam_list_M[i], beta_list_M[i], Gamma, obs, eph, obj, spindir, label) for i in range(N)]
-                    cycle_results = [f.result() for f in futures]
-                    results.extend(cycle_results)  # Append the results for this cycle
-
-                print(f"Cycle {cycle + 1}/{M} for Gamma = {Gamma} completed.")
-            
-            # Write all results for the current Gamma value to the file
-            header = "idx D_km lam beta x1 y1 z1 x2 y2 z2 flux5 flux6 flux7 flux8 flux9 flux10 flux11 flux12 flux13 flux14 flux15 flux16 flux17 flux18 flux19 flux20\n"
-            with open(f'{outdir}/TI{Gamma}_res_{label}.txt', "w") as f:
-                f.write(header)
-                f.writelines(results)  # Write all results at once
+    lam_init, beta_init = sample_poles(N_pole, method, seed)
+
+    # Extract locations of asteroids and wavelengths once per object
+    labels, objects = campaign_objects(obs_list, eph_list)
+
+    # The flux used in refinement has to be in all result files
+    key_refine = flux_column(w_refine)
+    if N_round > 0:
+        missing = [
+            label for label in labels
+            if key_refine not in (flux_column(w) for w in objects[label][3])]
+        if missing:
+            raise ValueError(
+                f"No {w_refine:g} micron in obs files of {len(missing)} objects (e.g., {objects[missing[0]][0]}) "
+                f"to refine poles: add it to the wavelengths or change the wavelength of refinement (--wrefine)")
+
+    # Poles of each file (differ among files after refinement)
+    poles = {
+        (label, Gamma): (lam_init, beta_init)
+        for label in labels for Gamma in Gamma_values}
+
+    # Results are streamed to output files as they arrive
+    headers = {label: tpmres_header(objects[label][3]) for label in labels}
+    writer = TPMResWriter(outdir, headers, store, catalog)
+
+    try:
+        with ProcessPoolExecutor(max_workers=N_proc) as executor:
+            N_start = 0
+            for idx_round in range(N_round + 1):
+                # Flatten objects x Gamma x poles
+                tasks = []
+                for (label, Gamma), (lam, beta) in poles.items():
+                    writer.expect(label, Gamma, len(lam), final=(idx_round == N_round))
+                    for i in range(N_start, len(lam)):
+                        tasks.append((label, Gamma, i, lam[i], beta[i]))
+                if idx_round == 0:
+                    print(f"Running {len(tasks)} simulations with {N_proc} processes...")
+                else:
+                    print(f"Refinement {idx_round}/{N_round}: running {len(tasks)} simulations...")
+                if metrics is not None:
+                    metrics.write(
+                        "start", round=idx_round, N_task=len(tasks), N_proc=N_proc,
+                        N_obj=len(labels), Gamma=list(Gamma_values))
+                run_tasks(
+                    executor, tasks, objects, obj, rotP_hr, spin, writer, N_proc,
+                    cache, resume, metrics)
+
+                if idx_round == N_round:
+                    break
+                # Add poles where the flux varies fastest
+                N_start = len(next(iter(poles.values()))[0])
+                for (label, Gamma), (lam, beta) in poles.items():
+                    data = read_tpmres_file(writer.path(label, Gamma), usecols=[key_refine])
+                    lam_new, beta_new = refine_poles(lam, beta, data[key_refine], N_refine)
+                    poles[(label, Gamma)] = (
+                        np.concatenate([lam, lam_new]), np.concatenate([beta, beta_new]))
+    finally:
+        writer.close()
+
+    if metrics is not None:
+        metrics.write("end")
+    if cache is not None:
+        print(cache.stats())
+
+
+def run_tasks(executor, tasks, objects, obj, rotP_hr, spin, writer, N_proc, cache=None, resume=False, metrics=None):
+    """
+    Run simulations in a pool and stream their results.
+
+    Parameters
+    ----------
+    executor : concurrent.futures.ProcessPoolExecutor
+        pool of processes
+    tasks : list of tuple
+        (label, Gamma, idx, lam, beta) of simulations
+    objects : dict
+        label -> (obs, eph, geometry, wavelengths)
+    obj : str
+        shape model
+    rotP_hr : float
+        rotation period in hour
+    spin : SpinStager
+        staging of spin files
+    writer : TPMResWriter
+        writer of results
+    N_proc : int
+        number of processes
+    cache : TPMCache, optional
+        cache where results of simulations are saved
+    resume : bool
+        reuse results in the cache
+    metrics : MetricsLog, optional
+        log where timings of each simulation are written
+    """
+    N_task, N_done = len(tasks), 0
+
+    def write_metrics(label, Gamma, i, lam, beta, status="ok", **fields):
+        if metrics is not None:
+            metrics.write(
+                "task", objid=int(label), label=label, Gamma=Gamma, idx=int(i),
+                lam=float(lam), beta=float(beta), status=status, **fields)
+
+    def add_result(label, Gamma, entry):
+        nonlocal N_done
+        N_done += 1
+        if writer.add(label, Gamma, entry):
+            print(f"TI{Gamma}_res_{label}.txt completed ({N_done}/{N_task} simulations)")
+
+    # Keep the queue of the pool short to save memory
+    pending = {}
+    tasks = iter(tasks)
+    while True:
+        for label, Gamma, i, lam, beta in tasks:
+            obs, eph, geom, wavelengths = objects[label]
+            args_sim = (i, rotP_hr, lam, beta, Gamma, obs, eph, obj)
+            key = simulation_key(*args_sim) if cache is not None else None
+            if resume and (cache is not None):
+                # Results are saved without idx
+                value = cache.get(key)
+                if value is not None:
+                    # The spin file is archived with those of simulations run
+                    spin.stage(lam, beta, rotP_hr)
+                    add_result(label, Gamma, f"{i} {value}\n")
+                    write_metrics(label, Gamma, i, lam, beta, cached=True)
+                    continue
+            fut = executor.submit(
+                run_simulation, *args_sim, spin.stage(lam, beta, rotP_hr), geom,
+                wavelengths, time.time())
+            pending[fut] = (label, Gamma, key, i, lam, beta)
+            if len(pending) >= 4*N_proc:
+                break
+        if not pending:
+            break
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            label, Gamma, key, i, lam, beta = pending.pop(fut)
+            try:
+                entry, timings = fut.result()
+            except Exception as e:
+                write_metrics(label, Gamma, i, lam, beta, status="error", error=str(e))
+                raise
+            if cache is not None:
+                cache.put(key, entry.split(" ", 1)[1].rstrip("\n"))
+            add_result(label, Gamma, entry)
+            write_metrics(label, Gamma, i, lam, beta, cached=False, **timings)
+
+
+# Sharded execution with a shared work queue =================================
+def enqueue_tpm(queue, obs_list, eph_list, obj, N_pole, rotP_hr, Gamma_values, method="uniform"):
+    """
+    Add simulations of all objects, Gamma, and poles to a work queue.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        work queue
+    obs_list, eph_list : array-like
+        obs and eph files of objects (paths seen by all workers)
+    obj : str
+        shape model
+    N_pole : int
+        number of poles per object and Gamma
+    rotP_hr : float
+        rotation period in hour
+    Gamma_values : array-like
+        thermal inertia
+    method : str
+        sampling method of poles (see NEOMIR_poles.py)
+
+    Return
+    ------
+    N : int
+        number of simulations added
+    """
+    # Workers may run in other directories
+    obs_list = [os.path.abspath(x) for x in obs_list]
+    eph_list = [os.path.abspath(x) for x in eph_list]
+    labels, objects = campaign_objects(obs_list, eph_list)
+    # Poles are given by the sampling (seed 0), so that tasks of all runs of
+    # enqueue on a queue share one pole set
+    campaign = dict(
+        obj=os.path.abspath(obj), rotP_hr=rotP_hr, method=method, N_pole=N_pole,
+        objects={label: [obs, eph, list(geom), wavelengths] for label, (obs, eph, geom, wavelengths) in objects.items()})
+    try:
+        old = queue.get_meta("campaign")
+    except KeyError:
+        old = None
+    if (old is not None) and (old != campaign):
+        diff = sorted(key for key in campaign if (old.get(key) != campaign[key]))
+        raise ValueError(
+            f"The queue {queue.path} has another campaign (different {', '.join(diff)}; "
+            "objects, shape model, period, and poles must be the same)")
+    queue.set_meta("campaign", campaign)
+
+    lam, beta = sample_poles(N_pole, method, 0)
+    tasks = [
+        (label, Gamma, i, lam[i], beta[i])
+        for label in labels for Gamma in Gamma_values for i in range(len(lam))]
+    return queue.enqueue(tasks)
+
+
+def run_worker(queue, N_proc, worker=None, lease=600., max_attempts=3, poll=10., spinstage=None, metrics=None):
+    """
+    Run simulations claimed from a work queue until the queue is empty.
+
+    Results are appended to the shard of the worker before the tasks are
+    marked done. Leases of running and queued tasks are renewed every
+    lease/3 s; tasks of crashed workers are claimed again when their
+    leases expire.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        work queue
+    N_proc : int
+        number of processes
+    worker : str, optional
+        id of the worker (host-pid by default)
+    lease : float
+        duration of leases in s
+    max_attempts : int
+        number of attempts before a task is marked failed
+    poll : float
+        interval in s to check tasks leased by other workers
+    spinstage : str, optional
+        directory where spin files are staged
+    metrics : MetricsLog, optional
+        log where timings of each simulation are written
+
+    Return
+    ------
+    N_done, N_fail : int
+        numbers of simulations done and failed in this worker
+    """
+    worker = worker or default_worker_id()
+    campaign = queue.get_meta("campaign")
+    obj, rotP_hr = campaign["obj"], campaign["rotP_hr"]
+    objects = {
+        label: (obs, eph, tuple(geom), wavelengths)
+        for label, (obs, eph, geom, wavelengths) in campaign["objects"].items()}
+    spin = SpinStager(spinstage)
+    N_done, N_fail = 0, 0
+    print(f"Worker {worker} started with {N_proc} processes")
+    if metrics is not None:
+        # Tasks left in the queue (shared with other workers)
+        metrics.write("start", N_task=queue.N_open(), N_proc=N_proc, worker=worker)
+
+    pending = {}
+    t_renew = time.time()
+    try:
+        with open(queue.shard_path(worker), "a") as shard, ProcessPoolExecutor(max_workers=N_proc) as executor:
+            while True:
+                # Keep the queue of the pool short, so that others can claim the rest
+                if len(pending) < 2*N_proc:
+                    for task_id, label, Gamma, i, lam, beta in queue.claim(worker, 4*N_proc - len(pending), lease):
+                        obs, eph, geom, wavelengths = objects[label]
+                        fut = executor.submit(
+                            run_simulation, i, rotP_hr, lam, beta, Gamma, obs, eph, obj,
+                            spin.stage(lam, beta, rotP_hr), geom, wavelengths, time.time())
+                        pending[fut] = (task_id, label, Gamma, i, lam, beta)
+                if not pending:
+                    # Tasks leased by other workers come back if their leases expire
+                    if queue.N_open() == 0:
+                        break
+                    time.sleep(poll)
+                    continue
+
+                done, _ = wait(pending, timeout=lease/3, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    task_id, label, Gamma, i, lam, beta = pending.pop(fut)
+                    key = dict(objid=int(label), label=label, Gamma=Gamma, idx=i, lam=lam, beta=beta, worker=worker)
+                    try:
+                        entry, timings = fut.result()
+                    except Exception as e:
+                        queue.fail(worker, task_id, str(e), max_attempts)
+                        N_fail += 1
+                        print(f"Failed TI{Gamma} {label} idx={i}: {e}")
+                        if metrics is not None:
+                            metrics.write("task", **key, status="error", error=str(e))
+                        continue
+                    shard.write(f"{task_id} {label} {Gamma} {entry}")
+                    shard.flush()
+                    queue.complete(worker, task_id)
+                    N_done += 1
+                    if metrics is not None:
+                        metrics.write("task", **key, status="ok", cached=False, **timings)
+                    if N_done % 100 == 0:
+                        print(f"Worker {worker}: {N_done} simulations done ({queue.N_open()} left in the queue)")
+
+                if time.time() - t_renew > lease/3:
+                    queue.renew(worker, [v[0] for v in pending.values()], lease)
+                    t_renew = time.time()
+    finally:
+        if spinstage is None:
+            spin.cleanup()
+    if metrics is not None:
+        metrics.write("end")
+    print(f"Worker {worker} finished: {N_done} done, {N_fail} failed")
+    return N_done, N_fail
+
+
+def merge_tpm(queue, outdir, store=None, spindir=None, partial=False, catalog=None):
+    """
+    Merge shards of workers into TI{Gamma}_res_{label}.txt.
+
+    A task run twice (e.g., after its lease expired) is saved once.
+    A task marked done without a result in the shards (e.g., a node
+    crashed before the shard was written to disk) is put back into the
+    queue.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        work queue
+    outdir : str
+        directory for output file
+    store : TPMStoreWriter, optional
+        columnar store where results are also saved
+    spindir : str, optional
+        directory for archive of spin files
+    partial : bool
+        merge even if some tasks are not done (files with missing poles are skipped)
+    catalog : TPMCatalog, optional
+        catalog where results are also saved (campaign is the name of outdir)
+
+    Return
+    ------
+    N_file : int
+        number of files written
+    """
+    campaign = queue.get_meta("campaign")
+    wavelengths = {label: obj[3] for label, obj in campaign["objects"].items()}
+
+    # Results of each file (the first one of each task)
+    results = defaultdict(dict)
+    for path in queue.shards():
+        with open(path) as f:
+            for line in f:
+                # A line cut by a crash is ignored
+                if not line.endswith("\n"):
+                    continue
+                task_id, label, Gamma, entry = line.split(" ", 3)
+                idx = int(entry.split(" ", 1)[0])
+                results[(label, int(Gamma))].setdefault(idx, entry)
+
+    # Tasks without results
+    missing, lost = defaultdict(list), []
+    for task_id, label, Gamma, idx, lam, beta, state, _, _, _ in queue.tasks():
+        if idx not in results[(label, Gamma)]:
+            missing[(label, Gamma)].append(idx)
+            if state == "done":
+                lost.append(task_id)
+    if lost:
+        queue.requeue(lost)
+        print(f"{len(lost)} tasks done without results in shards are put back into the queue")
+    if missing and not partial:
+        raise RuntimeError(
+            f"{sum(len(v) for v in missing.values())} simulations of {len(missing)} files are not done "
+            f"({queue.counts()}); run workers again or merge with --partial")
+
+    writer = TPMResWriter(outdir, {label: tpmres_header(w) for label, w in wavelengths.items()}, store, catalog)
+    N_file = 0
+    try:
+        for (label, Gamma), entries in sorted(results.items()):
+            if (not entries) or ((label, Gamma) in missing):
+                print(f"Skip TI{Gamma}_res_{label}.txt ({len(missing[(label, Gamma)])} poles missing)")
+                continue
+            writer.expect(label, Gamma, len(entries))
+            for idx in sorted(entries):
+                writer.add(label, Gamma, entries[idx])
+            N_file += 1
+    finally:
+        writer.close()
+
+    if spindir is not None:
+        # Spin files are made from poles again
+        spin = SpinStager()
+        for entries in results.values():
+            for entry in entries.values():
+                lam, beta = entry.split(" ", 4)[2:4]
+                spin.stage(lam, beta, campaign["rotP_hr"])
+        spinarc = spin.archive(spindir)
+        spin.cleanup()
+        if spinarc is not None:
+            print(f"{len(spin.staged)} spin files saved in {spinarc}")
+    return N_file
+
 
 if __name__ == "__main__":
     parser = ap(description="Run TPM for NEOMIR project.")
@@ -102,24 +683,126 @@ if __name__ == "__main__":
         help="Rotation period in hour")
     parser.add_argument(
         "--spindir", type=str, default="spinfile",
-        help="Directory for output file")
+        help="Directory for archive of spin files")
+    parser.add_argument(
+        "--spinstage", type=str, default=None,
+        help="Directory where spin files are staged (kept for other campaigns)")
     parser.add_argument(
         "--outdir", type=str, default="tpmresult",
         help="Directory for output file")
+    parser.add_argument(
+        "--store", type=str, default=None,
+        help="Columnar store where results are also saved")
+    parser.add_argument(
+        "--catalog", type=str, default=None,
+        help="SQLite catalog where results are also saved (campaign is the name of outdir)")
+    parser.add_argument(
+        "--npole", type=int, default=300,
+        help="Number of poles per object and Gamma")
+    parser.add_argument(
+        "--poles", type=str, default="uniform", choices=pole_methods,
+        help="Sampling method of poles")
+    parser.add_argument(
+        "--refine", type=int, default=0,
+        help="Number of rounds of adaptive refinement of poles")
+    parser.add_argument(
+        "--nrefine", type=int, default=30,
+        help="Number of poles added per object and Gamma in each round")
+    parser.add_argument(
+        "--wrefine", type=float, default=8.0,
+        help="Wavelength in micron of the flux used in refinement (must be in obs files)")
+    parser.add_argument(
+        "--nproc", type=int, default=os.cpu_count(),
+        help="Number of parallel processes")
+    parser.add_argument(
+        "--cachedir", type=str, default="tpmcache",
+        help="Directory for cache of simulations")
+    parser.add_argument(
+        "--no-cache", dest="cache", action="store_false", default=True,
+        help="Do not save simulations in the cache")
+    parser.add_argument(
+        "--resume", action="store_true", default=False,
+        help="Skip simulations already in the cache")
+    parser.add_argument(
+        "--metrics", type=str, default=None,
+        help="JSON-lines file where timings of each simulation are appended")
+    parser.add_argument(
+        "--mode", type=str, default="local", choices=["local", "enqueue", "worker", "merge"],
+        help="local (single machine), or enqueue/worker/merge with a shared --queue")
+    parser.add_argument(
+        "--queue", type=str, default=None,
+        help="SQLite file of the work queue (on storage shared by workers)")
+    parser.add_argument(
+        "--worker", type=str, default=None,
+        help="Id of the worker (host-pid by default)")
+    parser.add_argument(
+        "--lease", type=float, default=600.,
+        help="Lease of tasks in s (tasks of crashed workers are run again after it)")
+    parser.add_argument(
+        "--maxattempts", type=int, default=3,
+        help="Number of attempts before a task is marked failed")
+    parser.add_argument(
+        "--partial", action="store_true", default=False,
+        help="Merge even if some tasks are not done")
     args = parser.parse_args()
    
-    outdir = args.outdir
-    os.makedirs(outdir, exist_ok=True)
-    spindir = args.spindir
-    os.makedirs(spindir, exist_ok=True)
+    if args.mode != "local":
+        # Sharded execution with a shared work queue
+        assert args.queue, "Set --queue for enqueue, worker, and merge."
+        queue = WorkQueue(args.queue)
+        if args.mode == "enqueue":
+            assert len(args.obs) == len(args.eph), "Check the input files."
+            assert args.refine == 0, "Refinement of poles is not supported with a queue."
+            N = enqueue_tpm(
+                queue, args.obs, args.eph, args.obj, args.npole, args.rotP_hr,
+                args.gamma, args.poles)
+            print(f"{N} simulations added to {args.queue} ({queue.counts()})")
+        elif args.mode == "worker":
+            metrics = MetricsLog(args.metrics, "runtpm") if args.metrics else None
+            run_worker(
+                queue, args.nproc, args.worker, args.lease, args.maxattempts,
+                spinstage=args.spinstage, metrics=metrics)
+            if metrics is not None:
+                metrics.close()
+        elif args.mode == "merge":
+            os.makedirs(args.outdir, exist_ok=True)
+            store = TPMStoreWriter(args.store) if args.store else None
+            catalog = TPMCatalog(args.catalog) if args.catalog else None
+            N_file = merge_tpm(queue, args.outdir, store, args.spindir, args.partial, catalog)
+            print(f"{N_file} files saved in {args.outdir}")
+            if catalog is not None:
+                catalog.close()
+        queue.close()
+    else:
+        outdir = args.outdir
+        os.makedirs(outdir, exist_ok=True)
+        spindir = args.spindir
+        os.makedirs(spindir, exist_ok=True)
+        spin = SpinStager(args.spinstage)
+        store = TPMStoreWriter(args.store) if args.store else None
+        catalog = TPMCatalog(args.catalog) if args.catalog else None
     
-    N_obs, N_eph = len(args.obs), len(args.eph)
-    assert N_obs == N_eph, "Check the input files."
-
-    # Do tpm
-    N = 30  # Number of parallel processes
-    M = 10  # Number of cycles per Gamma value
-    for n in range(N_obs):
-        obs, eph = args.obs[n], args.eph[n]
-        label = f"{n+1:03d}"
-        main_tpm(obs, eph, args.obj, N, M, args.rotP_hr, args.gamma, label, spindir, outdir)
+        N_obs, N_eph = len(args.obs), len(args.eph)
+        assert N_obs == N_eph, "Check the input files."
+
+        assert args.cache or not args.resume, "--resume needs the cache (remove --no-cache)."
+        cache = TPMCache(args.cachedir) if args.cache else None
+        metrics = MetricsLog(args.metrics, "runtpm") if args.metrics else None
+
+        # Do tpm
+        main_tpm(
+            args.obs, args.eph, args.obj, args.npole, args.rotP_hr, args.gamma,
+            spin, outdir, args.nproc, store, cache, args.resume,
+            args.poles, args.refine, args.nrefine, metrics, catalog, args.wrefine)
+        if cache is not None:
+            cache.close()
+        if metrics is not None:
+            metrics.close()
+        if catalog is not None:
+            catalog.close()
+
+        # Save spin files at once
+        spinarc = spin.archive(spindir)
+        if spinarc is not None:
+            print(f"{len(spin.staged)} spin files ({spin.N_request} requests) saved in {spinarc}")
+        spin.cleanup()